@@ -1,33 +1,331 @@
+import os
+from datetime import datetime, timedelta, timezone
 import streamlit as st
-from api.main import create_contract, create_obligation, mark_contract_as_processed
+from api.main import create_contract, create_obligation, mark_contract_as_processed, bulk_upload_billing_schedule, get_obligations, iter_contract_obligations
+from api.tools import billing_term_payload_to_bulk_row, bulk_billing_schedule_file, match_obligations_to_rows
 from api.links import invoices_for_customer_and_contract_name
+from helper.metrics import timed_step
+from helper.task_queue import save_checkpoint, PipelineStage
+from helper.retry import RetryLater
+from helper.cancellation import TaskCancelled, check_cancelled
 
+# Batches with bulk upload turned on and at least this many rows upload their obligations through the bulk billing
+# schedule endpoint, BULK_UPLOAD_CHUNK_SIZE rows per upload
+BULK_UPLOAD_ROW_THRESHOLD = int(os.getenv("BULK_UPLOAD_ROW_THRESHOLD", 500))
+BULK_UPLOAD_CHUNK_SIZE = int(os.getenv("BULK_UPLOAD_CHUNK_SIZE", 500))
 
-def one_off_invoice_chain(customer_id, contract_name, billing_term_payload, merchant_link=None, task=None):
+# The steps of one_off_invoice_chain. Each step keeps its output in the task checkpoint and returns early when
+# an earlier run (retry or resumed batch) already did it, so they can also run one at a time as pipeline stages.
+
+
+def step_checkpoint(task, checkpoint):
+    if checkpoint is not None:
+        return checkpoint
+    if task is None:
+        return {}
+    if task.checkpoint is None:
+        task.checkpoint = {}
+    return task.checkpoint
+
+
+def existing_obligation_ids(contract_id, billing_term_payloads, task=None):
+    """Row key -> id of the obligation an earlier run already created for that row on a reused contract"""
+    return match_obligations_to_rows(billing_term_payloads, get_obligations(contract_id, task=task))
+
+
+def reuse_contract(checkpoint, task, existing_contract_id):
+    """An unprocessed contract with the same customer and name from an earlier run takes the place of a new one"""
+    checkpoint["contract_id"] = existing_contract_id
+    checkpoint["reused_contract"] = True
+    save_checkpoint(task, contract_id=existing_contract_id, reused_contract=True)
+    return existing_contract_id
+
+
+def create_contract_step(customer_id, contract_name, billing_term_payload, merchant_link=None, task=None, checkpoint=None, existing_contract_id=None):
+    checkpoint = step_checkpoint(task, checkpoint)
+    if checkpoint.get("contract_id") is not None:
+        return checkpoint["contract_id"]
+    if existing_contract_id is not None:
+        return reuse_contract(checkpoint, task, existing_contract_id)
 
     # try:
-    contract_id = create_contract(customer_id=customer_id, contract_name=contract_name, task=task)
+    with timed_step(task, "create_contract"):
+        contract_id = create_contract(customer_id=customer_id, contract_name=contract_name, task=task)
     # except Exception as e:
     #     st.toast(f"Error creating contract for customer {customer_id}: {e}", icon=":material/error:")
     #     raise Exception(f"Error creating contract for customer {customer_id}: {e}")
-    
+    if contract_id is None:
+        raise Exception(f"Error creating contract for customer {customer_id}, check the logs for more details")
+    checkpoint["contract_id"] = contract_id
+    save_checkpoint(task, contract_id=contract_id)
+    return contract_id
+
+
+def create_obligation_step(customer_id, contract_name, billing_term_payload, merchant_link=None, task=None, checkpoint=None, existing_contract_id=None):
+    checkpoint = step_checkpoint(task, checkpoint)
+    if checkpoint.get("obligation_id") is not None:
+        return checkpoint["obligation_id"]
+
+    contract_id = checkpoint["contract_id"]
+    if checkpoint.get("reused_contract"):
+        # The earlier run may have stopped after creating the obligation
+        obligation_id = existing_obligation_ids(contract_id, {"row": billing_term_payload}, task=task).get("row")
+        if obligation_id is not None:
+            checkpoint["obligation_id"] = obligation_id
+            save_checkpoint(task, obligation_id=obligation_id)
+            return obligation_id
     try:
-        obligation_id = create_obligation(payload=billing_term_payload, contract_id=contract_id, task=task)
+        with timed_step(task, "create_obligation"):
+            obligation_id = create_obligation(payload=billing_term_payload, contract_id=contract_id, task=task)
+        if obligation_id is None:
+            raise Exception("no obligation was created, check the logs for more details")
+    except (RetryLater, TaskCancelled):
+        raise
     except Exception as e:
         st.toast(f"Error creating obligation for contract {contract_id}: {e}", icon=":material/error:")
         raise Exception(f"Error creating obligation for contract {contract_id}: {e}")
-    
-    try:
-        results = mark_contract_as_processed(contract_id=contract_id, task=task)
-    except Exception as e:
-        st.toast(f"Error marking contract as processed for contract {contract_id}: {e}", icon=":material/error:")
-        raise Exception(f"Error marking contract as processed for contract {contract_id}: {e}")
+    checkpoint["obligation_id"] = obligation_id
+    save_checkpoint(task, obligation_id=obligation_id)
+    return obligation_id
+
+
+def mark_contract_as_processed_step(customer_id, contract_name, billing_term_payload, merchant_link=None, task=None, checkpoint=None, existing_contract_id=None):
+    checkpoint = step_checkpoint(task, checkpoint)
+    contract_id = checkpoint["contract_id"]
+    if not checkpoint.get("processed"):
+        try:
+            with timed_step(task, "mark_contract_as_processed"):
+                results = mark_contract_as_processed(contract_id=contract_id, task=task)
+        except (RetryLater, TaskCancelled):
+            raise
+        except Exception as e:
+            st.toast(f"Error marking contract as processed for contract {contract_id}: {e}", icon=":material/error:")
+            raise Exception(f"Error marking contract as processed for contract {contract_id}: {e}")
+
+        if results is None:
+            st.toast(f"Error marking contract as processed for contract {contract_id}, check the logs for more details", icon=":material/error:")
+            raise Exception(f"Error marking contract as processed for contract {contract_id}, check the logs for more details")
+        checkpoint["processed"] = True
+        save_checkpoint(task, processed=True)
+
+    # TODO return the link to the invoice
+    return invoices_for_customer_and_contract_name(customer_id, contract_name, merchant_link=merchant_link)
+
+
+# Pipelined version of one_off_invoice_chain, rows move through the stages independently
+ONE_OFF_INVOICE_STAGES = (
+    PipelineStage("create_contract", create_contract_step),
+    PipelineStage("create_obligation", create_obligation_step),
+    PipelineStage("mark_contract_as_processed", mark_contract_as_processed_step),
+)
+
+
+def one_off_invoice_chain(customer_id, contract_name, billing_term_payload, merchant_link=None, task=None, existing_contract_id=None):
+    # Steps already completed by an earlier run of this task (retry or resumed batch) are skipped
+    checkpoint = step_checkpoint(task, None)
+    step_args = dict(customer_id=customer_id, contract_name=contract_name, billing_term_payload=billing_term_payload, merchant_link=merchant_link, task=task, checkpoint=checkpoint, existing_contract_id=existing_contract_id)
+    create_contract_step(**step_args)
+    check_cancelled(task)
+    create_obligation_step(**step_args)
+    check_cancelled(task)
+    return mark_contract_as_processed_step(**step_args)
+
+
+# Grouped mode: one task per customer. One contract gets the obligation of every row of the group and is marked
+# processed once, 2 requests per customer plus 1 per row instead of 3 per row. billing_term_payloads maps the
+# row key (the row position as a string, checkpoints go through JSON) to that row's billing term payload.
+
+
+def create_group_contract_step(customer_id, contract_name, billing_term_payloads, merchant_link=None, task=None, checkpoint=None, existing_contract_id=None):
+    return create_contract_step(customer_id, contract_name, None, merchant_link=merchant_link, task=task, checkpoint=checkpoint, existing_contract_id=existing_contract_id)
+
+
+def create_group_obligations_step(customer_id, contract_name, billing_term_payloads, merchant_link=None, task=None, checkpoint=None, existing_contract_id=None):
+    checkpoint = step_checkpoint(task, checkpoint)
+    contract_id = checkpoint["contract_id"]
+    if checkpoint.get("reused_contract") and "obligation_ids" not in checkpoint:
+        # Only rows whose obligation an earlier run created are skipped, the others are created below
+        checkpoint["obligation_ids"] = existing_obligation_ids(contract_id, billing_term_payloads, task=task)
+        save_checkpoint(task, obligation_ids=checkpoint["obligation_ids"])
+    obligation_ids = checkpoint.setdefault("obligation_ids", {})
+    for row_key, billing_term_payload in billing_term_payloads.items():
+        if obligation_ids.get(row_key) is not None:
+            continue
+        check_cancelled(task)
+        try:
+            with timed_step(task, "create_obligation"):
+                obligation_id = create_obligation(payload=billing_term_payload, contract_id=contract_id, task=task)
+            if obligation_id is None:
+                raise Exception("no obligation was created, check the logs for more details")
+        except (RetryLater, TaskCancelled):
+            raise
+        except Exception as e:
+            st.toast(f"Error creating obligation for contract {contract_id}: {e}", icon=":material/error:")
+            raise Exception(f"Error creating obligation for contract {contract_id} (row {row_key}): {e}")
+        # Saved per obligation, a retry only creates the ones still missing
+        obligation_ids[row_key] = obligation_id
+        save_checkpoint(task, obligation_ids=obligation_ids)
+    return obligation_ids
+
+
+def mark_group_contract_as_processed_step(customer_id, contract_name, billing_term_payloads, merchant_link=None, task=None, checkpoint=None, existing_contract_id=None):
+    return mark_contract_as_processed_step(customer_id, contract_name, None, merchant_link=merchant_link, task=task, checkpoint=checkpoint)
+
+
+GROUPED_INVOICE_STAGES = (
+    PipelineStage("create_group_contract", create_group_contract_step),
+    PipelineStage("create_group_obligations", create_group_obligations_step),
+    PipelineStage("mark_group_contract_as_processed", mark_group_contract_as_processed_step),
+)
+
+
+def grouped_invoice_chain(customer_id, contract_name, billing_term_payloads, merchant_link=None, task=None, existing_contract_id=None):
+    checkpoint = step_checkpoint(task, None)
+    step_args = dict(customer_id=customer_id, contract_name=contract_name, billing_term_payloads=billing_term_payloads, merchant_link=merchant_link, task=task, checkpoint=checkpoint, existing_contract_id=existing_contract_id)
+    create_group_contract_step(**step_args)
+    check_cancelled(task)
+    create_group_obligations_step(**step_args)
+    check_cancelled(task)
+    return mark_group_contract_as_processed_step(**step_args)
+
+
+# Bulk mode: one task per chunk of rows. Contracts are still created and marked processed one by one, the obligations
+# of the whole chunk go up in one bulk billing schedule file. groups is a list of {"customer_id", "billing_term_payloads"},
+# one contract each (one row per group unless rows are grouped per customer), a group with "existing_contract_id"
+# reuses that contract and its obligations. The ids the upload returns are checked against the contract of their row,
+# with one listing of the obligations the upload created, before any contract is marked processed. Returns the invoice link per row key, the contract of each row key is kept
+# in the checkpoint as row_contract_ids.
+
+
+def bulk_upload_started_at():
+    # Lower bound for the createdAt of the obligations an upload creates, a few minutes early in case the clocks differ
+    return (datetime.now(timezone.utc) - timedelta(minutes=5)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def chunk_obligations(contract_name, contract_ids, created_from=None, task=None):
+    """
+    Contract id -> obligations for the contracts of a chunk, from one listing of the obligations of the contracts named
+    contract_name (created since created_from when given) instead of one request per contract.
+    """
+    obligations = {contract_id: [] for contract_id in contract_ids}
+    check_cancelled(task)
+    with timed_step(task, "list_chunk_obligations"):
+        for obligation in iter_contract_obligations(contract_name=contract_name, created_from=created_from, task=task):
+            if obligation.get("contractId") in obligations:
+                obligations[obligation["contractId"]].append(obligation)
+    return obligations
+
+
+def verify_bulk_billing_term_ids(row_keys, billing_term_ids, row_contract_ids, contract_obligations):
+    """
+    Map the ids the bulk upload returned (one per file row, in file order) to the row keys, after checking that each
+    one is an obligation of that row's contract (contract_obligations, see chunk_obligations). Raises when they cannot
+    be mapped, nothing is marked processed then.
+    """
+    if len(billing_term_ids) != len(row_keys) or len(set(billing_term_ids)) != len(billing_term_ids):
+        raise Exception(f"Bulk upload returned {len(billing_term_ids)} billing term ids ({len(set(billing_term_ids))} distinct) for {len(row_keys)} rows, check the contracts of the chunk before retrying")
+    contract_obligation_ids = {
+        contract_id: {obligation["id"] for obligation in obligations}
+        for contract_id, obligations in contract_obligations.items()
+    }
+    mismatched = [
+        row_key for row_key, billing_term_id in zip(row_keys, billing_term_ids)
+        if billing_term_id not in contract_obligation_ids.get(row_contract_ids[row_key], ())
+    ]
+    if mismatched:
+        raise Exception(f"Bulk upload returned billing term ids that are not on the contract of {len(mismatched)} row(s) (rows {', '.join(mismatched[:10])}), check the contracts of the chunk before retrying")
+    return dict(zip(row_keys, billing_term_ids))
+
+
+def bulk_invoice_chain(contract_name, groups, merchant_name, merchant_link=None, task=None):
+    checkpoint = step_checkpoint(task, None)
+    contract_ids = checkpoint.setdefault("contract_ids", {})
+    for group_key, group in enumerate(groups):
+        group_key = str(group_key)
+        if contract_ids.get(group_key) is not None:
+            continue
+        if group.get("existing_contract_id") is not None:
+            contract_ids[group_key] = group["existing_contract_id"]
+            save_checkpoint(task, contract_ids=contract_ids)
+            continue
+        check_cancelled(task)
+        with timed_step(task, "create_contract"):
+            contract_id = create_contract(customer_id=group["customer_id"], contract_name=contract_name, task=task)
+        if contract_id is None:
+            raise Exception(f"Error creating contract for customer {group['customer_id']}, check the logs for more details")
+        contract_ids[group_key] = contract_id
+        save_checkpoint(task, contract_ids=contract_ids)
 
-    if results is None:
-        st.toast(f"Error marking contract as processed for contract {contract_id}, check the logs for more details", icon=":material/error:")
-        raise Exception(f"Error marking contract as processed for contract {contract_id}, check the logs for more details")
-    else:
-        # TODO return the link to the invoice
-        return invoices_for_customer_and_contract_name(customer_id, contract_name, merchant_link=merchant_link)
-    
+    if checkpoint.get("obligation_ids") is None:
+        check_cancelled(task)
+        row_contract_ids = {
+            row_key: contract_ids[str(group_key)]
+            for group_key, group in enumerate(groups)
+            for row_key in group["billing_term_payloads"]
+        }
+        chunk_contract_ids = list(dict.fromkeys(contract_ids.values()))
+        upload_started = checkpoint.get("bulk_upload_started")
+        reuses_contracts = any(group.get("existing_contract_id") is not None for group in groups)
+        obligation_ids = {}
+        if reuses_contracts or upload_started is not None:
+            # A reused contract or an earlier upload of this chunk may already have the obligation of some rows, they
+            # are matched by billing_term_signature and not uploaded again
+            existing = chunk_obligations(contract_name, chunk_contract_ids, created_from=None if reuses_contracts else upload_started, task=task)
+            for group_key, group in enumerate(groups):
+                obligation_ids.update(match_obligations_to_rows(group["billing_term_payloads"], existing[contract_ids[str(group_key)]]))
+        row_keys = []
+        rows = []
+        for group in groups:
+            for row_key, billing_term_payload in group["billing_term_payloads"].items():
+                if row_key in obligation_ids:
+                    continue
+                row_keys.append(row_key)
+                rows.append(billing_term_payload_to_bulk_row(billing_term_payload, row_contract_ids[row_key]))
+        if rows:
+            if upload_started is None:
+                upload_started = bulk_upload_started_at()
+                checkpoint["bulk_upload_started"] = upload_started
+                save_checkpoint(task, bulk_upload_started=upload_started)
+            try:
+                with timed_step(task, "bulk_upload_billing_schedule"):
+                    billing_term_ids = bulk_upload_billing_schedule(files=bulk_billing_schedule_file(rows), merchant_name=merchant_name, task=task)
+            except (RetryLater, TaskCancelled):
+                raise
+            except Exception as e:
+                st.toast(f"Error uploading {len(rows)} billing schedules: {e}", icon=":material/error:")
+                raise Exception(f"Error uploading {len(rows)} billing schedules: {e}")
+            # Nothing is checkpointed before the ids are verified, a rerun looks up what the upload created instead
+            uploaded_obligations = chunk_obligations(contract_name, chunk_contract_ids, created_from=upload_started, task=task)
+            obligation_ids.update(verify_bulk_billing_term_ids(row_keys, billing_term_ids, row_contract_ids, uploaded_obligations))
+        checkpoint["obligation_ids"] = obligation_ids
+        save_checkpoint(task, obligation_ids=obligation_ids)
 
+    processed_contracts = checkpoint.setdefault("processed_contracts", {})
+    links = {}
+    for group_key, group in enumerate(groups):
+        group_key = str(group_key)
+        contract_id = contract_ids[group_key]
+        if not processed_contracts.get(group_key):
+            check_cancelled(task)
+            try:
+                with timed_step(task, "mark_contract_as_processed"):
+                    results = mark_contract_as_processed(contract_id=contract_id, task=task)
+            except (RetryLater, TaskCancelled):
+                raise
+            except Exception as e:
+                raise Exception(f"Error marking contract as processed for contract {contract_id}: {e}")
+            if results is None:
+                raise Exception(f"Error marking contract as processed for contract {contract_id}, check the logs for more details")
+            processed_contracts[group_key] = True
+            save_checkpoint(task, processed_contracts=processed_contracts)
+        link = invoices_for_customer_and_contract_name(group["customer_id"], contract_name, merchant_link=merchant_link)
+        for row_key in group["billing_term_payloads"]:
+            links[row_key] = link
+    if "row_contract_ids" not in checkpoint:
+        # Lets the invoices fetched after the batch be joined back to the rows of the chunk
+        save_checkpoint(task, row_contract_ids={
+            row_key: contract_ids[str(group_key)]
+            for group_key, group in enumerate(groups)
+            for row_key in group["billing_term_payloads"]
+        })
+    return links
@@ -1,14 +1,19 @@
 import streamlit as st
-import requests
 import math
 from datetime import datetime
 import pandas as pd
 from urllib.parse import quote
 import json
-import time
 import hashlib
 import re
 from helper.logger import print_logger
+from helper.http_sessions import get_session
+from helper.rate_limiter import acquire_request_slot
+from helper.retry import send_with_retries, rewind_files, RETRY_LATER_AFTER_SECONDS, OVERLOAD_STATUSES
+from helper.parallel import ordered_parallel_map
+from helper.request_log import build_request_record
+from helper.metrics import record_request, normalize_endpoint
+from helper.cancellation import check_cancelled
 import random
 ### UTILITIES FUNCTIONS ###
 
@@ -20,27 +25,26 @@ def test_generate_hash():
     result = get_generate_hash(timestamp)
     return result
 
-def generate_request_log(method, backend_url, endpoint, payload, response, batch_id=None):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    more_precise_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-    random_string = str(random.randint(1, 1000000))
-    hash_i = get_generate_hash(more_precise_timestamp, random_string)
-    return {
-        "method": method,
-        "backend_url": backend_url,
-        "endpoint": endpoint,
-        "payload": payload,
-        "response": response,
-        "timestamp": timestamp,
-        "hash": hash_i,
-        "batch_id": batch_id
-    }
+def generate_request_log(method, backend_url, endpoint, payload, response, batch_id=None, attempt=0, retry_decision=None, retry_delay=None, retry_reason=None, latency=None, error=None):
+    return build_request_record(
+        method=method,
+        backend_url=backend_url,
+        endpoint=endpoint,
+        payload=payload,
+        response=response,
+        batch_id=batch_id,
+        attempt=attempt,
+        retry_decision=retry_decision,
+        retry_delay=retry_delay,
+        retry_reason=retry_reason,
+        latency=latency,
+        error=error,
+    )
 
 def dummy_data(dummy, dummy2=None, task=None):
     print_logger("we fired the dummy data function")
-    result = make_get_request(endpoint="/health", task=task)
-    log = generate_request_log("GET", task.backend_url, "/health", {}, result, task.batch_id)
-    task.request_log = log
+    # The request is already on the task's request log
+    make_get_request(endpoint="/health", task=task)
     return dummy
 
 def non_blank_or_nan(value):
@@ -65,9 +69,7 @@ def is_rate_limited(response):
     except:
         return False
 
-def generalized_make_request(endpoint, method, payload=None, files=None, params=None, task=None, attempts=0):
-    if attempts > 30:
-        raise ValueError("Max attempts reached (30), request failed")
+def generalized_make_request(endpoint, method, payload=None, files=None, params=None, task=None):
     print_logger("Making", method, "request to", endpoint)
     if task is None:
         backend_url = st.session_state.backend_url
@@ -81,35 +83,54 @@ def generalized_make_request(endpoint, method, payload=None, files=None, params=
         batch_id = task.batch_id
     if backend_url is None or api_key is None:
         raise ValueError("Backend URL or API key is None")
+    if method not in ["GET", "POST", "PUT", "DELETE", "PATCH"]:
+        raise ValueError(f"Invalid method: {method}")
     final_url = f"{backend_url}{endpoint}"
     headers = {"Authorization": f"{api_key}"}
-    match method:
-        case "GET":
-            response = requests.get(final_url, headers=headers, params=params)
-        case "POST":
-            response = requests.post(final_url, headers=headers, json=payload, files=files)
-        case "PUT":
-            response = requests.put(final_url, headers=headers, json=payload)
-        case "DELETE":
-            response = requests.delete(final_url, headers=headers)
-        case "PATCH":
-            response = requests.patch(final_url, headers=headers, json=payload)
-        case _:
-            raise ValueError(f"Invalid method: {method}")
-    request_log = generate_request_log(method, backend_url, endpoint, payload, response, batch_id)
-    if using_session_state:
-        st.toast(f"{method} Request to {endpoint} returned {response.status_code}")
-        st.session_state.request_history.append(request_log)
-    else:
-        task.request_logs.append(request_log)
-    if is_rate_limited(response):
-        print_logger("Rate limited response received, backing off for 1 second and retrying")
-        attempts += 1
-        print_logger("Attempting to make request again in", attempts, "seconds")
-        time.sleep(attempts) # Linear backoff
-        return generalized_make_request(endpoint, method, payload, files, params, task, attempts)
-    else:
-        return response
+    session = get_session(backend_url, api_key)
+
+    def send(timeout):
+        rewind_files(files)
+        match method:
+            case "GET":
+                return session.get(final_url, headers=headers, params=params, timeout=timeout)
+            case "POST":
+                return session.post(final_url, headers=headers, json=payload, files=files, timeout=timeout)
+            case "PUT":
+                return session.put(final_url, headers=headers, json=payload, timeout=timeout)
+            case "DELETE":
+                return session.delete(final_url, headers=headers, timeout=timeout)
+            case "PATCH":
+                return session.patch(final_url, headers=headers, json=payload, timeout=timeout)
+
+    def log_attempt(response, error, attempt, decision, delay, reason, latency):
+        request_log = generate_request_log(method, backend_url, endpoint, payload, response, batch_id, attempt=attempt, retry_decision=decision, retry_delay=delay, retry_reason=reason, latency=latency, error=error)
+        if using_session_state:
+            status = response.status_code if response is not None else type(error).__name__
+            st.toast(f"{method} Request to {endpoint} returned {status}")
+            st.session_state.request_history.append(request_log)
+        else:
+            task.log_request(request_log)
+            if response is not None and task.queue is not None:
+                task.queue.record_response(is_rate_limited(response), latency, normalize_endpoint(method, endpoint), response.status_code in OVERLOAD_STATUSES)
+
+    def before_attempt():
+        # A cancelled task stops here instead of sending (or retrying) the request
+        check_cancelled(task)
+        return acquire_request_slot(backend_url, api_key)
+
+    def log_completion(response, error, wall_time, wait_time, retries):
+        failed = error is not None or response is None or response.status_code >= 400
+        record_request(task, method, endpoint, wall_time, wait_time, retries, failed)
+
+    return send_with_retries(
+        send, 
+        method, 
+        on_attempt=log_attempt, 
+        before_attempt=before_attempt,
+        on_complete=log_completion,
+        # Queued tasks hand long backoffs back to the scheduler instead of holding the worker
+        defer_after=RETRY_LATER_AFTER_SECONDS if task is not None and task.queue is not None else None)
 
 def make_post_request(endpoint, payload=None, merchant_id=None, files=None, task=None):
     return generalized_make_request(endpoint, "POST", payload=payload, files=files, task=task)
@@ -126,6 +147,43 @@ def make_put_request(endpoint, payload=None, merchant_id=None, task=None):
 def make_delete_request(endpoint, task=None):
     return generalized_make_request(endpoint, "DELETE", task=task)
 
+def iter_pages(build_endpoint, limit=None, task=None, get_all=True):
+    """
+    Yields the data list of every page of a list endpoint as it arrives.
+    `build_endpoint(page, limit)` returns the endpoint for a page, `limit` is None until page 1 told us the page size.
+    Pages 2..N are fetched concurrently and yielded in page order, only a handful are in memory at once.
+    """
+    response = make_get_request(endpoint=build_endpoint(1, limit), task=task)
+    results = check_success(response)
+    if results is None:
+        return
+    payload = results.get("payload", {})
+    yield payload.get("data", [])
+    if not get_all:
+        return
+
+    total_items = payload.get("totalItems", 0)
+    limit = limit or payload.get("limit")
+    if not limit:
+        return
+
+    def fetch_page(page):
+        response = make_get_request(endpoint=build_endpoint(page, limit), task=task)
+        results = check_success(response)
+        if results is None:
+            return None
+        return results.get("payload", {}).get("data", [])
+
+    for page_data in ordered_parallel_map(fetch_page, range(2, math.ceil(total_items / limit) + 1)):
+        if page_data is None:
+            print_logger("No more results found")
+            return
+        yield page_data
+
+def iter_records(build_endpoint, limit=None, task=None, get_all=True):
+    for page_data in iter_pages(build_endpoint, limit=limit, task=task, get_all=get_all):
+        yield from page_data
+
 def check_success(response):
     results = dict(response.json())
     if results.get("success") == False:
@@ -221,6 +279,28 @@ def create_contract(customer_id, contract_name, external_id=None, external_id_so
     else:
         return results.get("payload", {}).get("id","ID NOT FOUND")
 
+def iter_customers(limit=500, filter=None, task=None, get_all=True):
+    """
+    Stream customers with optional filtering, page by page.
+    
+    Args:
+        limit (int): Number of records per page (default: 500)
+        filter (str): Optional filter string to search customers by name
+        
+    Yields:
+        dict: One customer at a time across all pages
+    """
+    if filter:
+        filter = filter.replace(",", "")
+
+    def build_endpoint(page, limit):
+        endpoint = f"/v3/customers?limit={limit}&page={page}"
+        if filter:
+            endpoint += f'&filter=name:like:"{filter}"'
+        return endpoint
+
+    yield from iter_records(build_endpoint, limit=limit, task=task, get_all=get_all)
+
 def get_customers(limit=500, filter=None, get_all=False, task=None):
     """
     Get all customers with optional filtering, handling pagination automatically.
@@ -232,45 +312,7 @@ def get_customers(limit=500, filter=None, get_all=False, task=None):
     Returns:
         list: Complete list of customers across all pages
     """
-    all_customers = []
-    page = 1
-    
-    # Make initial request to get first page and total items
-    endpoint = f"/v3/customers?limit={limit}&page={page}"
-    if filter:
-        filter = filter.replace(",", "")
-        endpoint += f'&filter=name:like:"{filter}"'
-    
-    response = make_get_request(endpoint=endpoint, task=task)
-    results = check_success(response)
-    
-    if results is None:
-        return []
-    
-    payload = results.get("payload", {})
-    total_items = payload.get("totalItems", 0)
-    all_customers.extend(payload.get("data", []))
-    
-    # Calculate total pages needed using ceiling division
-    total_pages = math.ceil(total_items / limit)
-    
-    if get_all:
-        # Fetch remaining pages
-        for page in range(2, total_pages + 1):
-            endpoint = f"/v3/customers?limit={limit}&page={page}"
-            if filter:
-                endpoint += f'&filter=name:like:"{filter}"'
-            
-            response = make_get_request(endpoint=endpoint, task=task)
-            results = check_success(response)
-            
-            if results is None:
-                break
-                
-            page_data = results.get("payload", {}).get("data", [])
-            all_customers.extend(page_data)
-    
-    return all_customers
+    return list(iter_customers(limit=limit, filter=filter, task=task, get_all=get_all))
 
 def get_customer_by_id(customer_id, task=None):
     endpoint = f"/v3/customers/{customer_id}"
@@ -290,6 +332,28 @@ def get_all_contracts(task=None,get_all=False):
     else:
         return results.get("payload",{}).get("data",[])
 
+def iter_contracts(customer_id=None, name=None, status=None, task=None, get_all=True, limit=500):
+    """
+    Stream contracts page by page, filtered on the backend by customer, name and status.
+    """
+    filters = []
+    if customer_id:
+        filters.append(f'customerId:eq:"{customer_id}"')
+    if name:
+        filters.append(f'name:eq:"{name}"')
+    if status:
+        filters.append(f'status:eq:"{status}"')
+
+    def build_endpoint(page, limit):
+        endpoint = f"/v3/contracts?limit={limit}"
+        if page > 1:
+            endpoint += f"&page={page}"
+        if filters:
+            endpoint += f"&filter={'+'.join(filters)}"
+        return endpoint
+
+    yield from iter_records(build_endpoint, limit=limit, task=task, get_all=get_all)
+
 # NOTE: THIS IS A FAKE ENDPOINT, IT GETS ALL CONTRACTS FROM THE SESSION STATE, FILTERS VIA PANDAS
 def get_contracts(
     customer_id: str | None = None,
@@ -424,20 +488,12 @@ def get_obligations(contract_id, task=None):
     else:
         return results.get("payload", {}).get("data", [])
     
-def get_contract_obligations(contract_id=None, customer_id=None, obligation_name=None, customer_name=None, task=None, get_all=False, limit=500):
+def iter_contract_obligations(contract_id=None, customer_id=None, obligation_name=None, customer_name=None, contract_name=None, created_from=None, task=None, get_all=True, limit=500):
     """
-    Get obligations (billing terms) with flexible filtering options.
-    
-    Args:
-        contract_id (str, optional): Filter by contract ID
-        customer_id (str, optional): Filter by customer ID
-        obligation_name (str, optional): Filter by obligation name
-        customer_name (str, optional): Filter by customer name
-        
-    Returns:
-        list: List of obligations if request successful, empty list otherwise
+    Stream obligations (billing terms) with flexible filtering options, see get_contract_obligations. contract_name
+    narrows the listing to the obligations of contracts with that name, created_from (ISO timestamp) to the ones
+    created since then.
     """
-    endpoint = f"/v3/obligations?limit={limit}"
     filters = []
     
     if contract_id:
@@ -448,29 +504,35 @@ def get_contract_obligations(contract_id=None, customer_id=None, obligation_name
         filters.append(f'name:eq:"{obligation_name}"')
     if customer_name:
         filters.append(f'customerName:eq:"{customer_name}"')
+    if contract_name:
+        filters.append(f'contractName:eq:"{contract_name}"')
+    if created_from:
+        filters.append(f'createdAt:gte:"{created_from}"')
+
+    def build_endpoint(page, limit):
+        endpoint = f"/v3/obligations?limit={limit}"
+        if page > 1:
+            endpoint += f"&page={page}"
+        if filters:
+            endpoint += f"&filter={'+'.join(filters)}"
+        return endpoint
+
+    yield from iter_records(build_endpoint, limit=limit, task=task, get_all=get_all)
+    
+def get_contract_obligations(contract_id=None, customer_id=None, obligation_name=None, customer_name=None, task=None, get_all=False, limit=500):
+    """
+    Get obligations (billing terms) with flexible filtering options.
+    
+    Args:
+        contract_id (str, optional): Filter by contract ID
+        customer_id (str, optional): Filter by customer ID
+        obligation_name (str, optional): Filter by obligation name
+        customer_name (str, optional): Filter by customer name
         
-    if filters:
-        endpoint += f"&filter={'+'.join(filters)}"
-        
-    response = make_get_request(endpoint=endpoint, task=task)
-    results = check_success(response)
-    if results is None:
-        return []
-    else:
-        if get_all:
-            all_obligations = results.get("payload", {}).get("data", [])
-            total_items = results.get("payload", {}).get("totalItems", 0)
-            for page in range(2, math.ceil(total_items / limit) + 1):
-                endpoint = f"/v3/obligations?limit={limit}&page={page}&filter={'+'.join(filters)}"
-                response = make_get_request(endpoint=endpoint, task=task)
-                results = check_success(response)
-                if results is None:
-                    break
-                fetched_objects = results.get("payload", {}).get("data", [])
-                all_obligations.extend(fetched_objects)
-            return all_obligations
-        else:
-            return results.get("payload", {}).get("data", [])
+    Returns:
+        list: List of obligations if request successful, empty list otherwise
+    """
+    return list(iter_contract_obligations(contract_id, customer_id, obligation_name, customer_name, task=task, get_all=get_all, limit=limit))
 
 def get_revenue_categories(name=None,get_all=False, task=None):
     endpoint = "/v3/categories"
@@ -499,11 +561,10 @@ def create_revenue_category(name, task=None):
 def bulk_upload_billing_schedule(files,merchant_name, task=None):
     endpoint = f"/v16/secrets/merchant/{merchant_name}/bulk-create-billing-schedules"
     response = make_post_request(endpoint=endpoint, files=files, task=task)
-    results = dict(response.json())
-    if response.status_code == 201:
-        return results.get("billingTermIds", [])
-    else:
-        return []
+    # Raises instead of returning no ids, a failed upload has to be retried and not taken for an empty one
+    if response.status_code != 201:
+        raise Exception(f"Bulk billing schedule upload returned {response.status_code}: {response.text[:500]}")
+    return dict(response.json()).get("billingTermIds", [])
     
 def update_billing_terms(files, merchant_name, task=None):
     endpoint = f"v16/secrets/merchant/{merchant_name}/bulk-update-billing-schedules"
@@ -778,37 +839,39 @@ def delete_obligation(contract_id, obligation_id, task=None):
     else:
         return True
 
-def get_invoices(task=None, get_all=False):
-    endpoint = "/v3/invoices"
-    response = make_get_request(endpoint=endpoint, task=task)
-    print_logger(response.json())
-    results = check_success(response)
-    if results is None:
-        print_logger("No results found")
-        return []
-    else:
-        print_logger("Results found")
-        if get_all:
-            print_logger("Getting all invoices")
-            all_invoices = results.get("payload", {}).get("data", [])
-            total_items = results.get("payload", {}).get("totalItems", 0)
-            print_logger("total_items", total_items)
-            for page in range(2, math.ceil(total_items / 50000) + 1):
-                endpoint = f"/v3/invoices?limit=50000&page={page}"
-                response = make_get_request(endpoint=endpoint, task=task)
-                results = check_success(response)
-                if results is None:
-                    print_logger("No more results found")
-                    break
-                fetched_objects = results.get("payload", {}).get("data", [])
-                print_logger(fetched_objects)
-                all_invoices.extend(fetched_objects)
-            print_logger("All invoices found")
-            print_logger(all_invoices)
-            return all_invoices
-        else:
-            print_logger("Returning results")
-            return results.get("payload", {}).get("data", [])
+def iter_invoices(task=None, get_all=True, contract_id=None, customer_id=None, issue_date_from=None, issue_date_to=None, limit=None):
+    """
+    Stream invoices page by page, later pages use the page size the backend used for page 1 so no rows are skipped.
+    Optional filters narrow the listing to one contract, one customer or an issue date range (YYYY-MM-DD, inclusive).
+    """
+    filters = []
+    if contract_id:
+        filters.append(f'contractId:eq:"{contract_id}"')
+    if customer_id:
+        filters.append(f'customerId:eq:"{customer_id}"')
+    if issue_date_from:
+        filters.append(f'issueDate:gte:"{issue_date_from}"')
+    if issue_date_to:
+        filters.append(f'issueDate:lte:"{issue_date_to}"')
+
+    def build_endpoint(page, limit):
+        params = []
+        if limit is not None:
+            params.append(f"limit={limit}")
+            params.append(f"page={page}")
+        if filters:
+            params.append(f"filter={'+'.join(filters)}")
+        if not params:
+            return "/v3/invoices"
+        return f"/v3/invoices?{'&'.join(params)}"
+
+    yield from iter_records(build_endpoint, limit=limit, task=task, get_all=get_all)
+
+def get_invoices(task=None, get_all=False, contract_id=None, customer_id=None, issue_date_from=None, issue_date_to=None, limit=None):
+    all_invoices = list(iter_invoices(task=task, get_all=get_all, contract_id=contract_id, customer_id=customer_id,
+                                      issue_date_from=issue_date_from, issue_date_to=issue_date_to, limit=limit))
+    print_logger(f"Invoices found: {len(all_invoices)}")
+    return all_invoices
 
 def set_customer_external_id(customer_id, type, external_id, task=None):
     url = f"/v3/customers/{customer_id}/external-ids"
@@ -1,11 +1,16 @@
 import streamlit as st
 from datetime import datetime
 import hashlib
-import requests
 import math
 from helper.logger import print_logger
-import time
+from helper.http_sessions import get_session
+from helper.rate_limiter import acquire_request_slot
+from helper.retry import send_with_retries, rewind_files, RETRY_LATER_AFTER_SECONDS, OVERLOAD_STATUSES
 from helper.data_helpers import soql_response_to_flat
+from helper.parallel import ordered_parallel_map
+from helper.request_log import build_request_record
+from helper.metrics import record_request, normalize_endpoint
+from helper.cancellation import check_cancelled
 
 def get_generate_hash(hash_string):
     return hashlib.sha256(f"{hash_string}".encode()).hexdigest()
@@ -36,66 +41,87 @@ class Filters:
             params["filter"] = self.filter
         return params
     
+class ParsedResponse:
+    """
+    Decodes a response body once and exposes the parts of the Tabs envelope the SDK reads:
+    success, payload, data, totalItems and limit.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = getattr(response, "status_code", None)
+        try:
+            body = response.json() if response is not None else {}
+        except ValueError:
+            body = {}
+        self.body = body if isinstance(body, dict) else {}
+        self.success = bool(self.body.get("success", False))
+        payload = self.body.get("payload", {})
+        self.payload = payload if payload is not None else {}
+        if isinstance(self.payload, dict):
+            data = self.payload.get("data", None)
+            self.data = self.payload if data is None else data
+            self.total_items = self.payload.get("totalItems", 0)
+            self.limit = self.payload.get("limit", 0)
+        else:
+            self.data = self.payload
+            self.total_items = 0
+            self.limit = 0
+
+    @property
+    def ok(self):
+        return self.status_code is not None and 200 <= self.status_code < 300
+
+
 class TabsRequest:
 
+    def parse_response(self, response):
+        if isinstance(response, ParsedResponse):
+            return response
+        return ParsedResponse(response)
+
     def get_total_items(self, response):
-        results = dict(response.json())
-        payload = results.get("payload", {})
-        total_items = payload.get("totalItems", 0)
-        return total_items
+        return self.parse_response(response).total_items
 
     def get_limit(self, response):
-        results = dict(response.json())
-        payload = results.get("payload", {})
-        limit = payload.get("limit", 0)
-        return limit
+        return self.parse_response(response).limit
 
     def get_data(self, response):
-        results = dict(response.json())
-        payload = results.get("payload", {})
-        if type(payload) == list:
-            return payload
-        data = payload.get("data", None)
-        if data is None:
-            return payload
-        else:
-            return data
+        return self.parse_response(response).data
 
     def check_success(self, response, use_status_code=False):
-        results = dict(response.json())
-        success = results.get("success", False)
+        parsed = self.parse_response(response)
         if use_status_code:
-            status_code = response.status_code
-            if status_code >= 200 and status_code < 300:
-                return results
-            else:
-                return None
+            success = parsed.ok
         else:
-            if success:
-                return results
-            else:
-                return None
+            success = parsed.success
+        if success:
+            return parsed.body
+        else:
+            return None
 
     def handle_request_log(self, request_log, using_session_state, task):
         if using_session_state:
             st.session_state.request_history.append(request_log)
         else:
-            task.request_logs.append(request_log)
+            task.log_request(request_log)
         return request_log
 
-    def generate_request_log(self, method, backend_url, endpoint, payload, response, batch_id):
-        timestamp = self.get_timestamp()
-        request_hash = self.get_hash(precise=True)
-        return {
-            "method": method,
-            "backend_url": backend_url,
-            "endpoint": endpoint,
-            "payload": payload,
-            "response": response,
-            "timestamp": timestamp,
-            "hash": request_hash,
-            "batch_id": batch_id,
-        }
+    def generate_request_log(self, method, backend_url, endpoint, payload, response, batch_id, attempt=0, retry_decision=None, retry_delay=None, retry_reason=None, latency=None, error=None):
+        return build_request_record(
+            method=method,
+            backend_url=backend_url,
+            endpoint=endpoint,
+            payload=payload,
+            response=response,
+            batch_id=batch_id,
+            attempt=attempt,
+            retry_decision=retry_decision,
+            retry_delay=retry_delay,
+            retry_reason=retry_reason,
+            latency=latency,
+            error=error,
+        )
 
     def configure_request_attributes(self, task=None):
         if task is None:
@@ -126,18 +152,18 @@ class TabsRequest:
     def generate_headers(self, api_key):
         return {"Authorization": f"{api_key}"}
 
-    def get_method(self, method):
+    def get_method(self, method, session):
         match method:
             case "GET":
-                return requests.get
+                return session.get
             case "POST":
-                return requests.post
+                return session.post
             case "PUT":
-                return requests.put
+                return session.put
             case "DELETE":
-                return requests.delete
+                return session.delete
             case "PATCH":
-                return requests.patch
+                return session.patch
             case _:
                 return None
     
@@ -151,9 +177,7 @@ class TabsRequest:
         except:
             return False
 
-    def make_request(self, endpoint, method, payload=None, files=None, params=None, task=None, attempts=0):
-        if attempts > 30:
-            raise ValueError("Max attempts reached (30), request failed")
+    def make_request(self, endpoint, method, payload=None, files=None, params=None, task=None):
         backend_url, api_key, using_session_state, batch_id = self.configure_request_attributes(task)
 
         if backend_url is None or api_key is None:
@@ -161,78 +185,115 @@ class TabsRequest:
         
         final_url = self.construct_url(backend_url, endpoint)
         headers = self.generate_headers(api_key)
-        request_method = self.get_method(method)
-        print_logger(f"Making {method} request to {final_url}")
-        response = request_method(
-            url=final_url, 
-            json=payload, 
-            headers=headers, 
-            files=files, 
-            params=params)
-        print_logger(f"Response for {method} request to {final_url} is {response.status_code}")
-        request_log = self.generate_request_log(
-            method=method, 
-            backend_url=backend_url, 
-            endpoint=endpoint, 
-            payload=payload, 
-            response=response, 
-            batch_id=batch_id)
-        self.handle_request_log(
-            request_log=request_log, 
-            using_session_state=using_session_state, 
-            task=task)
-        if self.is_rate_limited(response):
-            print_logger("Rate limited response received, backing off for 1 second and retrying")
-            attempts += 1
-            print_logger("Attempting to make request again in", attempts, "seconds")
-            time.sleep(attempts) # Linear backoff
-            return self.make_request(endpoint=endpoint, method=method, payload=payload, files=files, params=params, task=task, attempts=attempts)
-        else:
-            return response
+        session = get_session(backend_url, api_key)
+        request_method = self.get_method(method, session)
+
+        def send(timeout):
+            rewind_files(files)
+            print_logger(f"Making {method} request to {final_url}")
+            return request_method(
+                url=final_url, 
+                json=payload, 
+                headers=headers, 
+                files=files, 
+                params=params,
+                timeout=timeout)
+
+        def log_attempt(response, error, attempt, decision, delay, reason, latency):
+            status = response.status_code if response is not None else type(error).__name__
+            print_logger(f"Response for {method} request to {final_url} is {status}")
+            request_log = self.generate_request_log(
+                method=method, 
+                backend_url=backend_url, 
+                endpoint=endpoint, 
+                payload=payload, 
+                response=response, 
+                batch_id=batch_id,
+                attempt=attempt,
+                retry_decision=decision,
+                retry_delay=delay,
+                retry_reason=reason,
+                latency=latency,
+                error=error)
+            self.handle_request_log(
+                request_log=request_log, 
+                using_session_state=using_session_state, 
+                task=task)
+            if response is not None and task is not None and task.queue is not None:
+                task.queue.record_response(self.is_rate_limited(response), latency, normalize_endpoint(method, endpoint), response.status_code in OVERLOAD_STATUSES)
+
+        def before_attempt():
+            # A cancelled task stops here instead of sending (or retrying) the request
+            check_cancelled(task)
+            return acquire_request_slot(backend_url, api_key)
+
+        def log_completion(response, error, wall_time, wait_time, retries):
+            failed = error is not None or response is None or response.status_code >= 400
+            record_request(task, method, endpoint, wall_time, wait_time, retries, failed)
+
+        return send_with_retries(
+            send, 
+            method, 
+            on_attempt=log_attempt, 
+            before_attempt=before_attempt,
+            on_complete=log_completion,
+            # Queued tasks hand long backoffs back to the scheduler instead of holding the worker
+            defer_after=RETRY_LATER_AFTER_SECONDS if task is not None and task.queue is not None else None)
         
-    def get_wrapper(self, endpoint, params=None, task=None, get_all=False):
-        return_data = []
+    def iter_pages(self, endpoint, params=None, task=None, get_all=True):
+        """
+        Yields the data of every page as it arrives, only a handful of pages are held in memory at once.
+        Page 1 gives the page count, the remaining pages are fetched concurrently but yielded in page order.
+        """
         if params is None:
             params = {}
         
-        response = self.make_request(endpoint=endpoint, method="GET", params=params, task=task)
-        success = self.check_success(response)
-        if not success:
-            return return_data
-        elif success and not get_all:
-            return_data = self.get_data(response)
-            return return_data
-        elif success:
-            return_data = self.get_data(response)
-            total_items = self.get_total_items(response)
-            limit = self.get_limit(response)
-            pages = math.ceil(total_items / limit)
-            for page in range(2, pages + 1):
-                print_logger("\n\n************************************************")
-                print_logger(f"**Getting data from page {page}")
-                print_logger(f"Current return data length: {len(return_data)}")
-                print_logger(f"Current return data: {return_data}")
-                params["page"] = page
-                params["limit"] = limit
-                response = self.make_request(endpoint=endpoint, method="GET", params=params, task=task)
-                print_logger(f"Found {len(self.get_data(response))} items on page {page}")
-                success = self.check_success(response)
-                if not success:
-                    return return_data
-                elif success:
-                    print_logger(f"Found data on page {page} : {self.get_data(response)}")
-                    return_data.extend(self.get_data(response))
-                    print_logger(f"Return data after extension: {return_data}")
-                print_logger("************************************************")
-                
-
-            return return_data
+        parsed = self.parse_response(self.make_request(endpoint=endpoint, method="GET", params=params, task=task))
+        if not parsed.success:
+            return
+        yield parsed.data
+        if not get_all:
+            return
 
-        
-def get_events(event_type_id=None, customer_id=None, differentiator=None, before_date=None, after_date=None, get_all=False, task=None, limit=1000):
-    endpoint = "/v3/events"
+        total_items = parsed.total_items
+        limit = parsed.limit
+        if not limit:
+            return
+        pages = math.ceil(total_items / limit)
+        print_logger(f"Found {total_items} items on {endpoint}, fetching {pages - 1} more page(s) of {limit}")
 
-    tabs_request = TabsRequest()
+        def fetch_page(page):
+            page_params = dict(params)
+            page_params["page"] = page
+            page_params["limit"] = limit
+            page_parsed = self.parse_response(self.make_request(endpoint=endpoint, method="GET", params=page_params, task=task))
+            if not page_parsed.success:
+                return None
+            return page_parsed.data
+
+        # Stop at the first page that failed like the sequential loop did
+        for page, page_data in enumerate(ordered_parallel_map(fetch_page, range(2, pages + 1)), start=2):
+            if page_data is None:
+                print_logger(f"Failed to get page {page} of {endpoint}")
+                return
+            yield page_data
+
+    def iter_records(self, endpoint, params=None, task=None, get_all=True):
+        for page_data in self.iter_pages(endpoint=endpoint, params=params, task=task, get_all=get_all):
+            yield from page_data
+
+    def get_wrapper(self, endpoint, params=None, task=None, get_all=False):
+        pages = self.iter_pages(endpoint=endpoint, params=params, task=task, get_all=get_all)
+        if not get_all:
+            # Single page endpoints can return an object instead of a list, hand it back untouched
+            return next(pages, [])
+        return_data = []
+        for page_data in pages:
+            return_data.extend(page_data)
+        return return_data
+
+        
+def events_params(event_type_id=None, customer_id=None, differentiator=None, before_date=None, after_date=None, limit=1000):
     filters = Filters()
     if event_type_id:
         filters.add_filter(filter_col="eventTypeId", filter_rule="eq", filter_value=event_type_id)
@@ -246,11 +307,16 @@ def get_events(event_type_id=None, customer_id=None, differentiator=None, before
         filters.add_filter(filter_col="datetime", filter_rule="gte", filter_value=after_date)
 
     params = {"limit": limit}
-    params = filters.format_params(params)
+    return filters.format_params(params)
 
-    data = tabs_request.get_wrapper(endpoint=endpoint, params=params, task=task, get_all=get_all)
+def iter_events(event_type_id=None, customer_id=None, differentiator=None, before_date=None, after_date=None, get_all=True, task=None, limit=1000):
+    endpoint = "/v3/events"
+    params = events_params(event_type_id, customer_id, differentiator, before_date, after_date, limit)
+    tabs_request = TabsRequest()
+    yield from tabs_request.iter_records(endpoint=endpoint, params=params, task=task, get_all=get_all)
 
-    return data
+def get_events(event_type_id=None, customer_id=None, differentiator=None, before_date=None, after_date=None, get_all=False, task=None, limit=1000):
+    return list(iter_events(event_type_id, customer_id, differentiator, before_date, after_date, get_all=get_all, task=task, limit=limit))
 
 def get_event_types(limit=500, task=None, get_all=False):
     endpoint = "/v3/events/types"
@@ -259,9 +325,7 @@ def get_event_types(limit=500, task=None, get_all=False):
     data = tabs_request.get_wrapper(endpoint=endpoint, params=params, task=task, get_all=get_all)
     return data
         
-def get_customers(limit=500, name=None, external_id=None, has_external_id=None, task=None, get_all=False):
-    endpoint = "/v3/customers"
-    tabs_request = TabsRequest()
+def customers_params(limit=500, name=None, external_id=None, has_external_id=None):
     filters = Filters()
     if name:
         filters.add_filter(filter_col="name", filter_rule="eq", filter_value=name)
@@ -273,9 +337,16 @@ def get_customers(limit=500, name=None, external_id=None, has_external_id=None,
         else:
             filters.add_filter(filter_col="externalId", filter_rule="isnull", filter_value="")
     params = {"limit": limit}
-    params = filters.format_params(params)
-    data = tabs_request.get_wrapper(endpoint=endpoint, params=params, task=task, get_all=get_all)
-    return data
+    return filters.format_params(params)
+
+def iter_customers(limit=500, name=None, external_id=None, has_external_id=None, task=None, get_all=True):
+    endpoint = "/v3/customers"
+    params = customers_params(limit, name, external_id, has_external_id)
+    tabs_request = TabsRequest()
+    yield from tabs_request.iter_records(endpoint=endpoint, params=params, task=task, get_all=get_all)
+
+def get_customers(limit=500, name=None, external_id=None, has_external_id=None, task=None, get_all=False):
+    return list(iter_customers(limit, name, external_id, has_external_id, task=task, get_all=get_all))
    
 def get_custom_fields(task=None, get_all=False):
     url = "/v3/custom-fields"
@@ -289,7 +360,7 @@ def get_classes(task=None, get_all=False):
     data = tabs_request.get_wrapper(endpoint=url, task=task, get_all=False)
     return data
 
-def get_obligations(customer_id=None, task=None, get_all=False):
+def iter_obligations(customer_id=None, task=None, get_all=True):
     endpoint = "/v3/obligations"
     tabs_request = TabsRequest()
     filters = Filters()
@@ -297,8 +368,10 @@ def get_obligations(customer_id=None, task=None, get_all=False):
         filters.add_filter(filter_col="customerId", filter_rule="eq", filter_value=customer_id)
     params = {"limit": 500}
     params = filters.format_params(params)
-    data = tabs_request.get_wrapper(endpoint=endpoint, params=params, task=task, get_all=get_all)
-    return data
+    yield from tabs_request.iter_records(endpoint=endpoint, params=params, task=task, get_all=get_all)
+
+def get_obligations(customer_id=None, task=None, get_all=False):
+    return list(iter_obligations(customer_id=customer_id, task=task, get_all=get_all))
 
 def query_salesforce_data(merchant_id, soql_query, task=None):
     url = f"/v16/secrets/salesforce/query"
@@ -307,9 +380,9 @@ def query_salesforce_data(merchant_id, soql_query, task=None):
     payload["manufacturerId"] = merchant_id
     payload["useAuthenticatedConnection"] = True
     tabs_request = TabsRequest()
-    response = tabs_request.make_request(endpoint=url, method="POST", payload=payload, task=task)
-    status_code = response.status_code
-    results = tabs_request.check_success(response, use_status_code=True)
+    parsed = tabs_request.parse_response(tabs_request.make_request(endpoint=url, method="POST", payload=payload, task=task))
+    status_code = parsed.status_code
+    results = tabs_request.check_success(parsed, use_status_code=True)
 
     if results is None:
         st.toast(f"Error querying Salesforce data, code: {status_code}", icon=":material/error:")
@@ -1,6 +1,6 @@
 import pandas as pd
 import streamlit as st
-from api.tabs_sdk import get_obligations
+from api.tabs_sdk import iter_obligations
 
 VALID_INTERVALS = ["NONE", "DAY", "MONTH", "YEAR", "QUARTER", "SEMI_MONTH"]
 
@@ -211,6 +211,59 @@ def create_obligation_payload(row):
         payload["discount"] = discount_payload
     return payload
 
+# (billingType, pricingType) -> (billing_type, is_volume), built from convert_billing_type so the two cannot drift apart.
+# is_volume=False comes last so the SIMPLE types, which ignore it, map back to False
+BILLING_TYPES_BY_SCHEDULE = {
+    (converted["billingType"], converted["pricingType"]): (billing_type, is_volume)
+    for billing_type in ("FLAT_PRICE", "UNIT_PRICE", "TIER_FLAT_PRICE", "TIER_UNIT_PRICE")
+    for is_volume in (True, False)
+    for converted in [convert_billing_type(billing_type, is_volume)]
+}
+
+def billing_term_payload_to_bulk_row(payload, contract_id):
+    # Inverse of create_obligation_payload, one row of the bulk billing schedule file:
+    # create_obligation_payload(billing_term_payload_to_bulk_row(payload, contract_id)) == payload
+    billing_schedule = payload["billingSchedule"]
+    billing_type_key = (billing_schedule.get("billingType"), billing_schedule.get("pricingType"))
+    if billing_type_key not in BILLING_TYPES_BY_SCHEDULE:
+        raise Exception(f"Invalid billing type: {billing_type_key[0]} | {billing_type_key[1]}")
+    billing_type, is_volume = BILLING_TYPES_BY_SCHEDULE[billing_type_key]
+    row = {
+        "contract_id": contract_id,
+        "revenue_start_date": payload.get("serviceStartDate"),
+        "revenue_end_date": payload.get("serviceEndDate"),
+        "revenue_product_id": payload.get("categoryId"),
+        "name": billing_schedule.get("name"),
+        "note": billing_schedule.get("description"),
+        "invoice_date": billing_schedule.get("startDate"),
+        "duration": billing_schedule.get("duration"),
+        "is_recurring": billing_schedule.get("isRecurring"),
+        "due_interval_unit": billing_schedule.get("interval"),
+        "due_interval": billing_schedule.get("intervalFrequency"),
+        "net_payment_terms": billing_schedule.get("netPaymentTerms"),
+        "quantity": billing_schedule.get("quantity"),
+        "billing_type": billing_type,
+        "is_volume": is_volume,
+        "event_to_track": billing_schedule.get("eventTypeId"),
+        "integration_item_id": billing_schedule.get("itemId"),
+        "invoice_type": billing_schedule.get("invoiceType"),
+        "classId": billing_schedule.get("classId"),
+    }
+    # is_arrears wins over invoiceDateStrategy in make_billing_schedule_payload, only one of them goes in the row
+    if "isArrears" in billing_schedule:
+        row["is_arrears"] = billing_schedule["isArrears"]
+    else:
+        row["invoiceDateStrategy"] = billing_schedule.get("invoiceDateStrategy")
+    for tier in billing_schedule.get("pricing", []):
+        row[f"amount_{tier['tier']}"] = tier.get("amount")
+        row[f"value_{tier['tier']}"] = tier.get("tierMinimum")
+    discount = payload.get("discount")
+    if discount:
+        row["discount_type"] = discount.get("type")
+        row["discount_amount"] = discount.get("amount")
+        row["discount_note"] = discount.get("note", "")
+    return row
+
 def find_name_for_revenue_category(revenue_category_id):
     for revenue_category in st.session_state.revenue_categories:
         if revenue_category["id"] == revenue_category_id:
@@ -269,12 +322,9 @@ def find_net_terms_for_customer(customer_id, mode="MODE"):
     if mode not in ["MODE", "MIN", "MAX"]:
         raise ValueError("Mode must be one of: MODE, MIN, MAX")
 
-    data = get_obligations(customer_id=customer_id)
-    if len(data) == 0:
-        return 30
-    
+    # Stream the obligations, only the net terms are kept
     net_terms = []
-    for obligation in data:
+    for obligation in iter_obligations(customer_id=customer_id, get_all=False):
         net_term_i = obligation.get("billingSchedule",{}).get("netPaymentTerms", None)
         if net_term_i:
             net_terms.append(int(net_term_i))
@@ -321,4 +371,153 @@ def generate_template_billing_term():
             },
 
         }
-    return payload
\ No newline at end of file
+    return payload
+
+
+def bulk_billing_schedule_file(rows, file_name="billing_schedules.csv"):
+    # Multipart files argument for bulk_upload_billing_schedule, rows from billing_term_payload_to_bulk_row
+    csv_bytes = pd.DataFrame(rows).to_csv(index=False).encode("utf-8")
+    return {"file": (file_name, csv_bytes, "text/csv")}
+
+def billing_term_signature(billing_term):
+    # What tells one row's obligation apart from another row's of the same customer and contract name: service period,
+    # product name, quantity and first tier amount. Takes a billing term payload or an obligation record
+    billing_schedule = billing_term.get("billingSchedule") or {}
+    pricing = sorted(billing_schedule.get("pricing") or [{}], key=lambda tier: tier.get("tier") or 0)
+
+    def number(value):
+        try:
+            return round(float(value), 6)
+        except (TypeError, ValueError):
+            return None
+
+    return (
+        str(billing_term.get("serviceStartDate") or "")[:10],
+        str(billing_term.get("serviceEndDate") or "")[:10],
+        billing_schedule.get("name"),
+        number(billing_schedule.get("quantity")),
+        number(pricing[0].get("amount")),
+    )
+
+def match_contracts_to_groups(contracts, contract_obligations, group_signatures):
+    # Matches one customer's existing contracts (same name, not deleted) to the batch's task groups of that customer.
+    # contract_obligations: contract id -> its obligations, group_signatures: per group the billing_term_signature of
+    # each row. A contract belongs to a group when every obligation it has is one of the group's rows, a contract with
+    # no obligation yet can go to any group without a match. Returns per group ("new", None), ("reuse", contract),
+    # ("processed", contract) or ("review", reason) when more than one contract or group could be meant
+    candidates = []
+    for signatures in group_signatures:
+        wanted = set(signatures)
+        candidates.append([
+            contract for contract in contracts
+            if contract_obligations.get(contract["id"])
+            and all(billing_term_signature(obligation) in wanted for obligation in contract_obligations[contract["id"]])
+        ])
+    claims = {}
+    for group_candidates in candidates:
+        for contract in group_candidates:
+            claims[contract["id"]] = claims.get(contract["id"], 0) + 1
+    empty_contracts = [
+        contract for contract in sorted(contracts, key=lambda contract: contract.get("createdAt") or "")
+        if not contract_obligations.get(contract["id"]) and contract.get("status") != "PROCESSED"
+    ]
+
+    outcomes = []
+    for group_candidates in candidates:
+        if len(group_candidates) > 1:
+            outcomes.append(("review", f"{len(group_candidates)} existing contracts have obligations matching this row"))
+        elif group_candidates and claims[group_candidates[0]["id"]] > 1:
+            outcomes.append(("review", f"Existing contract {group_candidates[0]['id']} matches {claims[group_candidates[0]['id']]} rows"))
+        elif group_candidates:
+            contract = group_candidates[0]
+            outcomes.append(("processed" if contract.get("status") == "PROCESSED" else "reuse", contract))
+        elif empty_contracts:
+            outcomes.append(("reuse", empty_contracts.pop(0)))
+        else:
+            outcomes.append(("new", None))
+    return outcomes
+
+def match_obligations_to_rows(billing_term_payloads, obligations):
+    # Pairs the obligations already on a reused contract with the rows they were created for. billing_term_payloads:
+    # row key -> billing term payload. Rows are matched by billing_term_signature, identical rows take the oldest
+    # obligation first. A row without a matching obligation is still to be created, it never takes another row's.
+    # Returns row key -> obligation id for the matched rows
+    ids_by_signature = {}
+    for obligation in sorted(obligations, key=lambda obligation: obligation.get("createdAt") or ""):
+        ids_by_signature.setdefault(billing_term_signature(obligation), []).append(obligation["id"])
+    matched = {}
+    for row_key, billing_term_payload in billing_term_payloads.items():
+        obligation_ids = ids_by_signature.get(billing_term_signature(billing_term_payload))
+        if obligation_ids:
+            matched[row_key] = obligation_ids.pop(0)
+    return matched
+
+def invoice_summary(invoice, match="confirmed"):
+    # Amount field naming differs between invoice payload versions. match is "confirmed" for an invoice of the row's
+    # own contract and "ambiguous" for one only picked by customer and issue date
+    amount = invoice.get("total", invoice.get("amount"))
+    return {"id": invoice.get("id"), "amount": amount, "status": invoice.get("status"), "match": match}
+
+def match_invoices_to_rows(invoices, contract_ids, customer_ids, issue_date=None):
+    # Joins invoices fetched in one listing to the rows of a batch. A row with a contract id (created, reused or
+    # skipped as processed) only takes that contract's invoice, rows grouped into one contract share it. Only rows
+    # without a contract id fall back to the customer's invoices issued on issue_date, those matches are "ambiguous"
+    # and handed out in order so two contracts for the same customer get two invoices.
+    # Returns one invoice_summary (or None) per row
+    known_contracts = {contract_id for contract_id in contract_ids if contract_id}
+    by_contract = {}
+    by_customer = {}
+    for invoice in sorted(invoices, key=lambda invoice: invoice.get("createdAt") or ""):
+        by_contract.setdefault(invoice.get("contractId"), []).append(invoice)
+        if invoice.get("contractId") in known_contracts:
+            continue
+        invoice_date = str(invoice.get("issueDate") or "")[:10]
+        if issue_date is None or invoice_date == issue_date:
+            by_customer.setdefault(invoice.get("customerId"), []).append(invoice)
+
+    matches = []
+    for contract_id, customer_id in zip(contract_ids, customer_ids):
+        if contract_id:
+            invoices_of_contract = by_contract.get(contract_id)
+            matches.append(invoice_summary(invoices_of_contract[0]) if invoices_of_contract else None)
+            continue
+        candidates = by_customer.get(customer_id) or []
+        # The last candidate is shared, rows of one customer without a contract id may all belong to one contract
+        invoice = candidates.pop(0) if len(candidates) > 1 else (candidates[0] if candidates else None)
+        matches.append(invoice_summary(invoice, match="ambiguous") if invoice is not None else None)
+    return matches
+
+def clean_numbers(values):
+    """Currency strings ("$1,234.50") to floats for a whole column, values that are not numbers become NaN"""
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float)
+    values = values.astype("string").str.replace(r"[$,\s]", "", regex=True)
+    return pd.to_numeric(values, errors="coerce").astype(float)
+
+def validate_invoice_rows(df, matched_customers):
+    """
+    Pre-flight checks over the whole upload before any request is sent, column at a time so 100k rows take milliseconds.
+    A row fails when its customer is missing or unmapped (blank customer id or no net terms), or its amount or quantity is missing,
+    not a number or not positive. Returns the error message of every failing row by row position, the rows not in it
+    are the ones to submit.
+    """
+    customer_names = df["Rep Invoicing Tabs Customer Name"]
+    mapped_names = [
+        customer_name for customer_name, details in matched_customers.items()
+        if non_blank_or_nan(details.get("customer_id")) and details.get("net_terms") is not None
+    ]
+    missing_customer = customer_names.isna() | (customer_names.astype("string").str.strip() == "")
+    checks = {
+        "Customer name is missing": missing_customer,
+        "Customer is not mapped to a Tabs customer": ~missing_customer & ~customer_names.isin(mapped_names),
+    }
+    for column, label in (("Rep Invoicing Invoice Value", "Amount"), ("Rep Invoicing Invoice Quantity", "Quantity")):
+        numbers = clean_numbers(df[column])
+        checks[f"{label} is missing or not a number"] = numbers.isna()
+        checks[f"{label} must be greater than zero"] = numbers <= 0
+
+    errors = pd.Series("", index=range(len(df)), dtype=object)
+    for message, mask in checks.items():
+        errors = errors + pd.Series(mask.to_numpy(dtype=bool)).map({True: f"{message}; ", False: ""})
+    errors = errors[errors != ""].str[:-2]
+    return dict(zip(errors.index.tolist(), errors.tolist()))
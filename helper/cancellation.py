@@ -0,0 +1,50 @@
+import threading
+import time
+from typing import Optional
+
+
+class TaskCancelled(Exception):
+    """Raised at the next check point (between chain steps or request attempts) once a task is cancelled"""
+
+
+class TaskDeadlineExceeded(TaskCancelled):
+    """Raised at the next check point once a task has run longer than its deadline"""
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation for one task. cancel() can be called from any thread, the task itself
+    calls raise_if_cancelled() between steps so it stops without leaving a request half sent.
+    An optional deadline (monotonic clock) cancels the task once it has passed.
+    """
+    __slots__ = ("_event", "reason", "deadline")
+
+    def __init__(self, deadline: Optional[float] = None):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+        self.deadline = deadline
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise TaskCancelled(self.reason)
+        if self.expired:
+            raise TaskDeadlineExceeded("task deadline exceeded")
+
+
+def check_cancelled(task):
+    """No-op for requests made outside the queue"""
+    if task is not None and task.cancel_token is not None:
+        task.cancel_token.raise_if_cancelled()
@@ -0,0 +1,64 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from helper.logger import print_logger
+
+# Pool size used until a TaskQueue tells us how many workers it runs
+DEFAULT_POOL_SIZE = int(os.getenv("DEFAULT_THREADS", 8))
+
+
+class SessionManager:
+    """
+    Keeps one keep-alive requests.Session per (backend_url, api_key) so every request
+    of every invoice chain reuses pooled TCP/TLS connections instead of doing a fresh handshake.
+    Sessions are shared by the TaskQueue worker threads, the connection pool is sized to the worker count.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE):
+        self._lock = threading.Lock()
+        self._sessions = {}  # (backend_url, api_key) -> (requests.Session, pool_size)
+        self.pool_size = max(1, pool_size)
+
+    def _build_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_session(self, backend_url, api_key):
+        key = (backend_url, api_key)
+        session_entry = self._sessions.get(key)
+        if session_entry is not None:
+            return session_entry[0]
+        with self._lock:
+            # Double check, another worker may have created it while we waited
+            session_entry = self._sessions.get(key)
+            if session_entry is None:
+                print_logger(f"Creating pooled HTTP session for {backend_url} with pool size {self.pool_size}")
+                session_entry = (self._build_session(self.pool_size), self.pool_size)
+                self._sessions[key] = session_entry
+            return session_entry[0]
+
+    def ensure_pool_size(self, backend_url, api_key, pool_size):
+        """Make sure the session for this backend/key can hold `pool_size` concurrent connections."""
+        pool_size = max(1, int(pool_size))
+        key = (backend_url, api_key)
+        with self._lock:
+            self.pool_size = max(self.pool_size, pool_size)
+            session_entry = self._sessions.get(key)
+            if session_entry is not None and session_entry[1] >= pool_size:
+                return session_entry[0]
+            print_logger(f"Sizing pooled HTTP session for {backend_url} to {pool_size} connections")
+            # The old session is not closed, workers may still have requests in flight on it
+            session = self._build_session(pool_size)
+            self._sessions[key] = (session, pool_size)
+        return session
+
+
+session_manager = SessionManager()
+
+
+def get_session(backend_url, api_key):
+    return session_manager.get_session(backend_url, api_key)
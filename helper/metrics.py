@@ -0,0 +1,170 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+# Samples kept per endpoint/step for the percentiles, and how many batches are remembered
+METRICS_SAMPLE_CAPACITY = int(os.getenv("METRICS_SAMPLE_CAPACITY", 10000))
+METRICS_BATCH_CAPACITY = int(os.getenv("METRICS_BATCH_CAPACITY", 20))
+# Same batch id the request helpers use for requests made outside of a task
+ONE_OFF_BATCH_ID = "One Off Request"
+
+_ID_SEGMENT = re.compile(r"^\d+$|^(?=.*\d)[0-9a-fA-F-]{8,}$")
+
+
+def normalize_endpoint(method, endpoint):
+    """'GET /v3/contracts/5f1c.../obligations?limit=1' -> 'GET /v3/contracts/{id}/obligations'"""
+    path = endpoint.split("?", 1)[0]
+    segments = ["{id}" if _ID_SEGMENT.match(segment) else segment for segment in path.split("/")]
+    return f"{method} {'/'.join(segments)}"
+
+
+def percentile(sorted_values, q):
+    """Nearest rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class LatencySeries:
+    """Timings of one endpoint or step, the last METRICS_SAMPLE_CAPACITY samples feed the percentiles."""
+    __slots__ = ("count", "failures", "retries", "total_wait", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.samples = deque(maxlen=METRICS_SAMPLE_CAPACITY)
+
+    def add(self, wall_time, wait_time=0.0, retries=0, failed=False):
+        self.count += 1
+        self.failures += int(failed)
+        self.retries += retries
+        self.total_wait += wait_time
+        self.samples.append(wall_time)
+
+    def summary(self):
+        values = sorted(self.samples)
+        return {
+            "count": self.count,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else None,
+            "avg_wait": self.total_wait / self.count if self.count else None,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+
+class BatchMetrics:
+    """
+    Timings for one batch, grouped by kind:
+    - "request": every HTTP call (all attempts), keyed by normalized endpoint, wait is the rate limiter wait
+    - "step": every chain step (create_contract, create_obligation, ...)
+    - "task": every TaskQueue task, wait is the time spent queued
+    """
+
+    def __init__(self, batch_id):
+        self._lock = threading.Lock()
+        self.batch_id = batch_id
+        self.series = {}  # (kind, name) -> LatencySeries
+        self.first_started_at = None
+        self.last_finished_at = None
+        self.rows_done = 0
+        self.rows_failed = 0
+
+    def record(self, kind, name, wall_time, wait_time=0.0, retries=0, failed=False):
+        with self._lock:
+            series = self.series.get((kind, name))
+            if series is None:
+                series = self.series[(kind, name)] = LatencySeries()
+            series.add(wall_time, wait_time, retries, failed)
+
+    def task_started(self):
+        with self._lock:
+            if self.first_started_at is None:
+                self.first_started_at = time.monotonic()
+
+    def task_finished(self, wall_time, queue_wait, retries, failed):
+        self.record("task", "task", wall_time, queue_wait, retries, failed)
+        with self._lock:
+            self.last_finished_at = time.monotonic()
+            self.rows_done += 1
+            self.rows_failed += int(failed)
+
+    def throughput(self):
+        """Rows per second from the first task start to the last task finish."""
+        if self.first_started_at is None or self.last_finished_at is None:
+            return None
+        elapsed = self.last_finished_at - self.first_started_at
+        return self.rows_done / elapsed if elapsed > 0 else None
+
+    def summary(self):
+        with self._lock:
+            series = list(self.series.items())
+        return [{"kind": kind, "name": name, **values.summary()} for (kind, name), values in sorted(series)]
+
+    def report(self):
+        """summary() with the batch id and totals on every row, exported so runs can be compared afterwards."""
+        throughput = self.throughput()
+        totals = {"batch_id": self.batch_id, "rows_done": self.rows_done, "rows_failed": self.rows_failed, "rows_per_second": throughput}
+        return [{**totals, **row} for row in self.summary()]
+
+
+class MetricsRegistry:
+    """Process wide BatchMetrics by batch id, only the most recent METRICS_BATCH_CAPACITY batches are kept."""
+
+    def __init__(self, capacity=METRICS_BATCH_CAPACITY):
+        self._lock = threading.Lock()
+        self._batches = OrderedDict()
+        self.capacity = max(1, capacity)
+
+    def get(self, batch_id):
+        batch_id = batch_id or ONE_OFF_BATCH_ID
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                batch = self._batches[batch_id] = BatchMetrics(batch_id)
+                while len(self._batches) > self.capacity:
+                    self._batches.popitem(last=False)
+            return batch
+
+    def batch_ids(self):
+        with self._lock:
+            return list(self._batches)
+
+
+metrics = MetricsRegistry()
+
+
+def record_request(task, method, endpoint, wall_time, wait_time, retries, failed):
+    """Called once per HTTP call by the request helpers, after every retry has been made."""
+    batch_id = task.batch_id if task is not None else ONE_OFF_BATCH_ID
+    metrics.get(batch_id).record("request", normalize_endpoint(method, endpoint), wall_time, wait_time, retries, failed)
+    if task is not None:
+        task.retries += retries
+
+
+@contextmanager
+def timed_step(task, step):
+    """Times a chain step, it is recorded on the batch and on the task so it ends up in the results export."""
+    started_at = time.monotonic()
+    retries_before = task.retries if task is not None else 0
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        wall_time = time.monotonic() - started_at
+        retries = task.retries - retries_before if task is not None else 0
+        batch_id = task.batch_id if task is not None else ONE_OFF_BATCH_ID
+        metrics.get(batch_id).record("step", step, wall_time, retries=retries, failed=failed)
+        if task is not None:
+            if task.timings is None:
+                task.timings = {}
+            task.timings[f"{step}_seconds"] = round(wall_time, 3)
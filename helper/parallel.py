@@ -0,0 +1,36 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# How many list pages are fetched at the same time, the shared rate limiter still applies to every request
+PAGE_FETCH_CONCURRENCY = int(os.getenv("PAGE_FETCH_CONCURRENCY", 4))
+
+
+def ordered_parallel_map(function, items, max_workers=PAGE_FETCH_CONCURRENCY):
+    """
+    Lazily yields function(item) for every item, in the order of `items`.
+    At most `max_workers` calls are in flight, so memory stays bounded and a consumer that
+    stops early (e.g. on a failed page) cancels everything that has not started yet.
+    The Streamlit script context is passed to the pool threads so they can use st.session_state.
+    """
+    max_workers = max(1, int(max_workers))
+    script_run_ctx = get_script_run_ctx()
+
+    def run(item):
+        if script_run_ctx is not None:
+            add_script_run_ctx(threading.current_thread(), script_run_ctx)
+        return function(item)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="PageFetcher")
+    in_flight = deque()
+    try:
+        for item in items:
+            in_flight.append(executor.submit(run, item))
+            if len(in_flight) >= max_workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+from helper.logger import print_logger
+
+# Requests per second allowed against one backend with one API key, shared by every thread in the process
+DEFAULT_REQUESTS_PER_SECOND = float(os.getenv("DEFAULT_REQUESTS_PER_SECOND", 10))
+DEFAULT_REQUESTS_BURST = int(os.getenv("DEFAULT_REQUESTS_BURST", 10))
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket. Tokens refill at `rate` per second up to `burst`.
+    acquire() reserves a token and only sleeps when the bucket is empty, so callers
+    are spaced out exactly as much as the configured rate requires and no more.
+    """
+
+    def __init__(self, rate=DEFAULT_REQUESTS_PER_SECOND, burst=DEFAULT_REQUESTS_BURST):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+
+    def configure(self, rate, burst=None):
+        with self._lock:
+            self.rate = max(float(rate), 0.001)
+            self.burst = max(int(burst if burst is not None else self.rate), 1)
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def reserve(self):
+        """Reserve a token and return how many seconds the caller has to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait_time = self.reserve()
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+
+class RateLimiterRegistry:
+    """Process wide registry of token buckets keyed by (backend_url, api_key)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._limits = {}  # (backend_url, api_key) -> (rate, burst) configured before the bucket exists
+
+    def get_bucket(self, backend_url, api_key):
+        key = (backend_url, api_key)
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            return bucket
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                rate, burst = self._limits.get(key, (DEFAULT_REQUESTS_PER_SECOND, DEFAULT_REQUESTS_BURST))
+                bucket = TokenBucket(rate=rate, burst=burst)
+                self._buckets[key] = bucket
+            return bucket
+
+    def configure(self, backend_url, api_key, rate, burst=None):
+        key = (backend_url, api_key)
+        print_logger(f"Rate limit for {backend_url} set to {rate} requests/sec")
+        with self._lock:
+            self._limits[key] = (rate, burst)
+            bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.configure(rate, burst)
+
+
+rate_limiters = RateLimiterRegistry()
+
+
+def acquire_request_slot(backend_url, api_key):
+    """Block until the shared limiter for this backend/key allows another request, returns the time waited."""
+    return rate_limiters.get_bucket(backend_url, api_key).acquire()
+
+
+def configure_rate_limit(backend_url, api_key, rate, burst=None):
+    rate_limiters.configure(backend_url, api_key, rate, burst)
@@ -0,0 +1,158 @@
+import os
+import threading
+import itertools
+from collections import deque
+from datetime import datetime
+
+# Retention, the session history is shared by every batch, task logs only need the last few attempts
+REQUEST_HISTORY_CAPACITY = int(os.getenv("REQUEST_HISTORY_CAPACITY", 5000))
+TASK_REQUEST_LOG_CAPACITY = int(os.getenv("TASK_REQUEST_LOG_CAPACITY", 50))
+# Full bodies are only kept for failed requests unless asked for
+KEEP_RESPONSE_BODIES = os.getenv("KEEP_RESPONSE_BODIES", "False").lower() == "true"
+BODY_DIGEST_LENGTH = 200
+
+# Process wide monotonic request IDs, next() on itertools.count is atomic so worker threads never collide
+_request_ids = itertools.count(1)
+
+
+def next_request_id():
+    return next(_request_ids)
+
+
+class RequestRecord:
+    """
+    Compact record of one HTTP attempt. The live Response object is never kept,
+    only its status, size, latency and a truncated digest of the body.
+    The request payload and full response body are kept for failures (or when KEEP_RESPONSE_BODIES is set).
+    """
+    __slots__ = (
+        "request_id", "timestamp", "method", "backend_url", "endpoint", "batch_id",
+        "status_code", "latency", "bytes", "attempt", "retry_decision", "retry_delay",
+        "retry_reason", "error", "body_digest", "body", "payload",
+    )
+
+    def __init__(self, method, backend_url, endpoint, batch_id, status_code=None, latency=None, bytes=0,
+                 attempt=0, retry_decision=None, retry_delay=None, retry_reason=None, error=None, body_digest=None, body=None, payload=None):
+        self.request_id = next_request_id()
+        self.timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.method = method
+        self.backend_url = backend_url
+        self.endpoint = endpoint
+        self.batch_id = batch_id
+        self.status_code = status_code
+        self.latency = latency
+        self.bytes = bytes
+        self.attempt = attempt
+        self.retry_decision = retry_decision
+        self.retry_delay = retry_delay
+        self.retry_reason = retry_reason
+        self.error = error
+        self.body_digest = body_digest
+        self.body = body
+        self.payload = payload
+
+    @property
+    def failed(self):
+        return self.status_code is None or self.status_code >= 400
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+def build_request_record(method, backend_url, endpoint, payload, response, batch_id, attempt=0, retry_decision=None, retry_delay=None, retry_reason=None, latency=None, error=None, keep_body=KEEP_RESPONSE_BODIES):
+    status_code = getattr(response, "status_code", None)
+    content = b""
+    if response is not None:
+        try:
+            content = response.content or b""
+        except Exception:
+            content = b""
+    record = RequestRecord(
+        method=method,
+        backend_url=backend_url,
+        endpoint=endpoint,
+        batch_id=batch_id,
+        status_code=status_code,
+        latency=latency,
+        bytes=len(content),
+        attempt=attempt,
+        retry_decision=retry_decision,
+        retry_delay=retry_delay,
+        retry_reason=retry_reason,
+        error=str(error) if error is not None else None,
+        # Only the head of the body is decoded, large successful pages are never turned into text
+        body_digest=content[:BODY_DIGEST_LENGTH].decode("utf-8", errors="replace"),
+    )
+    if keep_body or record.failed:
+        record.body = content.decode("utf-8", errors="replace")
+        record.payload = payload
+    return record
+
+
+class RequestLogStore:
+    """
+    Thread safe ring buffer of RequestRecords, the oldest records are dropped once `capacity` is reached.
+    `appended` counts every record ever added so readers can keep a cursor and only read what is new.
+    With `indexed=True` the store also keeps a request_id index for O(1) membership checks.
+    """
+
+    def __init__(self, capacity=REQUEST_HISTORY_CAPACITY, indexed=False):
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=max(1, int(capacity)))
+        self._index = {} if indexed else None
+        self.appended = 0
+
+    @property
+    def capacity(self):
+        return self._records.maxlen
+
+    def append(self, record):
+        with self._lock:
+            if self._index is not None:
+                if record.request_id in self._index:
+                    return False
+                if len(self._records) == self._records.maxlen:
+                    self._index.pop(self._records[0].request_id, None)
+                self._index[record.request_id] = record
+            self._records.append(record)
+            self.appended += 1
+            return True
+
+    def since(self, cursor):
+        """Records appended after `cursor` (that are still retained) and the new cursor."""
+        with self._lock:
+            new_count = min(self.appended - cursor, len(self._records))
+            if new_count <= 0:
+                return [], self.appended
+            records = list(itertools.islice(reversed(self._records), new_count))
+            records.reverse()
+            return records, self.appended
+
+    def get_record(self, request_id):
+        if self._index is None:
+            raise ValueError("Store is not indexed")
+        return self._index.get(request_id)
+
+    def __contains__(self, request_id):
+        if self._index is None:
+            return any(record.request_id == request_id for record in self.snapshot())
+        return request_id in self._index
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            if self._index is not None:
+                self._index.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._records)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self._records)
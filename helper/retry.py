@@ -0,0 +1,270 @@
+import os
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from helper.logger import print_logger
+
+# Decisions taken after each attempt, they are recorded on the request log
+RETURN = "return"
+RETRY = "retry"
+GIVE_UP = "give_up"
+DEFER = "defer"
+
+# Inside a TaskQueue task, backoffs longer than this are not slept in the worker, the task is rescheduled instead
+RETRY_LATER_AFTER_SECONDS = float(os.getenv("RETRY_LATER_AFTER_SECONDS", 2))
+# Runs of a failed TaskQueue task (first run included) when its batch has no retry policy of its own
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", 1))
+
+# Floor for the per attempt timeout, an attempt started right at the deadline still gets this long
+MIN_ATTEMPT_TIMEOUT_SECONDS = 0.1
+
+IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")
+# Server errors of an overloaded backend, the adaptive concurrency limit backs off on them like on a 429
+OVERLOAD_STATUSES = (502, 503, 504)
+RETRY_AFTER_HEADERS = ("Retry-After", "RateLimit-Reset", "X-RateLimit-Reset", "X-Rate-Limit-Reset")
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Capped exponential backoff with full jitter.
+    - 429 is always retried, honoring Retry-After / rate limit reset headers when present
+    - 5xx and connection errors are only retried for idempotent methods unless retry_unsafe_methods is set,
+      a POST that timed out may already have created the contract
+    - the whole request (all attempts and sleeps) gives up after `deadline` seconds
+    - every attempt times out after `attempt_timeout` seconds, or what is left of the deadline when that is less
+    """
+    max_attempts: int = int(os.getenv("REQUEST_MAX_ATTEMPTS", 10))
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    deadline: float = float(os.getenv("REQUEST_DEADLINE_SECONDS", 120))
+    attempt_timeout: float = float(os.getenv("REQUEST_TIMEOUT_SECONDS", 30))
+    retry_statuses: tuple = (500, 502, 503, 504)
+    retry_unsafe_methods: bool = False
+    retry_exceptions: tuple = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+    def backoff(self, attempt):
+        """Full jitter: a random delay between 0 and the capped exponential ceiling."""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def can_retry_method(self, method):
+        return self.retry_unsafe_methods or method in IDEMPOTENT_METHODS
+
+    def timeout_for(self, elapsed):
+        """Timeout of the next attempt, elapsed seconds into the request. Never below MIN_ATTEMPT_TIMEOUT_SECONDS"""
+        return max(min(self.attempt_timeout, self.deadline - elapsed), MIN_ATTEMPT_TIMEOUT_SECONDS)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class RetryLater(Exception):
+    """Raised by send_with_retries instead of a long sleep, the TaskQueue runs the task again after `delay` seconds"""
+
+    def __init__(self, delay, reason=""):
+        super().__init__(f"Retry in {delay:.2f} seconds: {reason}")
+        self.delay = delay
+        self.reason = reason
+
+
+class RateLimitExhausted(ValueError):
+    """Raised by send_with_retries when a rate limited request runs out of attempts"""
+
+
+class UnconfirmedWrite(Exception):
+    """
+    Raised by send_with_retries (from the connection error or timeout) when a POST or PATCH got no response and is not
+    retried, the backend may have applied it. TaskRetryPolicy does not run such a task again, it could create twice.
+    """
+
+
+@dataclass
+class TaskRetryPolicy:
+    """
+    Retries of a whole TaskQueue task, on top of the request retries above. A failed task runs again
+    from its checkpoint after a capped, jittered backoff.
+    - max_attempts counts the first run, 1 turns task retries off
+    - only errors in retry_on (or raised while handling one) are retried unless retry_all_errors is set
+    - never a task whose create request may have gone through (UnconfirmedWrite), a rerun would create it twice
+    - a chain that returns None has no error to look at, it is only retried with retry_all_errors
+    """
+    max_attempts: int = TASK_MAX_ATTEMPTS
+    base_delay: float = 2.0
+    max_delay: float = 60.0
+    retry_on: tuple = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, RateLimitExhausted)
+    retry_all_errors: bool = False
+
+    def backoff(self, attempt):
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def is_retryable(self, error):
+        # Chain steps wrap request errors in their own message, the original is on the exception chain
+        chain = []
+        seen = set()
+        while error is not None and id(error) not in seen:
+            chain.append(error)
+            seen.add(id(error))
+            error = error.__cause__ or error.__context__
+        for error in chain:
+            if isinstance(error, UnconfirmedWrite):
+                return False
+            if isinstance(error, self.retry_on):
+                return True
+        return self.retry_all_errors
+
+    def should_retry(self, attempt, error):
+        """attempt is how many retries the task already had"""
+        return attempt + 1 < self.max_attempts and self.is_retryable(error)
+
+
+DEFAULT_TASK_RETRY_POLICY = TaskRetryPolicy()
+
+
+def get_retry_after(response):
+    """
+    Seconds the server asked us to wait, or None.
+    Supports delta seconds, HTTP dates and epoch timestamps (used by some rate limit reset headers).
+    """
+    if response is None:
+        return None
+    headers = getattr(response, "headers", None) or {}
+    for header in RETRY_AFTER_HEADERS:
+        value = headers.get(header)
+        if value is None or str(value).strip() == "":
+            continue
+        value = str(value).strip()
+        try:
+            seconds = float(value)
+            if seconds > 10 ** 9:
+                # Epoch timestamp
+                seconds = seconds - time.time()
+            return max(seconds, 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def is_rate_limited(response):
+    return response is not None and getattr(response, "status_code", None) == 429
+
+
+def is_unconfirmed_write(policy, method, error):
+    """A write that was sent but got no response, a connect timeout means it never reached the backend"""
+    return (
+        isinstance(error, policy.retry_exceptions)
+        and not isinstance(error, requests.exceptions.ConnectTimeout)
+        and not policy.can_retry_method(method)
+    )
+
+
+def decide(policy, method, response, error, attempt, elapsed):
+    """Return (decision, delay_in_seconds, reason) for the attempt that just finished."""
+    if error is not None:
+        if not isinstance(error, policy.retry_exceptions) or not policy.can_retry_method(method):
+            return GIVE_UP, 0.0, f"{type(error).__name__} is not retryable for {method}"
+        reason = f"{type(error).__name__}"
+        delay = policy.backoff(attempt)
+    elif is_rate_limited(response):
+        reason = "rate limited (429)"
+        retry_after = get_retry_after(response)
+        delay = retry_after if retry_after is not None else policy.backoff(attempt)
+        if retry_after is not None:
+            reason += f", server asked for {retry_after:.2f}s"
+    elif response.status_code in policy.retry_statuses:
+        if not policy.can_retry_method(method):
+            return RETURN, 0.0, f"{response.status_code} is not retried for {method}"
+        reason = f"server error ({response.status_code})"
+        delay = policy.backoff(attempt)
+    else:
+        return RETURN, 0.0, "ok"
+
+    if attempt + 1 >= policy.max_attempts:
+        return GIVE_UP, 0.0, f"{reason}, max attempts ({policy.max_attempts}) reached"
+    if elapsed + delay > policy.deadline:
+        return GIVE_UP, 0.0, f"{reason}, request deadline ({policy.deadline}s) reached"
+    return RETRY, delay, reason
+
+
+def rewind_files(files):
+    """Multipart uploads are file objects, they have to be rewound before they can be sent again."""
+    if not files:
+        return
+    values = files.values() if isinstance(files, dict) else files
+    for value in values:
+        file_object = value[1] if isinstance(value, (tuple, list)) and len(value) > 1 else value
+        if hasattr(file_object, "seek"):
+            file_object.seek(0)
+
+
+def send_with_retries(send, method, policy=None, on_attempt=None, before_attempt=None, on_complete=None, defer_after=None):
+    """
+    Call `send(timeout)` until it returns a response that should not be retried, `timeout` is the per attempt
+    timeout (seconds) from policy.timeout_for and has to be passed on to the HTTP call.
+    `before_attempt()` runs ahead of every attempt (rate limiting), its wait is not counted as request latency.
+    `on_attempt(response, error, attempt, decision, delay, reason, latency)` is called after every attempt so callers can log it.
+    `on_complete(response, error, wall_time, wait_time, retries)` is called once at the end, wait_time is
+    the sum of what before_attempt() returned.
+    With `defer_after` set, a backoff longer than that many seconds raises RetryLater instead of sleeping.
+    Raises the last connection error, or RateLimitExhausted when a rate limited request runs out of attempts.
+    """
+    if policy is None:
+        policy = DEFAULT_RETRY_POLICY
+    started_at = time.monotonic()
+    attempt = 0
+    wait_time = 0.0
+    response = None
+    error = None
+    try:
+        while True:
+            response = None
+            error = None
+            if before_attempt is not None:
+                wait_time += before_attempt() or 0.0
+            attempt_started_at = time.monotonic()
+            try:
+                response = send(policy.timeout_for(time.monotonic() - started_at))
+            except Exception as e:
+                error = e
+            latency = time.monotonic() - attempt_started_at
+            elapsed = time.monotonic() - started_at
+            decision, delay, reason = decide(policy, method, response, error, attempt, elapsed)
+            if decision == RETRY and defer_after is not None and delay > defer_after:
+                decision = DEFER
+            if on_attempt is not None:
+                on_attempt(response, error, attempt, decision, delay, reason, latency)
+
+            if decision == DEFER:
+                print_logger(f"Deferring {method} request for {delay:.2f} seconds (attempt {attempt + 1}/{policy.max_attempts}): {reason}")
+                error = RetryLater(delay, reason)
+                raise error
+            if decision == RETRY:
+                print_logger(f"Retrying {method} request in {delay:.2f} seconds (attempt {attempt + 1}/{policy.max_attempts}): {reason}")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if decision == GIVE_UP:
+                print_logger(f"Giving up on {method} request after {attempt + 1} attempt(s): {reason}")
+            if error is not None and is_unconfirmed_write(policy, method, error):
+                raise UnconfirmedWrite(f"{method} request got no response ({type(error).__name__}), it may have been applied") from error
+            if error is not None:
+                raise error
+            if decision == GIVE_UP and is_rate_limited(response):
+                error = RateLimitExhausted(f"Max attempts reached ({attempt + 1}), request failed: {reason}")
+                raise error
+            return response
+    finally:
+        if on_complete is not None:
+            on_complete(response, error, time.monotonic() - started_at, wait_time, attempt)
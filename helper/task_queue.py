@@ -1,191 +1,1128 @@
+import os
+import heapq
+import itertools
+import math
 import threading
-import queue
 import time
+import uuid
+from collections import deque
 from dataclasses import dataclass, field
-from typing import Callable, Dict, Any, Optional, List
+from typing import Callable, Dict, Any, Iterable, Optional, List, Tuple
 from helper.logger import print_logger
+from helper.http_sessions import session_manager
+from helper.rate_limiter import configure_rate_limit
+from helper.request_log import RequestLogStore, TASK_REQUEST_LOG_CAPACITY
+from helper.metrics import metrics
+from helper.task_store import TaskStore, get_task_store, resolve_function, function_path, batch_owner, FINAL_STATUSES, TASK_LEASE_SECONDS
+from helper.retry import RetryLater, TaskRetryPolicy, DEFAULT_TASK_RETRY_POLICY
+from helper.cancellation import CancellationToken, TaskCancelled, TaskDeadlineExceeded, check_cancelled
 
-@dataclass
+TASK_STATUSES = ("pending", "running", "completed", "failed", "cancelled")
+# Stage used by tasks that run their function in one go
+DEFAULT_STAGE = "task"
+# How many times a task may hand a long backoff back to the scheduler before it fails
+TASK_MAX_DEFERRALS = int(os.getenv("TASK_MAX_DEFERRALS", 20))
+# Share of the workers allowed to run when a queue starts, the adaptive limit backs off from there on 429s or slow responses
+CONCURRENCY_INITIAL_FRACTION = float(os.getenv("CONCURRENCY_INITIAL_FRACTION", 1.0))
+# add_tasks rows are written to the task store in the background, this many per transaction
+TASK_STORE_WRITE_CHUNK = 5000
+
+
+def new_status_counts() -> Dict[str, int]:
+    return dict.fromkeys(("total",) + TASK_STATUSES, 0)
+
+
+def count_done(counts: Dict[str, int]) -> int:
+    return sum(counts[status] for status in FINAL_STATUSES)
+
+
+@dataclass(frozen=True)
+class PipelineStage:
+    """
+    One step of a pipelined task. `function(**task.args)` runs with the task's args and keeps
+    its progress in task.checkpoint, the last stage returns the task result.
+    """
+    name: str
+    function: Callable
+    concurrency: Optional[int] = None  # Stage executions at once, defaults to the number of workers
+    capacity: Optional[int] = None  # Rows allowed to wait for this stage before the stage before it stops, defaults to 2 x workers
+
+
+class StageState:
+    """Ready rows and counters of one stage, guarded by the TaskQueue lock"""
+    __slots__ = ("name", "position", "stage", "concurrency", "capacity", "next_stage", "ready", "in_flight", "done")
+
+    def __init__(self, name: str, position: int, stage: PipelineStage, num_workers: int, next_stage: Optional[str] = None):
+        self.name = name
+        self.position = position
+        self.stage = stage
+        self.next_stage = next_stage
+        self.ready = deque()
+        self.in_flight = 0
+        self.done = 0
+        self.size_for(num_workers)
+
+    def size_for(self, num_workers: int):
+        """Limits the stage did not set follow the worker pool"""
+        self.concurrency = self.stage.concurrency or num_workers
+        self.capacity = self.stage.capacity or 2 * num_workers
+
+@dataclass(slots=True)
 class Task:
+    # Slotted, a batch can hold 100k of these. args is None for tasks added with add_tasks until they run,
+    # they are built from `source` by the batch's args factory and dropped again once the task is finished.
+    # timings and checkpoint stay None until the task first writes to them
     function: Callable
-    args: Dict[str, Any]
+    args: Optional[Dict[str, Any]]
     batch_id: str
     result: Any = None
-    status: str = "pending"  # pending, running, completed, failed
+    status: str = "pending"  # pending, running, completed, failed, cancelled
     error: Optional[str] = None
-    request_logs: Any = field(default_factory=list)
+    # Created by the first request the task makes
+    request_logs: Optional[RequestLogStore] = None
     api_key: Optional[str] = None
     backend_url: Optional[str] = None
     throttle_time: Optional[int] = None
+    queue: Optional["TaskQueue"] = field(default=None, repr=False)
+    # Timing, monotonic clock. timings holds the per row numbers exported with the results
+    enqueued_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    retries: int = 0
+    timings: Optional[Dict[str, float]] = None
+    # Completed chain steps (e.g. contract_id, obligation_id), a rerun of the task continues after them
+    checkpoint: Optional[Dict[str, Any]] = None
+    task_id: Optional[str] = None
+    # Pipelined tasks run one stage at a time, other rows can use the worker in between
+    stages: Optional[Tuple[PipelineStage, ...]] = None
+    stage_index: int = 0
+    ready_at: Optional[float] = None
+    deferrals: int = 0
+    # Retries of the whole task under its batch TaskRetryPolicy
+    attempts: int = 0
+    # Cancellation, checked between chain steps and request attempts. timeout (seconds) starts when the task starts
+    cancel_token: Optional[CancellationToken] = None
+    timeout: Optional[float] = None
+    executing: bool = False
+    source: Any = None
+
+    def log_request(self, record):
+        if self.request_logs is None:
+            self.request_logs = RequestLogStore(capacity=TASK_REQUEST_LOG_CAPACITY)
+        self.request_logs.append(record)
+
+
+def stages_to_settings(stages: Optional[Tuple[PipelineStage, ...]]) -> Optional[List[Dict[str, Any]]]:
+    if stages is None:
+        return None
+    return [
+        {"name": stage.name, "function": function_path(stage.function), "concurrency": stage.concurrency, "capacity": stage.capacity}
+        for stage in stages
+    ]
+
+
+def stages_from_settings(values: Optional[List[Dict[str, Any]]]) -> Optional[Tuple[PipelineStage, ...]]:
+    if not values:
+        return None
+    return tuple(
+        PipelineStage(name=value["name"], function=resolve_function(value["function"]), concurrency=value.get("concurrency"), capacity=value.get("capacity"))
+        for value in values
+    )
+
+
+def retry_policy_to_settings(policy: TaskRetryPolicy) -> Dict[str, Any]:
+    return {
+        "max_attempts": policy.max_attempts,
+        "base_delay": policy.base_delay,
+        "max_delay": policy.max_delay,
+        "retry_on": [function_path(error_type) for error_type in policy.retry_on],
+        "retry_all_errors": policy.retry_all_errors,
+    }
+
+
+def retry_policy_from_settings(values: Dict[str, Any]) -> TaskRetryPolicy:
+    return TaskRetryPolicy(
+        max_attempts=values["max_attempts"],
+        base_delay=values["base_delay"],
+        max_delay=values["max_delay"],
+        retry_on=tuple(resolve_function(path) for path in values["retry_on"]),
+        retry_all_errors=values["retry_all_errors"])
+
+
+def save_checkpoint(task: Optional[Task], **values):
+    """Record completed chain steps on the task (and in the task store), no-op for requests made outside the queue"""
+    if task is None:
+        return
+    if task.checkpoint is None:
+        task.checkpoint = {}
+    task.checkpoint.update(values)
+    if task.queue is not None:
+        task.queue.persist_checkpoint(task)
+
+
+class AdaptiveConcurrencyController:
+    """
+    AIMD limit on how many tasks may run at once.
+    - Additive increase: +1 once a full window of healthy responses (one per slot) has been seen
+    - Multiplicative decrease: the limit is cut by `decrease_factor` on a 429, a 502/503/504 or when an endpoint's
+      latency rises above `latency_tolerance` x that endpoint's baseline, at most once per `cooldown` seconds
+    The worker threads are the ceiling, the controller decides how many of them do work. It starts at the
+    ceiling (CONCURRENCY_INITIAL_FRACTION of it) unless initial_limit is given.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int = 1, initial_limit: Optional[int] = None, decrease_factor: float = 0.5, latency_tolerance: float = 2.0, cooldown: float = 2.0):
+        self._condition = threading.Condition()
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        if initial_limit is None:
+            initial_limit = math.ceil(self.max_limit * CONCURRENCY_INITIAL_FRACTION)
+        self.limit = max(self.min_limit, min(initial_limit, self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.healthy_responses = 0
+        # endpoint -> [latency ewma, baseline], a slow bulk upload is not compared with fast GETs
+        self.latencies: Dict[str, List[float]] = {}
+        self.last_decrease = 0.0
+        self.history = deque(maxlen=500)  # (timestamp, limit, reason)
+        self.history.append((time.time(), self.limit, "start"))
+
+    def acquire(self, timeout: Optional[float] = None, cancelled: Optional[Callable[[], bool]] = None) -> bool:
+        """
+        Wait for a free slot, returns False if none was free before the timeout or `cancelled()` became true.
+        Whoever makes `cancelled()` true has to call wake_all() so waiting workers see it.
+        """
+        is_cancelled = cancelled if cancelled is not None else (lambda: False)
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < self.limit or is_cancelled(), timeout=timeout):
+                return False
+            if is_cancelled():
+                return False
+            self.in_flight += 1
+            return True
+
+    def wake_all(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def set_max_limit(self, max_limit: int):
+        """
+        Follow a resized worker pool. The limit keeps its share of the ceiling, a limit at the old ceiling moves to
+        the new one so added workers start running straight away, and a limit cut by 429s stays cut by as much.
+        """
+        with self._condition:
+            previous_max_limit = self.max_limit
+            self.max_limit = max(1, max_limit)
+            self.min_limit = min(self.min_limit, self.max_limit)
+            new_limit = self.limit
+            if self.max_limit > previous_max_limit:
+                new_limit = math.ceil(self.limit * self.max_limit / previous_max_limit)
+            self._set_limit(new_limit, f"worker pool resized to {self.max_limit}")
+            self._condition.notify_all()
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def _set_limit(self, new_limit: int, reason: str):
+        new_limit = max(self.min_limit, min(new_limit, self.max_limit))
+        if new_limit != self.limit:
+            print_logger(f"Concurrency limit {self.limit} -> {new_limit} ({reason})")
+            self.limit = new_limit
+            self.history.append((time.time(), new_limit, reason))
+            self._condition.notify_all()
+        self.healthy_responses = 0
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self._set_limit(int(self.limit * self.decrease_factor), reason)
+
+    def record_response(self, rate_limited: bool, latency: Optional[float] = None, endpoint: Optional[str] = None, overloaded: bool = False):
+        """
+        endpoint is the normalized endpoint (metrics.normalize_endpoint) the latency belongs to, overloaded is set for
+        the server errors an overloaded backend answers with (retry.OVERLOAD_STATUSES)
+        """
+        with self._condition:
+            if rate_limited:
+                self._decrease("rate limited (429)")
+                return
+            if overloaded:
+                self._decrease("server overloaded (5xx)")
+                return
+            if latency is not None:
+                endpoint_latency = self.latencies.get(endpoint)
+                if endpoint_latency is None:
+                    endpoint_latency = self.latencies[endpoint] = [latency, latency]
+                else:
+                    endpoint_latency[0] = 0.8 * endpoint_latency[0] + 0.2 * latency
+                ewma, baseline = endpoint_latency
+                if ewma < baseline:
+                    endpoint_latency[1] = ewma
+                else:
+                    # Let the baseline drift up slowly so a permanently slower backend is not punished forever
+                    endpoint_latency[1] = baseline + (ewma - baseline) * 0.01
+                if ewma > endpoint_latency[1] * self.latency_tolerance:
+                    self._decrease(f"{endpoint or 'latency'} {ewma:.2f}s over baseline {endpoint_latency[1]:.2f}s")
+                    return
+            self.healthy_responses += 1
+            if self.healthy_responses >= self.limit:
+                self._set_limit(self.limit + 1, "healthy responses")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "latencies": {endpoint: tuple(values) for endpoint, values in self.latencies.items()},
+            "history": list(self.history),
+        }
+
 
 class TaskQueue:
-    def __init__(self, api_key: str, backend_url: str, num_workers: int = 10):
+    def __init__(self, api_key: str, backend_url: str, num_workers: int = 10, requests_per_second: Optional[float] = None, store: Optional[TaskStore] = None, retry_policy: Optional[TaskRetryPolicy] = None):
         print_logger(f"Initializing TaskQueue with {num_workers} workers")
-        self.queue = queue.Queue()
         self.tasks: Dict[str, Task] = {}  # task_id -> Task
         self.batches: Dict[str, list[str]] = {}  # batch_id -> list of task_ids
         self.processing = False
+        # Workers belong to a generation, starting again begins a new one. _stop_mode is "drain" or "abort" while stopping
+        self._generation = 0
+        self._stop_mode: Optional[str] = None
+        # Pool resizing: live workers of the current generation and how many of them still have to retire
+        self._active_workers = 0
+        self._workers_to_retire = 0
         self.num_workers = num_workers
         self.worker_threads: List[threading.Thread] = []
         self._lock = threading.Lock()
+        # Workers wait on this for ready work, it shares _lock with the counters and the stage queues
+        self._work_available = threading.Condition(self._lock)
+        # Ready rows per stage, workers take from the stage furthest down the pipeline first
+        self._stages: Dict[str, StageState] = {}
+        self._stage_order: List[StageState] = []
+        self._register_stages(None)
+        # Delayed work: heap of (not_before, seq, task_id) on the monotonic clock, moved to the ready queues once due
+        self._delayed: List[Tuple[float, int, str]] = []
+        self._delay_sequence = itertools.count()
+        # throttle_time paces the starts of a batch, batch_id -> earliest next start
+        self._batch_next_start: Dict[str, float] = {}
         self.tabs_api_token = api_key
         self.backend_url = backend_url
-        self.task_size = 0
-        self.completed_tasks = 0
-        self.failed_tasks = 0
-        self.pending_tasks = 0
+        # Status counters, updated on every transition under _lock. Readers take a copy without the lock
+        self._counts = new_status_counts()
+        self._batch_counts: Dict[str, Dict[str, int]] = {}
+        # Unfinished task ids per batch, so a batch can be cancelled without scanning every task
+        self._batch_unfinished: Dict[str, set] = {}
+        # Task retries per batch (register_batch), and the failed task ids of each batch in the order they failed
+        self.retry_policy = retry_policy or DEFAULT_TASK_RETRY_POLICY
+        self._retry_policies: Dict[str, TaskRetryPolicy] = {}
+        self._dead_letters: Dict[str, Dict[str, None]] = {}
+        # add_tasks: batch_id -> function building a task's args from its source row when the task runs
+        self._args_factories: Dict[str, Callable[[Any], Dict[str, Any]]] = {}
+        # Request log sync: tasks that ran since the last sync and how far each task's log has been read
+        self._unsynced_task_ids = set()
+        self._request_log_cursors: Dict[str, int] = {}
+        # Optional durable copy of every batch (TASK_STORE_PATH), the in memory queue is the working cache in front of it
+        self.store = store if store is not None else get_task_store()
+        # Stored batches belong to a backend and API key, the queue holds a lease on the ones it processes
+        self.owner = batch_owner(backend_url, api_key)
+        self.lease_holder = uuid.uuid4().hex
+        self._heartbeat_stopped: Optional[threading.Event] = None
+        # Stages, timeout and retry policy of each batch, saved with the batch so a resumed batch runs the same way
+        self._batch_settings: Dict[str, Dict[str, Any]] = {}
+        # Request records written to the store: position in each task's log, and where a resumed task's numbering starts
+        self._store_log_cursors: Dict[str, int] = {}
+        self._request_sequence_base: Dict[str, int] = {}
+        # Threads still writing add_tasks rows to the store, see flush_store
+        self._store_writers: List[threading.Thread] = []
+        # Every worker can hold its own keep-alive connection to the backend
+        session_manager.ensure_pool_size(backend_url, api_key, num_workers)
+        if requests_per_second:
+            configure_rate_limit(backend_url, api_key, requests_per_second)
+        # num_workers is the ceiling, the controller finds how many of them the backend can take
+        self.concurrency = AdaptiveConcurrencyController(max_limit=num_workers)
+
+    @property
+    def task_size(self) -> int:
+        return self._counts["total"]
+
+    @property
+    def completed_tasks(self) -> int:
+        return self._counts["completed"]
+
+    @property
+    def failed_tasks(self) -> int:
+        return self._counts["failed"]
+
+    @property
+    def pending_tasks(self) -> int:
+        return self._counts["pending"]
 
     def is_done(self):
-        return self.completed_tasks + self.failed_tasks == self.task_size
+        counts = self.progress()
+        return count_done(counts) == counts["total"]
+
+    def _set_status(self, task: Task, status: str):
+        """Move a task to a new status and keep the counters in step, the caller holds _lock"""
+        batch_counts = self._batch_counts[task.batch_id]
+        self._counts[task.status] -= 1
+        batch_counts[task.status] -= 1
+        task.status = status
+        self._counts[status] += 1
+        batch_counts[status] += 1
+        if status in FINAL_STATUSES:
+            self._batch_unfinished[task.batch_id].discard(task.task_id)
+        if status == "failed":
+            self._dead_letters.setdefault(task.batch_id, {})[task.task_id] = None
+        elif task.batch_id in self._dead_letters:
+            self._dead_letters[task.batch_id].pop(task.task_id, None)
         
-    def add_task(self, function: Callable, args: Dict[str, Any], batch_id: str, throttle_time: Optional[int] = None) -> str:
-        """Add a task to the queue and return its ID"""
+    def _register_stages(self, stages: Optional[Tuple[PipelineStage, ...]]):
+        """Create the stage queues of a pipeline the first time it is seen, the caller holds _lock (or is __init__)"""
+        if stages is None:
+            stages = (PipelineStage(DEFAULT_STAGE, None),)
+        for position, stage in enumerate(stages):
+            if stage.name in self._stages:
+                continue
+            next_stage = stages[position + 1].name if position + 1 < len(stages) else None
+            self._stages[stage.name] = StageState(
+                name=stage.name,
+                position=position,
+                stage=stage,
+                num_workers=self.num_workers,
+                next_stage=next_stage)
+        self._stage_order = sorted(self._stages.values(), key=lambda stage: stage.position, reverse=True)
+
+    def _current_stage(self, task: Task) -> StageState:
+        return self._stages[task.stages[task.stage_index].name if task.stages else DEFAULT_STAGE]
+
+    def _enqueue(self, task_id: str, task: Task):
+        """Make a task ready for its current stage and wake a worker, the caller holds _lock"""
+        task.ready_at = time.monotonic()
+        self._current_stage(task).ready.append(task_id)
+        self._work_available.notify()
+
+    def _schedule(self, task_id: str, not_before: float):
+        """Park a task until `not_before` (monotonic) without holding a worker, the caller holds _lock"""
+        heapq.heappush(self._delayed, (not_before, next(self._delay_sequence), task_id))
+        # A sleeping worker may be waiting on a later deadline
+        self._work_available.notify()
+
+    def _release_due(self, now: float):
+        """Move delayed tasks that are due to their stage's ready queue, the caller holds _lock"""
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, task_id = heapq.heappop(self._delayed)
+            task = self.tasks[task_id]
+            if task.status in ("pending", "running"):
+                task.ready_at = now
+                self._current_stage(task).ready.append(task_id)
+
+    def _wait_timeout(self, now: float) -> Optional[float]:
+        """How long an idle worker may sleep: until the next delayed task is due, or until notified"""
+        if self._delayed:
+            return max(0.0, self._delayed[0][0] - now)
+        return None
+
+    def _should_exit(self, generation: int) -> bool:
+        """Read without the lock by workers waiting for a concurrency slot, _wait_for_work checks again under it"""
+        if generation != self._generation or self._stop_mode == "abort":
+            return True
+        return self._stop_mode == "drain" and self._is_drained()
+
+    def _is_drained(self) -> bool:
+        return not self._delayed and all(not stage.ready and not stage.in_flight for stage in self._stage_order)
+
+    def _take_retirement(self) -> bool:
+        """Claim one pending retirement for the calling worker, the caller holds _lock"""
+        if self._workers_to_retire > 0:
+            self._workers_to_retire -= 1
+            return True
+        return False
+
+    def _wait_for_work(self, generation: int) -> Optional[Tuple[str, Task, StageState]]:
+        """Sleep until a row is ready (or a delayed one is due), None once this worker has to stop"""
+        with self._work_available:
+            while True:
+                if generation != self._generation or self._stop_mode == "abort":
+                    return None
+                if self._take_retirement():
+                    return None
+                work = self._claim_next()
+                if work is not None:
+                    return work
+                if self._stop_mode == "drain" and self._is_drained():
+                    # Last row is done, wake everyone else so they stop too
+                    self._work_available.notify_all()
+                    self.concurrency.wake_all()
+                    return None
+                self._work_available.wait(timeout=self._wait_timeout(time.monotonic()))
+
+    def queue_size(self) -> int:
+        """Rows waiting for a worker, over all stages"""
+        return sum(len(stage.ready) for stage in self._stage_order)
+
+    def delayed_size(self) -> int:
+        """Rows parked until a backoff or throttle_time has passed"""
+        return len(self._delayed)
+
+    def _add_batch(self, batch_id: str):
+        """Counters and lookups of a batch seen for the first time, the caller holds _lock"""
+        if batch_id not in self.batches:
+            self.batches[batch_id] = []
+            self._batch_counts[batch_id] = new_status_counts()
+            self._batch_unfinished[batch_id] = set()
+
+    def add_task(self, function: Callable, args: Dict[str, Any], batch_id: str, throttle_time: Optional[int] = None, stages: Optional[Tuple[PipelineStage, ...]] = None, timeout: Optional[float] = None) -> str:
+        """
+        Add a task to the queue and return its ID.
+        With `stages` the task runs one stage at a time instead of calling `function`, `function` is
+        still what a resumed batch runs (it has to pick up from the checkpoint).
+        With `timeout` the task fails at its next check point once it has been running that many seconds.
+        """
         task_id = f"{batch_id}_{len(self.tasks)}"
-        task = Task(function=function, args=args, batch_id=batch_id, api_key=self.tabs_api_token, backend_url=self.backend_url, throttle_time=throttle_time)
+        task = Task(function=function, args=args, batch_id=batch_id, api_key=self.tabs_api_token, backend_url=self.backend_url, throttle_time=throttle_time, queue=self, enqueued_at=time.monotonic(), task_id=task_id, stages=stages, timeout=timeout)
+        print_logger(f"Adding task {task_id} to batch {batch_id}")
+        self._update_batch_settings(batch_id, stages=stages_to_settings(stages), timeout=timeout, throttle_time=throttle_time)
         
         with self._lock:
-            print_logger(f"Adding task {task_id} to batch {batch_id}")
             self.tasks[task_id] = task
-            if batch_id not in self.batches:
-                self.batches[batch_id] = []
+            self._add_batch(batch_id)
             self.batches[batch_id].append(task_id)
-            self.queue.put(task_id)
-            print_logger(f"Queue size after adding task: {self.queue.qsize()}")
+            position = len(self.batches[batch_id]) - 1
+            self._batch_unfinished[batch_id].add(task_id)
+            self._register_stages(stages)
+            self._enqueue(task_id, task)
 
-            self.task_size += 1
-            self.pending_tasks += 1
+            for counts in (self._counts, self._batch_counts[batch_id]):
+                counts["total"] += 1
+                counts["pending"] += 1
+        if self.store is not None:
+            self.store.save_tasks([(task_id, position, task, args)])
         
         return task_id
+
+    def add_tasks(self, function: Callable, sources: Iterable[Any], batch_id: str, build_args: Callable[[Any], Dict[str, Any]], throttle_time: Optional[int] = None, stages: Optional[Tuple[PipelineStage, ...]] = None, timeout: Optional[float] = None) -> List[str]:
+        """
+        Add one task per source row in one go and return their IDs, for large batches.
+        Only the source (e.g. a DataFrame index label) is kept, `build_args(source)` builds the args
+        when the task runs. It is called from the workers so it must not read st.session_state.
+        With a task store only the source is saved as well, a resumed batch gets its factory again from set_args_factory.
+        """
+        self._update_batch_settings(batch_id, stages=stages_to_settings(stages), timeout=timeout, throttle_time=throttle_time)
+        now = time.monotonic()
+        tasks = []
+        with self._work_available:
+            self._add_batch(batch_id)
+            self._args_factories[batch_id] = build_args
+            self._register_stages(stages)
+            stage = self._stages[stages[0].name if stages else DEFAULT_STAGE]
+            batch_task_ids = self.batches[batch_id]
+            unfinished = self._batch_unfinished[batch_id]
+            for source in sources:
+                task_id = f"{batch_id}_{len(self.tasks)}"
+                task = Task(function=function, args=None, batch_id=batch_id, api_key=self.tabs_api_token, backend_url=self.backend_url, throttle_time=throttle_time, queue=self, enqueued_at=now, task_id=task_id, stages=stages, timeout=timeout, ready_at=now, source=source)
+                self.tasks[task_id] = task
+                batch_task_ids.append(task_id)
+                unfinished.add(task_id)
+                stage.ready.append(task_id)
+                tasks.append((task_id, len(batch_task_ids) - 1, task))
+            for counts in (self._counts, self._batch_counts[batch_id]):
+                counts["total"] += len(tasks)
+                counts["pending"] += len(tasks)
+            self._work_available.notify_all()
+        if self.store is not None:
+            # Saved in the background, the rows can start before they are in the store (see TaskStore.save_tasks)
+            writer = threading.Thread(target=self._write_tasks_to_store, args=(tasks,), name=f"Store-writer-{batch_id}")
+            with self._lock:
+                self._store_writers = [thread for thread in self._store_writers if thread.is_alive()]
+                self._store_writers.append(writer)
+            writer.start()
+        print_logger(f"Added {len(tasks)} task(s) to batch {batch_id}")
+        return [task_id for task_id, _, _ in tasks]
+
+    def _write_tasks_to_store(self, tasks: List[Tuple[str, int, Task]]):
+        for start in range(0, len(tasks), TASK_STORE_WRITE_CHUNK):
+            try:
+                self.store.save_tasks([(task_id, position, task, None) for task_id, position, task in tasks[start:start + TASK_STORE_WRITE_CHUNK]])
+            except Exception as e:
+                print_logger(f"Failed to save {len(tasks)} task(s) to the task store: {str(e)}")
+                return
+
+    def flush_store(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the rows add_tasks is still writing to the store, True once they are all written"""
+        with self._lock:
+            writers = list(self._store_writers)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for writer in writers:
+            writer.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not any(writer.is_alive() for writer in writers)
+
+    def set_args_factory(self, batch_id: str, build_args: Callable[[Any], Dict[str, Any]]):
+        """The args factory of a resumed batch, its tasks added with add_tasks have only their source stored"""
+        with self._lock:
+            self._args_factories[batch_id] = build_args
     
-    def _process_tasks(self):
+    def _claim_next(self) -> Optional[Tuple[str, Task, StageState]]:
+        """
+        Take the next ready row, the caller holds _lock. Stages further down the pipeline go first so rows
+        already in flight finish before new ones start, and a stage is skipped while the stage after it is full.
+        """
+        now = time.monotonic()
+        self._release_due(now)
+        for stage in self._stage_order:
+            if not stage.ready or stage.in_flight >= stage.concurrency:
+                continue
+            if stage.next_stage is not None and len(self._stages[stage.next_stage].ready) >= self._stages[stage.next_stage].capacity:
+                continue
+            while stage.ready:
+                task_id = stage.ready.popleft()
+                task = self.tasks[task_id]
+                if task.status not in ("pending", "running"):
+                    continue
+                if task.status == "pending" and task.throttle_time:
+                    # Pacing: the next row of this batch is parked instead of a worker sleeping after each row
+                    next_start = self._batch_next_start.get(task.batch_id, 0.0)
+                    if now < next_start:
+                        self._schedule(task_id, next_start)
+                        continue
+                    self._batch_next_start[task.batch_id] = now + task.throttle_time
+                if task.status == "pending":
+                    self._set_status(task, "running")
+                    task.started_at = time.monotonic()
+                    if task.timeout:
+                        if task.cancel_token is None:
+                            task.cancel_token = CancellationToken()
+                        task.cancel_token.deadline = task.started_at + task.timeout
+                    self._unsynced_task_ids.add(task_id)
+                    metrics.get(task.batch_id).task_started()
+                stage.in_flight += 1
+                task.executing = True
+                return task_id, task, stage
+        return None
+
+    def _process_tasks(self, generation: int):
         """Background thread function to process tasks"""
         thread_name = threading.current_thread().name
         print_logger(f"Starting task processing thread: {thread_name}")
         
-        while self.processing:
-            try:
-                task_id = self.queue.get(timeout=1)
-                
-                # CRITICAL: Atomic check-and-set to prevent duplicate processing
+        try:
+            while True:
+                if not self.concurrency.acquire(cancelled=lambda: self._should_exit(generation) or self._workers_to_retire > 0):
+                    with self._lock:
+                        if generation == self._generation and self._take_retirement():
+                            break
+                    if self._should_exit(generation):
+                        break
+                    # Another worker took the retirement
+                    continue
+                # CRITICAL: rows are claimed under the lock so no two workers run the same stage of a task
+                work = self._wait_for_work(generation)
+                if work is None:
+                    self.concurrency.release()
+                    break
+                try:
+                    self._run_stage(*work)
+                finally:
+                    self.concurrency.release()
+        finally:
+            with self._lock:
+                if generation == self._generation:
+                    self._active_workers -= 1
+        print_logger(f"Task processing thread stopped: {thread_name}")
+
+    def _spawn_workers(self, count: int):
+        """Start `count` workers of the current generation, the caller holds _lock"""
+        for _ in range(count):
+            worker = threading.Thread(target=self._process_tasks, args=(self._generation,), name=f"Worker-{self._generation}-{len(self.worker_threads)}")
+            worker.daemon = True
+            self._active_workers += 1
+            self.worker_threads.append(worker)
+            worker.start()
+
+    def resize_workers(self, num_workers: int):
+        """
+        Grow or shrink the worker pool, also while a batch is running. Extra workers start straight away,
+        surplus workers retire once they finish the row they are on, no row is lost either way.
+        """
+        num_workers = max(1, int(num_workers))
+        print_logger(f"Resizing worker pool from {self.num_workers} to {num_workers} workers")
+        session_manager.ensure_pool_size(self.backend_url, self.tabs_api_token, num_workers)
+        self.concurrency.set_max_limit(num_workers)
+        with self._work_available:
+            self.num_workers = num_workers
+            for stage in self._stage_order:
+                stage.size_for(num_workers)
+            if self.processing:
+                self.worker_threads = [worker for worker in self.worker_threads if worker.is_alive()]
+                difference = num_workers - (self._active_workers - self._workers_to_retire)
+                if difference > 0:
+                    # Cancel retirements that have not happened yet before starting new threads
+                    cancelled = min(difference, self._workers_to_retire)
+                    self._workers_to_retire -= cancelled
+                    self._spawn_workers(difference - cancelled)
+                elif difference < 0:
+                    self._workers_to_retire += -difference
+            self._work_available.notify_all()
+        self.concurrency.wake_all()
+
+    def _run_stage(self, task_id: str, task: Task, stage: StageState):
+        """Run the current stage of a task (or the whole function for tasks without stages)"""
+        thread_name = threading.current_thread().name
+        print_logger(f"{thread_name} processing task {task_id} from batch {task.batch_id} ({stage.name})")
+        last_stage = task.stages is None or task.stage_index == len(task.stages) - 1
+        function = task.stages[task.stage_index].function if task.stages else task.function
+        finished = True
+        retry_at = None
+        stage_started_at = time.monotonic()
+        try:
+            # Cancelled or out of time while waiting for this stage
+            check_cancelled(task)
+            if task.args is None:
+                build_args = self._args_factories.get(task.batch_id)
+                if build_args is None:
+                    raise ValueError(f"No args factory for batch {task.batch_id}, call set_args_factory after resume_batch")
+                task.args = build_args(task.source)
+            print_logger(f"Executing {stage.name} for task {task_id} with args: {task.args}")
+            task.args["task"] = task
+            result = function(**task.args)
+
+            if last_stage and result is None:
+                retry_at = self._retry_at(task, None)
+            if retry_at is not None:
+                finished = False
+                print_logger(f"Task {task_id} returned no result, retry {task.attempts} in {retry_at - time.monotonic():.2f} seconds")
+            elif last_stage:
+                # Update result (brief lock for thread safety)
                 with self._lock:
-                    task = self.tasks[task_id]
-                    if task.status != "pending":
-                        # Another thread already claimed this task
-                        self.queue.task_done()
-                        continue
-                    task.status = "running"
-                    self.pending_tasks -= 1
-                
-                # Now we own this task exclusively
-                print_logger(f"{thread_name} processing task {task_id} from batch {task.batch_id}")
-                
+                    task.result = result
+                    self._set_status(task, "completed" if result is not None else "failed")
+                if result is None:
+                    print_logger(f"Task {task_id} failed with result: {result}")
+                else:
+                    print_logger(f"Task {task_id} completed successfully with result: {result}")
+            else:
+                finished = False
+
+        except RetryLater as e:
+            if task.deferrals < TASK_MAX_DEFERRALS:
+                # Runs again from its checkpoint once the backoff has passed, the worker moves on to other rows
+                task.deferrals += 1
+                finished = False
+                retry_at = time.monotonic() + e.delay
+                print_logger(f"Task {task_id} rescheduled in {e.delay:.2f} seconds ({task.deferrals}/{TASK_MAX_DEFERRALS}): {e.reason}")
+            else:
+                with self._lock:
+                    task.error = str(e)
+                    task.result = f"Failed to execute function, gave up after {task.deferrals} deferrals: {e.reason}"
+                    self._set_status(task, "failed")
+                print_logger(f"Task {task_id} failed after {task.deferrals} deferrals: {e.reason}")
+
+        except TaskCancelled as e:
+            with self._lock:
+                task.error = str(e)
+                if isinstance(e, TaskDeadlineExceeded):
+                    task.result = f"Failed to execute function, deadline of {task.timeout} seconds exceeded"
+                    self._set_status(task, "failed")
+                else:
+                    task.result = f"Cancelled: {str(e)}"
+                    self._set_status(task, "cancelled")
+            print_logger(f"Task {task_id} stopped: {str(e)}")
+
+        except Exception as e:
+            task.error = str(e)
+            retry_at = self._retry_at(task, e)
+            if retry_at is not None:
+                # Runs again from its checkpoint, the stage that failed is the one that runs
+                finished = False
+                print_logger(f"Task {task_id} failed with error: {str(e)}, retry {task.attempts} in {retry_at - time.monotonic():.2f} seconds")
+            else:
+                with self._lock:
+                    task.result = f"Failed to execute function {str(e)}"
+                    self._set_status(task, "failed")
+                print_logger(f"Task {task_id} failed with error: {str(e)}")
+
+        batch_metrics = metrics.get(task.batch_id)
+        if task.stages is not None:
+            stage_wait = stage_started_at - task.ready_at if task.ready_at is not None else 0.0
+            batch_metrics.record("stage", stage.name, time.monotonic() - stage_started_at, stage_wait, failed=task.status == "failed")
+
+        with self._work_available:
+            task.executing = False
+            stage.in_flight -= 1
+            stage.done += 1
+            if retry_at is not None:
+                self._schedule(task_id, retry_at)
+            elif not finished:
+                task.stage_index += 1
+                self._enqueue(task_id, task)
+            # A finished stage can unblock the stage before it (capacity) or free a stage slot
+            self._work_available.notify_all()
+
+        if finished:
+            self._record_task_timings(task, batch_metrics)
+            self._persist_task(task_id, task)
+            if task.source is not None:
+                # Rebuilt from the source row if the task is retried
+                task.args = None
+            print_logger(f"Queue size after task completion: {self.queue_size()}")
+
+    def _retry_at(self, task: Task, error: Optional[Exception]) -> Optional[float]:
+        """When a failed task runs again under its batch retry policy, None once it is out of attempts or the error is not retryable"""
+        policy = self._retry_policies.get(task.batch_id, self.retry_policy)
+        if not policy.should_retry(task.attempts, error):
+            return None
+        delay = policy.backoff(task.attempts)
+        task.attempts += 1
+        return time.monotonic() + delay
+
+    def _persist_task(self, task_id: str, task: Task):
+        if self.store is None:
+            return
+        try:
+            self.store.update_task(task_id, task.status, task.result, task.error)
+            if task.request_logs is not None:
+                # Only records appended since the last write, a retried task does not write its earlier attempts again
+                records, cursor = task.request_logs.since(self._store_log_cursors.get(task_id, 0))
+                first_sequence = self._request_sequence_base.get(task_id, 0) + cursor - len(records)
+                self.store.save_request_records(task_id, task.batch_id, records, first_sequence)
+                self._store_log_cursors[task_id] = cursor
+        except Exception as e:
+            print_logger(f"Failed to persist task {task_id}: {str(e)}")
+
+    def _update_batch_settings(self, batch_id: str, **values):
+        """Remember how a batch's tasks run and save it with the batch when it changed"""
+        settings = self._batch_settings.setdefault(batch_id, {})
+        if all(key in settings and settings[key] == value for key, value in values.items()):
+            return
+        settings.update(values)
+        if self.store is not None:
+            try:
+                self.store.save_batch_settings(batch_id, self.owner, settings)
+            except Exception as e:
+                print_logger(f"Failed to persist settings of batch {batch_id}: {str(e)}")
+
+    def persist_checkpoint(self, task: Task):
+        if self.store is None or task.task_id is None:
+            return
+        try:
+            self.store.save_checkpoint(task.task_id, task.checkpoint)
+        except Exception as e:
+            print_logger(f"Failed to persist checkpoint for task {task.task_id}: {str(e)}")
+
+    def _cancel(self, task_id: str, reason: str) -> Optional[str]:
+        """
+        Cancel one unfinished task, the caller holds _lock. A task no worker is running is marked cancelled now
+        and left in the ready queue or delay heap, workers drop it when they reach it ("cancelled"). A running task
+        is told through its token and stops at its next check point, unless it finishes first ("cancel_requested").
+        None for a task that was already finished.
+        """
+        task = self.tasks[task_id]
+        if task.status not in ("pending", "running"):
+            return None
+        if task.cancel_token is None:
+            task.cancel_token = CancellationToken()
+        task.cancel_token.cancel(reason)
+        if task.executing:
+            return "cancel_requested"
+        task.error = reason
+        task.result = f"Cancelled: {reason}"
+        self._set_status(task, "cancelled")
+        return "cancelled"
+
+    def cancel_task(self, task_id: str, reason: str = "cancelled") -> Optional[str]:
+        """"cancelled", "cancel_requested" for a task a worker is running, or None if it was already finished"""
+        with self._work_available:
+            outcome = self._cancel(task_id, reason)
+            self._work_available.notify_all()
+        if outcome == "cancelled":
+            self._persist_task(task_id, self.tasks[task_id])
+        return outcome
+
+    def cancel_batch(self, batch_id: str, reason: str = "batch cancelled") -> Dict[str, int]:
+        """
+        Cancel every unfinished task of a batch, only that batch's unfinished tasks are visited. Returns how many
+        were cancelled and how many are running and were asked to stop, those can still complete or fail,
+        the batch counters have their final status.
+        """
+        outcomes = {"cancelled": [], "cancel_requested": []}
+        with self._work_available:
+            for task_id in list(self._batch_unfinished.get(batch_id, ())):
+                outcome = self._cancel(task_id, reason)
+                if outcome is not None:
+                    outcomes[outcome].append(task_id)
+            # Drain mode may be waiting on rows that are now gone
+            self._work_available.notify_all()
+        for task_id in outcomes["cancelled"]:
+            self._persist_task(task_id, self.tasks[task_id])
+        print_logger(f"Cancelled {len(outcomes['cancelled'])} task(s) of batch {batch_id}, {len(outcomes['cancel_requested'])} running task(s) asked to stop")
+        return {outcome: len(task_ids) for outcome, task_ids in outcomes.items()}
+
+    def get_dead_letters(self, batch_id: str) -> List[Dict[str, Any]]:
+        """Failed tasks of a batch (out of retries or not retryable), oldest failure first"""
+        with self._lock:
+            task_ids = list(self._dead_letters.get(batch_id, ()))
+        return [
+            {"task_id": task_id, "error": self.tasks[task_id].error, "attempts": self.tasks[task_id].attempts + 1, "result": self.tasks[task_id].result}
+            for task_id in task_ids
+        ]
+
+    def retry_dead_letters(self, batch_id: str) -> int:
+        """
+        Queue the failed tasks of a batch again with a fresh retry budget, the rest of the batch is left alone.
+        They continue from their checkpoint. Returns how many were queued, start_processing() runs them.
+        """
+        now = time.monotonic()
+        with self._work_available:
+            task_ids = list(self._dead_letters.get(batch_id, ()))
+            for task_id in task_ids:
+                task = self.tasks[task_id]
+                self._set_status(task, "pending")
+                self._batch_unfinished[batch_id].add(task_id)
+                task.result = None
+                task.error = None
+                task.attempts = 0
+                task.deferrals = 0
+                task.cancel_token = None
+                task.enqueued_at = now
+                task.started_at = None
+                task.finished_at = None
+                self._enqueue(task_id, task)
+        if self.store is not None:
+            for task_id in task_ids:
                 try:
-                    print_logger(f"Executing function for task {task_id} with args: {task.args}")
-                    task.args["task"] = task
-                    result = task.function(**task.args)
-                    
-                    # Update result (brief lock for thread safety)
-                    with self._lock:
-                        task.result = result
-                        task.status = "completed" if result is not None else "failed"
-                        self.completed_tasks += 1
-                    
-                    if result is None:
-                        print_logger(f"Task {task_id} failed with result: {result}")
-                    else:
-                        print_logger(f"Task {task_id} completed successfully with result: {result}")
-                        
+                    self.store.update_task(task_id, "pending")
                 except Exception as e:
-                    with self._lock:
-                        task.status = "failed"
-                        task.error = str(e)
-                        task.result = f"Failed to execute function {str(e)}"
-                        self.failed_tasks += 1
-                    print_logger(f"Task {task_id} failed with error: {str(e)}")
-                
-                # Handle throttling
-                if task.throttle_time:
-                    print_logger(f"Sleeping for {task.throttle_time} seconds")
-                    time.sleep(task.throttle_time) # Built in buffer of 1 second to avoid rate limiting
-
-                
-                self.queue.task_done()
-                print_logger(f"Queue size after task completion: {self.queue.qsize()}")
-                
-            except queue.Empty:
+                    print_logger(f"Failed to persist task {task_id}: {str(e)}")
+        print_logger(f"Retrying {len(task_ids)} failed task(s) of batch {batch_id}")
+        return len(task_ids)
+
+    def register_batch(self, batch_id: str, meta: Optional[Dict[str, Any]] = None, retry_policy: Optional[TaskRetryPolicy] = None):
+        """
+        Set the retry policy of a batch (the queue's policy otherwise) and save what is needed to rebuild
+        the page for this batch after a restart, the store part is a no-op without a store
+        """
+        if self.store is not None:
+            self.store.save_batch(batch_id, self.owner, meta)
+            self.store.claim_batch(batch_id, self.owner, self.lease_holder)
+        if retry_policy is not None:
+            self._retry_policies[batch_id] = retry_policy
+            self._update_batch_settings(batch_id, retry_policy=retry_policy_to_settings(retry_policy))
+
+    def resume_batch(self, batch_id: str) -> int:
+        """
+        Load a stored batch into the queue. Finished tasks keep their result, everything else
+        (pending or running when the app stopped) is queued again with the batch's stages, timeout and
+        retry policy. Returns how many tasks were queued. Tasks stored without args (added with add_tasks) are
+        built from their source, set_args_factory has to be called before start_processing.
+        Raises ValueError for a batch of another backend or API key, or one another queue still holds the lease on.
+        """
+        if self.store is None:
+            raise ValueError("No task store configured, set TASK_STORE_PATH to resume batches")
+        if not self.store.claim_batch(batch_id, self.owner, self.lease_holder):
+            raise ValueError(f"Batch {batch_id} is still running in another session or belongs to another merchant")
+        settings = self.store.get_batch_settings(batch_id) or {}
+        self._batch_settings[batch_id] = settings
+        stages = stages_from_settings(settings.get("stages"))
+        if settings.get("retry_policy"):
+            self._retry_policies[batch_id] = retry_policy_from_settings(settings["retry_policy"])
+        self._request_sequence_base.update(self.store.get_request_sequences(batch_id))
+        with self._lock:
+            self._register_stages(stages)
+        queued = 0
+        for row in self.store.load_tasks(batch_id):
+            task_id = row["task_id"]
+            if task_id in self.tasks:
                 continue
-        print_logger(f"Task processing thread stopped: {thread_name}")
-    
+            task = Task(function=resolve_function(row["function"]), args=row["args"], batch_id=batch_id, api_key=self.tabs_api_token, backend_url=self.backend_url, throttle_time=settings.get("throttle_time"), queue=self, enqueued_at=time.monotonic(), task_id=task_id, checkpoint=row["checkpoint"], stages=stages, timeout=settings.get("timeout"), source=row["source"])
+            finished = row["status"] in FINAL_STATUSES
+            if finished:
+                task.status = row["status"]
+                task.result = row["result"]
+                task.error = row["error"]
+            with self._lock:
+                self.tasks[task_id] = task
+                self._add_batch(batch_id)
+                self.batches[batch_id].append(task_id)
+                if not finished:
+                    self._batch_unfinished[batch_id].add(task_id)
+                elif task.status == "failed":
+                    self._dead_letters.setdefault(batch_id, {})[task_id] = None
+                for counts in (self._counts, self._batch_counts[batch_id]):
+                    counts["total"] += 1
+                    counts[task.status] += 1
+                if not finished:
+                    self._enqueue(task_id, task)
+                    queued += 1
+        print_logger(f"Resumed batch {batch_id}, {queued} task(s) queued")
+        return queued
+
+    def _record_task_timings(self, task: Task, batch_metrics):
+        task.finished_at = time.monotonic()
+        wall_time = task.finished_at - task.started_at
+        queue_wait = task.started_at - task.enqueued_at if task.enqueued_at is not None else 0.0
+        if task.timings is None:
+            task.timings = {}
+        task.timings["wall_seconds"] = round(wall_time, 3)
+        task.timings["queue_wait_seconds"] = round(queue_wait, 3)
+        task.timings["retries"] = task.retries
+        task.timings["attempts"] = task.attempts + 1
+        batch_metrics.task_finished(wall_time, queue_wait, task.retries, task.status != "completed")
+
     def start_processing(self):
         """Start multiple background processing threads"""
         if not self.processing:
             print_logger(f"Starting queue processing with {self.num_workers} workers")
-            self.processing = True
-            self.worker_threads = []
-            
-            for i in range(self.num_workers):
-                worker = threading.Thread(target=self._process_tasks, name=f"Worker-{i}")
-                worker.daemon = True
-                worker.start()
-                self.worker_threads.append(worker)
+            with self._work_available:
+                self._generation += 1
+                self._stop_mode = None
+                self.processing = True
+                self._active_workers = 0
+                self._workers_to_retire = 0
+                # Workers of an earlier generation may still be finishing their last row
+                self.worker_threads = [worker for worker in self.worker_threads if worker.is_alive()]
+                self._spawn_workers(self.num_workers)
+                if self.store is not None:
+                    self._heartbeat_stopped = threading.Event()
+                    threading.Thread(target=self._heartbeat, args=(self._generation, self._heartbeat_stopped), name=f"Heartbeat-{self._generation}", daemon=True).start()
             
             print_logger("Queue processing started")
+
+    def _heartbeat(self, generation: int, stopped: threading.Event):
+        """
+        Renew the store lease of every batch this queue still has work for. Once processing stops and the last
+        worker of the generation is gone (and every task row is in the store) the leases are released, so the batch
+        can be resumed elsewhere.
+        """
+        while generation == self._generation:
+            if stopped.is_set() and self._active_workers == 0:
+                self.flush_store()
+                try:
+                    self.store.release_leases(self.lease_holder)
+                except Exception as e:
+                    print_logger(f"Failed to release batch leases: {str(e)}")
+                return
+            with self._lock:
+                batch_ids = [batch_id for batch_id, unfinished in self._batch_unfinished.items() if unfinished]
+            try:
+                self.store.renew_leases(batch_ids, self.lease_holder)
+            except Exception as e:
+                print_logger(f"Failed to renew batch leases: {str(e)}")
+            stopped.wait(1.0 if stopped.is_set() else TASK_LEASE_SECONDS / 3)
     
-    def stop_processing(self):
-        """Stop all background processing threads"""
+    def stop_processing(self, mode: str = "abort", wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """
+        Stop the background processing threads, idle workers are woken and exit immediately.
+        - mode="abort": workers exit after the stage they are running, rows not started stay pending for the next start
+        - mode="drain": workers finish every ready and delayed row first
+        With wait=False this returns straight away, otherwise it joins the workers for at most `timeout` seconds in total.
+        Returns True when no worker is left running.
+        """
+        if mode not in ("abort", "drain"):
+            raise ValueError(f"Invalid stop mode: {mode}")
         if self.processing:
-            print_logger("Stopping queue processing")
-            self.processing = False
-            
-            for worker in self.worker_threads:
-                worker.join()
-            self.worker_threads = []
-            print_logger("Queue processing stopped")
+            print_logger(f"Stopping queue processing ({mode})")
+            with self._work_available:
+                self.processing = False
+                self._stop_mode = mode
+                self._work_available.notify_all()
+            self.concurrency.wake_all()
+            if self._heartbeat_stopped is not None:
+                self._heartbeat_stopped.set()
+
+        if not wait:
+            return not any(worker.is_alive() for worker in self.worker_threads)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self.worker_threads:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            worker.join(remaining)
+        self.worker_threads = [worker for worker in self.worker_threads if worker.is_alive()]
+        self.flush_store(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        if self.worker_threads:
+            print_logger(f"Queue processing stopping, {len(self.worker_threads)} worker(s) still finishing their row")
+            return False
+        print_logger("Queue processing stopped")
+        return True
     
+    def drain_new_request_logs(self) -> List[Any]:
+        """Request logs appended since the last call, only tasks that ran since then are visited"""
+        with self._lock:
+            task_ids = list(self._unsynced_task_ids)
+        new_request_logs = []
+        for task_id in task_ids:
+            task = self.tasks[task_id]
+            # Read the status first, a task that was already done cannot append after we read its log
+            finished = task.status not in ("pending", "running")
+            if task.request_logs is None:
+                if finished:
+                    with self._lock:
+                        self._unsynced_task_ids.discard(task_id)
+                continue
+            records, cursor = task.request_logs.since(self._request_log_cursors.get(task_id, 0))
+            self._request_log_cursors[task_id] = cursor
+            new_request_logs.extend(records)
+            if finished:
+                with self._lock:
+                    self._unsynced_task_ids.discard(task_id)
+        return new_request_logs
+
+    def record_response(self, rate_limited: bool, latency: Optional[float] = None, endpoint: Optional[str] = None, overloaded: bool = False):
+        """Feedback from the request helpers, drives the adaptive concurrency limit"""
+        self.concurrency.record_response(rate_limited, latency, endpoint, overloaded)
+
+    def progress(self) -> Dict[str, int]:
+        """Consistent snapshot of the global counters, dict.copy() is atomic so no lock is taken"""
+        return self._counts.copy()
+
     def get_queue_stats(self) -> Dict[str, int]:
         """Get current queue statistics"""
-        with self._lock:
-            total = len(self.tasks)
-            completed = sum(1 for task in self.tasks.values() if task.status == "completed")
-            failed = sum(1 for task in self.tasks.values() if task.status == "failed")
-            pending = sum(1 for task in self.tasks.values() if task.status == "pending")
-            running = sum(1 for task in self.tasks.values() if task.status == "running")
-            
-            stats = {
-                "total": total,
-                "completed": completed,
-                "failed": failed,
-                "pending": pending,
-                "running": running,
-                "queue_size": self.queue.qsize()
-            }
-            print_logger(f"Queue stats: {stats}")
-            return stats
+        stats = self.progress()
+        stats["queue_size"] = self.queue_size()
+        stats["delayed"] = self.delayed_size()
+        print_logger(f"Queue stats: {stats}")
+        return stats
     
     def get_batch_stats(self, batch_id: str) -> Dict[str, int]:
         """Get statistics for a specific batch"""
-        if batch_id not in self.batches:
+        batch_counts = self._batch_counts.get(batch_id)
+        if batch_counts is None:
             print_logger(f"No batch found with ID: {batch_id}")
-            return {"total": 0, "completed": 0, "failed": 0, "pending": 0, "running": 0}
-        
+            return new_status_counts()
+        stats = batch_counts.copy()
+        print_logger(f"Batch {batch_id} stats: {stats}")
+        return stats
+
+    def get_stage_stats(self) -> List[Dict[str, Any]]:
+        """Ready rows, running and finished executions per stage, a growing ready count marks the bottleneck"""
         with self._lock:
-            batch_tasks = [self.tasks[task_id] for task_id in self.batches[batch_id]]
-            total = len(batch_tasks)
-            completed = sum(1 for task in batch_tasks if task.status == "completed")
-            failed = sum(1 for task in batch_tasks if task.status == "failed")
-            pending = sum(1 for task in batch_tasks if task.status == "pending")
-            running = sum(1 for task in batch_tasks if task.status == "running")
-            
-            stats = {
-                "total": total,
-                "completed": completed,
-                "failed": failed,
-                "pending": pending,
-                "running": running
-            }
-            print_logger(f"Batch {batch_id} stats: {stats}")
-            return stats 
-        
+            return [
+                {
+                    "stage": stage.name,
+                    "ready": len(stage.ready),
+                    "in_flight": stage.in_flight,
+                    "done": stage.done,
+                    "concurrency": stage.concurrency,
+                    "capacity": stage.capacity,
+                }
+                for stage in sorted(self._stage_order, key=lambda stage: stage.position)
+                if stage.name != DEFAULT_STAGE or stage.done or stage.ready
+            ]
+
+    def get_batch_timings(self, batch_id: str) -> List[Dict[str, float]]:
+        """Per task timings (wall time, queue wait, retries and each chain step) in the order the tasks were added"""
+        if batch_id not in self.batches:
+            return []
+        return [dict(self.tasks[task_id].timings or {}) for task_id in self.batches[batch_id]]
+
+    def get_batch_checkpoints(self, batch_id: str) -> List[Dict[str, Any]]:
+        """Copies of the task checkpoints (ids created by each chain) in the order the tasks were added"""
+        if batch_id not in self.batches:
+            return []
+        with self._lock:
+            return [dict(self.tasks[task_id].checkpoint or {}) for task_id in self.batches[batch_id]]
+
     def get_batch_results(self, batch_id: str) -> List[Any]:
         """Get results for a specific batch"""
         if batch_id not in self.batches:
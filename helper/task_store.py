@@ -0,0 +1,261 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+import importlib
+from datetime import date, datetime
+from helper.logger import print_logger
+
+# Set TASK_STORE_PATH (e.g. /mount/data/tasks.db) to keep batches on disk so they survive restarts, unset keeps everything in memory
+TASK_STORE_PATH = os.getenv("TASK_STORE_PATH")
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+# A queue processing a batch renews its lease on it, another session can only resume the batch once the lease ran out
+TASK_LEASE_SECONDS = float(os.getenv("TASK_LEASE_SECONDS", 60))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    meta TEXT,
+    owner TEXT,
+    lease_holder TEXT,
+    lease_until REAL,
+    settings TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    batch_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    function TEXT NOT NULL,
+    args TEXT NOT NULL,
+    source TEXT,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    checkpoint TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_batch ON tasks (batch_id, position);
+CREATE TABLE IF NOT EXISTS request_records (
+    request_id INTEGER,
+    task_id TEXT NOT NULL,
+    batch_id TEXT NOT NULL,
+    record TEXT NOT NULL,
+    sequence INTEGER
+);
+CREATE INDEX IF NOT EXISTS request_records_batch ON request_records (batch_id);
+CREATE INDEX IF NOT EXISTS batches_owner ON batches (owner);
+-- sequence is the position of the record in its task's log over every run of the task
+CREATE UNIQUE INDEX IF NOT EXISTS request_records_key ON request_records (batch_id, task_id, sequence);
+"""
+
+
+def to_json(value):
+    def default(obj):
+        if isinstance(obj, (datetime, date)):
+            return obj.isoformat()
+        if hasattr(obj, "item"):
+            # numpy / pandas scalars coming from DataFrame rows
+            return obj.item()
+        return str(obj)
+    return json.dumps(value, default=default)
+
+
+def from_json(value):
+    return json.loads(value) if value is not None else None
+
+
+def batch_owner(backend_url, api_key):
+    """Batches are only listed and resumed for the backend and API key (merchant) that created them, the key itself is not stored"""
+    return hashlib.sha256(f"{backend_url}\n{api_key}".encode("utf-8")).hexdigest()
+
+
+def function_path(function):
+    return f"{function.__module__}:{function.__qualname__}"
+
+
+def resolve_function(path):
+    module_name, qualname = path.split(":", 1)
+    target = importlib.import_module(module_name)
+    for attribute in qualname.split("."):
+        target = getattr(target, attribute)
+    return target
+
+
+class TaskStore:
+    """
+    SQLite (WAL mode) copy of every batch, its tasks and their request records.
+    The TaskQueue stays the working copy in memory, the store is what a batch is resumed from after a restart.
+    One connection is shared by all workers, writes are serialized by a lock and are small.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        print_logger(f"Task store opened at {path}")
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters)
+
+    def _executemany(self, sql, rows):
+        with self._lock:
+            self._write_many(sql, rows)
+
+    def _write_many(self, sql, rows):
+        """One transaction for all rows, the caller holds _lock"""
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.executemany(sql, rows)
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def save_batch(self, batch_id, owner, meta=None):
+        self._execute(
+            "INSERT INTO batches (batch_id, created_at, meta, owner) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(batch_id) DO UPDATE SET meta = excluded.meta",
+            (batch_id, time.time(), to_json(meta or {}), owner))
+
+    def save_batch_settings(self, batch_id, owner, settings):
+        """How the batch's tasks run (stages, timeout, retry policy), resume_batch restores them"""
+        self._execute(
+            "INSERT INTO batches (batch_id, created_at, owner, settings) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(batch_id) DO UPDATE SET settings = excluded.settings",
+            (batch_id, time.time(), owner, to_json(settings)))
+
+    def get_batch_settings(self, batch_id):
+        rows = self._query("SELECT settings FROM batches WHERE batch_id = ?", (batch_id,))
+        return from_json(rows[0]["settings"]) if rows else None
+
+    def claim_batch(self, batch_id, owner, holder, lease_seconds=TASK_LEASE_SECONDS):
+        """
+        Take the lease of a batch of `owner`, False if the batch belongs to someone else or another holder's
+        lease is still live. The check and the update are one statement, two sessions cannot both win.
+        """
+        now = time.time()
+        cursor = self._execute(
+            "UPDATE batches SET lease_holder = ?, lease_until = ? WHERE batch_id = ? AND owner = ? "
+            "AND (lease_holder IS NULL OR lease_holder = ? OR lease_until IS NULL OR lease_until < ?)",
+            (holder, now + lease_seconds, batch_id, owner, holder, now))
+        return cursor.rowcount == 1
+
+    def renew_leases(self, batch_ids, holder, lease_seconds=TASK_LEASE_SECONDS):
+        until = time.time() + lease_seconds
+        rows = [(until, batch_id, holder) for batch_id in batch_ids]
+        if rows:
+            self._executemany("UPDATE batches SET lease_until = ? WHERE batch_id = ? AND lease_holder = ?", rows)
+
+    def release_leases(self, holder):
+        self._execute("UPDATE batches SET lease_holder = NULL, lease_until = NULL WHERE lease_holder = ?", (holder,))
+
+    def save_tasks(self, tasks):
+        """
+        tasks: iterable of (task_id, position, Task, args), args is passed separately since queued tasks may not hold theirs.
+        Tasks added with add_tasks are saved with args None and their source, the batch's args factory rebuilds them.
+        The rows are built under the write lock: a task that already ran before its row is written (add_tasks saves in
+        the background) is saved as it is now, the update_task and save_checkpoint calls it made are not lost.
+        """
+        with self._lock:
+            now = time.time()
+            rows = [
+                (task_id, task.batch_id, position, function_path(task.function), to_json(args), to_json(task.source),
+                 task.status, to_json(task.result), task.error, to_json(task.checkpoint), now)
+                for task_id, position, task, args in tasks
+            ]
+            self._write_many(
+                "INSERT OR IGNORE INTO tasks (task_id, batch_id, position, function, args, source, status, result, error, checkpoint, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows)
+
+    def update_task(self, task_id, status, result=None, error=None):
+        self._execute(
+            "UPDATE tasks SET status = ?, result = ?, error = ?, updated_at = ? WHERE task_id = ?",
+            (status, to_json(result), error, time.time(), task_id))
+
+    def save_checkpoint(self, task_id, checkpoint):
+        self._execute(
+            "UPDATE tasks SET checkpoint = ?, updated_at = ? WHERE task_id = ?",
+            (to_json(checkpoint), time.time(), task_id))
+
+    def save_request_records(self, task_id, batch_id, records, first_sequence):
+        """records are new since the caller's cursor, first_sequence is the position of the first one in the task's log"""
+        rows = [
+            (record.request_id, task_id, batch_id, to_json(record.to_dict()), sequence)
+            for sequence, record in enumerate(records, start=first_sequence)
+        ]
+        if rows:
+            self._executemany("INSERT OR IGNORE INTO request_records (request_id, task_id, batch_id, record, sequence) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def get_request_sequences(self, batch_id):
+        """task_id -> how many request records are stored for it, a resumed task numbers its new records after them"""
+        rows = self._query(
+            "SELECT task_id, MAX(sequence) + 1 AS next_sequence FROM request_records WHERE batch_id = ? AND sequence IS NOT NULL GROUP BY task_id",
+            (batch_id,))
+        return {row["task_id"]: row["next_sequence"] for row in rows}
+
+    def get_batch_meta(self, batch_id):
+        rows = self._query("SELECT meta FROM batches WHERE batch_id = ?", (batch_id,))
+        return from_json(rows[0]["meta"]) if rows else None
+
+    def load_tasks(self, batch_id):
+        """Rows of a batch in the order they were added, args/source/result/checkpoint decoded"""
+        rows = self._query(
+            "SELECT task_id, position, function, args, source, status, result, error, checkpoint FROM tasks WHERE batch_id = ? ORDER BY position",
+            (batch_id,))
+        return [
+            {
+                "task_id": row["task_id"],
+                "position": row["position"],
+                "function": row["function"],
+                "args": from_json(row["args"]),
+                "source": from_json(row["source"]),
+                "status": row["status"],
+                "result": from_json(row["result"]),
+                "error": row["error"],
+                "checkpoint": from_json(row["checkpoint"]),
+            }
+            for row in rows
+        ]
+
+    def list_unfinished_batches(self, owner):
+        """
+        Batches of `owner` with tasks that never reached a final status, newest first.
+        `leased` is set while another queue still holds the batch (it is running somewhere), those cannot be resumed.
+        """
+        final_statuses = ", ".join(f"'{status}'" for status in FINAL_STATUSES)
+        rows = self._query(
+            "SELECT b.batch_id, b.created_at, b.lease_until, COUNT(t.task_id) AS total, "
+            f"SUM(CASE WHEN t.status IN ({final_statuses}) THEN 1 ELSE 0 END) AS done "
+            "FROM batches b JOIN tasks t ON t.batch_id = b.batch_id WHERE b.owner = ? "
+            "GROUP BY b.batch_id HAVING done < total ORDER BY b.created_at DESC",
+            (owner,))
+        now = time.time()
+        return [{**dict(row), "leased": row["lease_until"] is not None and row["lease_until"] >= now} for row in rows]
+
+
+_task_store = None
+_task_store_lock = threading.Lock()
+
+
+def get_task_store():
+    """The process wide TaskStore, or None when TASK_STORE_PATH is not set"""
+    global _task_store
+    if not TASK_STORE_PATH:
+        return None
+    with _task_store_lock:
+        if _task_store is None:
+            _task_store = TaskStore(TASK_STORE_PATH)
+        return _task_store
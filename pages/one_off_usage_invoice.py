@@ -9,14 +9,17 @@ from helper.matching_helpers import (
     find_most_likely_customer
 )
 from helper.date_functions import create_time_stamp
-from api.tools import find_net_terms_for_customer, generate_template_billing_term
+from api.tools import find_net_terms_for_customer, generate_template_billing_term, billing_term_signature, match_contracts_to_groups, match_invoices_to_rows, clean_numbers, validate_invoice_rows
 from api.tabs_sdk import get_revenue_categories, get_integration_items
-from api.main import get_customers
+from api.main import get_customers, get_invoices, iter_contracts, iter_contract_obligations
+from helper.parallel import ordered_parallel_map
 import time
 from datetime import datetime
-from helper.task_queue import TaskQueue, Task
-from api.chains import one_off_invoice_chain
-from api.links import invoices_for_contract_name
+from helper.task_queue import TaskQueue, count_done
+from helper.retry import TaskRetryPolicy, TASK_MAX_ATTEMPTS
+from api.chains import one_off_invoice_chain, ONE_OFF_INVOICE_STAGES, grouped_invoice_chain, GROUPED_INVOICE_STAGES, bulk_invoice_chain, BULK_UPLOAD_ROW_THRESHOLD, BULK_UPLOAD_CHUNK_SIZE
+from api.links import invoices_for_contract_name, invoices_for_customer_and_contract_name
+from streamlit_config.config import concurrency_panel, worker_pool_panel, batch_metrics_panel, session_task_queue
 from calendar import monthrange
 
 # Constants for product name column detection
@@ -76,11 +79,6 @@ def template_data_frame():
     ])
     return template_df
 
-def clean_number(string_number):
-    string_number = str(string_number)
-    string_number = string_number.replace("$", "").replace(",", "")
-    return float(string_number)
-
 def help_blurb():
     blurb = """
     **Quick Start Guide:**
@@ -108,7 +106,7 @@ def app_specific_session_state(refresh_from_db=False, reset_to_step=999):
             st.session_state.integration_items = get_integration_items(get_all=True)
 
         if "task_queue" not in st.session_state:
-            st.session_state.task_queue = TaskQueue(api_key=st.session_state.tabs_api_token, backend_url=st.session_state.backend_url, num_workers=st.session_state.max_allowed_threads)
+            st.session_state.task_queue = TaskQueue(api_key=st.session_state.tabs_api_token, backend_url=st.session_state.backend_url, num_workers=st.session_state.max_allowed_threads, requests_per_second=st.session_state.requests_per_second)
     else:
         # Initialize empty lists if API key not set
         if "customers" not in st.session_state:
@@ -136,6 +134,33 @@ def app_specific_session_state(refresh_from_db=False, reset_to_step=999):
     # STEP 4
     if "one_off_invoice_batch_id" not in st.session_state or reset_to_step <= 4:
         st.session_state.one_off_invoice_batch_id = None
+        # Row positions of each task when rows are grouped per customer, None when every row is its own task
+        st.session_state.invoice_row_groups = None
+        # Bulk batches return the invoice link per row key instead of one result per task
+        st.session_state.invoice_bulk_upload = False
+        # Rows skipped because their contract was already processed, {"invoice_link", "contract_id"} by row position
+        st.session_state.invoice_skipped_rows = {}
+        # Validation errors of rows left out of the batch, by row position
+        st.session_state.invoice_invalid_rows = {}
+        # Rows left out because more than one existing contract could be theirs, reason by row position
+        st.session_state.invoice_review_rows = {}
+        # Batch whose invoices were last joined back onto the results
+        st.session_state.invoice_reconciled_batch_id = None
+    # Run settings
+    if "pipeline_invoice_steps" not in st.session_state:
+        st.session_state.pipeline_invoice_steps = False
+    if "invoice_row_timeout" not in st.session_state:
+        st.session_state.invoice_row_timeout = 0
+    if "invoice_row_attempts" not in st.session_state:
+        st.session_state.invoice_row_attempts = max(TASK_MAX_ATTEMPTS, 1)
+    if "invoice_retry_all_errors" not in st.session_state:
+        st.session_state.invoice_retry_all_errors = False
+    if "group_invoice_rows" not in st.session_state:
+        st.session_state.group_invoice_rows = False
+    if "invoice_bulk_upload_enabled" not in st.session_state:
+        st.session_state.invoice_bulk_upload_enabled = False
+    if "invoice_bulk_threshold" not in st.session_state:
+        st.session_state.invoice_bulk_threshold = BULK_UPLOAD_ROW_THRESHOLD
     
 
 def calculate_app_states():
@@ -177,17 +202,14 @@ def format_invoice_product_name(product_name, product_description):
     <i style="font-size: .8em;">{product_description}</i>"""
     return template_string.format(product_name=product_name, product_description=product_description)
 
-def generate_task_payload_for_row(row, contract_name):
+def generate_task_payload_for_row(row, contract_name, df, matched_customers, invoice_config, merchant_link):
     customer_name = row["Rep Invoicing Tabs Customer Name"]
-    current_customer_details = st.session_state.matched_customers_for_usage_one_off_invoices[customer_name]
+    current_customer_details = matched_customers[customer_name]
     customer_id = current_customer_details["customer_id"]
     net_terms = current_customer_details["net_terms"]
     
-    # Use CSV column values if available, otherwise use global defaults
-    invoice_config = st.session_state.invoice_details_for_usage_one_off_invoices
-    
+    # Use CSV column values if available, otherwise use global defaults (invoice_config)
     # Get product name from CSV row or use default
-    df = st.session_state.base_data_for_usage_one_off_invoices
     product_name = get_product_name_from_row(row, df, invoice_config.get("product_name", "Usage Credits"))
     
     # Description is optional - only use if provided, otherwise leave empty
@@ -226,9 +248,181 @@ def generate_task_payload_for_row(row, contract_name):
     task_payload["customer_id"] = customer_id
     task_payload["contract_name"] = contract_name
     task_payload["billing_term_payload"] = template_payload
-    task_payload["merchant_link"] = st.session_state.merchant_link
+    task_payload["merchant_link"] = merchant_link
     return task_payload
 
+def task_payload_builder(contract_name, existing_contract_ids=None):
+    """
+    Builds a row's task payload from its position when the task runs, so a large upload is not held twice in memory.
+    Session state is read here, the workers calling the builder cannot read it.
+    existing_contract_ids maps a row position to the unprocessed contract that row (or the group it starts) reuses.
+    """
+    existing_contract_ids = existing_contract_ids or {}
+    df = st.session_state.base_data_for_usage_one_off_invoices
+    matched_customers = st.session_state.matched_customers_for_usage_one_off_invoices
+    invoice_config = st.session_state.invoice_details_for_usage_one_off_invoices
+    merchant_link = st.session_state.merchant_link
+    def build_task_payload(position):
+        task_payload = generate_task_payload_for_row(df.iloc[position], contract_name, df, matched_customers, invoice_config, merchant_link)
+        if position in existing_contract_ids:
+            task_payload["existing_contract_id"] = existing_contract_ids[position]
+        return task_payload
+    return build_task_payload
+
+def match_existing_contracts(contract_name, task_groups):
+    """
+    Pre-submission pass so a re-run only sends the missing work. The contracts named contract_name are listed once,
+    kept for the customers of the batch and matched to each task (a row, or a customer's rows) by the obligations they
+    already have, see match_contracts_to_groups. Returns the groups still to run, the unprocessed contract each of them
+    reuses (by first row position), the invoice link and contract of rows whose contract is already processed and the reason
+    rows that could belong to more than one contract are held back for review (both by row position).
+    """
+    matched_customers = st.session_state.matched_customers_for_usage_one_off_invoices
+    customer_names = st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Tabs Customer Name"].tolist()
+    groups_by_customer = {}
+    for positions in task_groups:
+        groups_by_customer.setdefault(matched_customers[customer_names[positions[0]]]["customer_id"], []).append(positions)
+
+    # One listing for the whole batch instead of one per customer, obligations are only fetched for the contracts of
+    # the batch's customers
+    contracts_by_customer = {}
+    for contract in iter_contracts(name=contract_name):
+        if contract.get("name") == contract_name and contract.get("status") != "DELETED" and contract.get("customerId") in groups_by_customer:
+            contracts_by_customer.setdefault(contract["customerId"], []).append(contract)
+    contract_ids = [contract["id"] for contracts in contracts_by_customer.values() for contract in contracts]
+    contract_obligations = dict(zip(contract_ids, ordered_parallel_map(lambda contract_id: list(iter_contract_obligations(contract_id=contract_id)), contract_ids)))
+
+    build_row_payload = task_payload_builder(contract_name)
+    outcomes = {}
+    for customer_id, groups in groups_by_customer.items():
+        if customer_id not in contracts_by_customer:
+            continue
+        group_signatures = [[billing_term_signature(build_row_payload(position)["billing_term_payload"]) for position in positions] for positions in groups]
+        for positions, outcome in zip(groups, match_contracts_to_groups(contracts_by_customer[customer_id], contract_obligations, group_signatures)):
+            outcomes[positions[0]] = outcome
+
+    remaining_groups = []
+    existing_contract_ids = {}
+    skipped_rows = {}
+    review_rows = {}
+    for positions in task_groups:
+        outcome, value = outcomes.get(positions[0], ("new", None))
+        if outcome == "processed":
+            link = invoices_for_customer_and_contract_name(value["customerId"], contract_name, merchant_link=st.session_state.merchant_link)
+            for position in positions:
+                skipped_rows[position] = {"invoice_link": link, "contract_id": value["id"]}
+            continue
+        if outcome == "review":
+            for position in positions:
+                review_rows[position] = value
+            continue
+        if outcome == "reuse":
+            existing_contract_ids[positions[0]] = value["id"]
+        remaining_groups.append(positions)
+    return remaining_groups, existing_contract_ids, skipped_rows, review_rows
+
+def group_rows_by_customer(df):
+    """Row positions per customer, in the order each customer first appears"""
+    groups = df.groupby("Rep Invoicing Tabs Customer Name", sort=False).indices
+    return [positions.tolist() for positions in groups.values()]
+
+def group_task_payload_builder(contract_name, row_groups, existing_contract_ids=None):
+    """Like task_payload_builder for grouped tasks, one contract with the billing term of every row in the group"""
+    build_row_payload = task_payload_builder(contract_name, existing_contract_ids)
+    def build_task_payload(group):
+        row_payloads = {str(position): build_row_payload(position) for position in row_groups[group]}
+        task_payload = dict(next(iter(row_payloads.values())))
+        del task_payload["billing_term_payload"]
+        task_payload["billing_term_payloads"] = {row_key: row_payload["billing_term_payload"] for row_key, row_payload in row_payloads.items()}
+        return task_payload
+    return build_task_payload
+
+def chunk_row_groups(row_groups, chunk_size):
+    """Whole groups per chunk, a chunk is closed once it has chunk_size rows so a customer is never split"""
+    chunks = [[]]
+    rows_in_chunk = 0
+    for positions in row_groups:
+        if rows_in_chunk >= chunk_size:
+            chunks.append([])
+            rows_in_chunk = 0
+        chunks[-1].append(positions)
+        rows_in_chunk += len(positions)
+    return chunks
+
+def bulk_task_payload_builder(contract_name, chunks, existing_contract_ids=None):
+    """Like task_payload_builder for bulk_invoice_chain, one task per chunk of row groups"""
+    build_row_payload = task_payload_builder(contract_name, existing_contract_ids)
+    merchant_name = st.session_state.merchant_name
+    merchant_link = st.session_state.merchant_link
+    def build_task_payload(chunk):
+        groups = []
+        for positions in chunks[chunk]:
+            row_payloads = {str(position): build_row_payload(position) for position in positions}
+            first_row_payload = next(iter(row_payloads.values()))
+            groups.append({
+                "customer_id": first_row_payload["customer_id"],
+                "existing_contract_id": first_row_payload.get("existing_contract_id"),
+                "billing_term_payloads": {row_key: row_payload["billing_term_payload"] for row_key, row_payload in row_payloads.items()},
+            })
+        return {"contract_name": contract_name, "groups": groups, "merchant_name": merchant_name, "merchant_link": merchant_link}
+    return build_task_payload
+
+def batch_payload_builder(contract_name, bulk_upload, grouped, row_groups, chunks, existing_contract_ids):
+    """The args factory of an invoice batch, built when the batch is created and again when it is resumed"""
+    if bulk_upload:
+        return bulk_task_payload_builder(contract_name, chunks, existing_contract_ids)
+    if grouped:
+        return group_task_payload_builder(contract_name, row_groups, existing_contract_ids)
+    return task_payload_builder(contract_name, existing_contract_ids)
+
+def values_per_row(values, row_groups, keyed=False, row_count=None):
+    """
+    Per task values (results, timings) back onto the source rows, a grouped task covers several rows.
+    With keyed=True a task value is a dict by row key (row position as a string), as bulk_invoice_chain returns.
+    Rows without a task (skipped) are None.
+    """
+    if row_groups is None:
+        return values
+    rows = [None] * (row_count if row_count is not None else sum(len(positions) for positions in row_groups))
+    for value, positions in zip(values, row_groups):
+        for position in positions:
+            rows[position] = value.get(str(position)) if keyed and isinstance(value, dict) else value
+    return rows
+
+def reconcile_invoices(batch_id):
+    """
+    Post-batch pass filling in the id, amount and status of the generated invoices. The invoices issued on the invoice
+    date are fetched in one paginated listing and joined to the rows in memory on the row's contract: the one its task
+    created or reused (checkpoints) or the processed one it was skipped for. Only rows without a contract fall back to
+    the customer, those matches are marked ambiguous. Returns how many rows got an invoice.
+    """
+    results = st.session_state.invoice_generation_results
+    row_count = len(results)
+    row_groups = st.session_state.invoice_row_groups
+    checkpoints = st.session_state.task_queue.get_batch_checkpoints(batch_id)
+    if st.session_state.invoice_bulk_upload:
+        contract_ids = values_per_row([checkpoint.get("row_contract_ids") or {} for checkpoint in checkpoints], row_groups, keyed=True, row_count=row_count)
+    else:
+        contract_ids = values_per_row([checkpoint.get("contract_id") for checkpoint in checkpoints], row_groups, row_count=row_count)
+    for position, skipped_row in st.session_state.invoice_skipped_rows.items():
+        contract_ids[position] = skipped_row["contract_id"]
+    matched_customers = st.session_state.matched_customers_for_usage_one_off_invoices
+    left_out_rows = {**st.session_state.invoice_invalid_rows, **st.session_state.invoice_review_rows}
+    # Rows left out by validation or for review have no invoice, they are kept out of the customer fallback
+    customer_ids = [
+        None if position in left_out_rows else matched_customers.get(customer_name, {}).get("customer_id")
+        for position, customer_name in enumerate(results["Rep Invoicing Tabs Customer Name"])
+    ]
+
+    issue_date = st.session_state.invoice_details_for_usage_one_off_invoices["invoice_date"].strftime("%Y-%m-%d")
+    invoices = get_invoices(get_all=True, issue_date_from=issue_date, issue_date_to=issue_date, limit=500)
+    matches = match_invoices_to_rows(invoices, contract_ids, customer_ids, issue_date=issue_date)
+    results["Invoice ID"] = [match["id"] if match else None for match in matches]
+    results["Invoice Amount"] = [match["amount"] if match else None for match in matches]
+    results["Invoice Status"] = [match["status"] if match else None for match in matches]
+    results["Invoice Match"] = [match["match"] if match else None for match in matches]
+    return sum(match is not None for match in matches)
+
 @st.dialog("Confirm invoice details", width="large")
 def confirm_invoice_details(invoice_date, product_name, product_description, revenue_category, integration_item):
     with st.container(border=True):
@@ -318,8 +512,9 @@ def invoice_upload_step(current_step, steps, render_object=st):
                 st.error(f"Missing required columns: {', '.join(missing_cols)}. Found columns: {', '.join(st.session_state.base_data_for_usage_one_off_invoices.columns.tolist())}")
                 st.stop()
             
-            st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Invoice Value"] = st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Invoice Value"].apply(clean_number)
-            st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Invoice Quantity"] = st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Invoice Quantity"].apply(clean_number)
+            # Values that are not numbers become NaN here, validate_invoice_rows reports them before anything is sent
+            st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Invoice Value"] = clean_numbers(st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Invoice Value"])
+            st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Invoice Quantity"] = clean_numbers(st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Invoice Quantity"])
         with st.spinner("Matching customer names to Tabs customers..."):
             unique_customer_names = st.session_state.base_data_for_usage_one_off_invoices["Rep Invoicing Tabs Customer Name"].unique()
             total_customers = len(unique_customer_names)
@@ -504,32 +699,108 @@ def generate_invoice_step(current_step, steps, render_object=st):
         if st.session_state.one_off_invoice_batch_id is not None:
             batch_stats = st.session_state.task_queue.get_batch_stats(st.session_state.one_off_invoice_batch_id)
             total = batch_stats.get("total", 0)
-            completed = batch_stats.get("completed", 0)
-            failed = batch_stats.get("failed", 0)
-            all_done = (completed + failed) == total and total > 0
+            all_done = count_done(batch_stats) == total and (total > 0 or bool(st.session_state.invoice_skipped_rows or st.session_state.invoice_invalid_rows or st.session_state.invoice_review_rows))
             invoices_already_generated = all_done and st.session_state.invoice_generation_results is not None
         elif st.session_state.invoice_generation_results is not None:
             invoices_already_generated = True
         
         invoice_details = st.session_state.invoice_details_for_usage_one_off_invoices
+        base_data = st.session_state.base_data_for_usage_one_off_invoices
+        invalid_rows = {}
+        if st.session_state.one_off_invoice_batch_id is None:
+            invalid_rows = validate_invoice_rows(base_data, st.session_state.matched_customers_for_usage_one_off_invoices)
+            if invalid_rows:
+                st.warning(f"**{len(invalid_rows)} of {len(base_data)} row(s) fail validation**, they are left out when the invoices are created", icon=":material/rule:")
+                with st.expander(f"Validation errors ({len(invalid_rows)})", icon=":material/error:"):
+                    validation_report = base_data.iloc[list(invalid_rows)].assign(**{"Validation Errors": list(invalid_rows.values())})
+                    st.dataframe(validation_report, hide_index=True, use_container_width=True)
         st.write("Configure the contract name and create the invoices")
-        cols = st.columns([3,1])
+        cols = st.columns([3,1,1])
         contract_name = cols[0].text_input("Contract name", value=f"Usage Credits for {invoice_details.get('invoice_date', None).strftime('%B %Y')}", label_visibility="collapsed")
-        create_invoice_button = cols[1].button("Create invoices", icon=":material/rocket_launch:", type="primary", use_container_width=True, disabled=invoices_already_generated)
+        with cols[1].popover("Run settings", icon=":material/tune:", use_container_width=True, disabled=invoices_already_generated):
+            st.toggle("One contract per customer", key="group_invoice_rows", help="Rows of the same customer share one contract with an obligation per row, and it is marked processed once. Otherwise every row gets its own contract")
+            st.toggle("Bulk upload large batches", key="invoice_bulk_upload_enabled", help="Upload the obligations through the bulk billing schedule endpoint, the ids it returns are checked against each row's contract before the contracts are marked processed")
+            st.number_input("Bulk upload from (rows)", min_value=1, step=100, key="invoice_bulk_threshold", disabled=not st.session_state.invoice_bulk_upload_enabled, help=f"With bulk upload on, batches with at least this many rows upload the obligations in files of {BULK_UPLOAD_CHUNK_SIZE} rows instead of one request per row")
+            st.toggle("Pipeline the invoice steps", key="pipeline_invoice_steps", help="Run create contract, create obligation and mark as processed as separate stages so rows overlap, instead of one row at a time per worker")
+            st.number_input("Row timeout (seconds)", min_value=0, step=30, key="invoice_row_timeout", help="A row still running after this long is failed at its next step or request, 0 means no limit. Bulk uploads have no limit")
+            st.number_input("Attempts per row", min_value=1, max_value=10, key="invoice_row_attempts", help="A failed row runs again from the last step it completed, with a growing pause in between")
+            st.toggle("Retry any error", key="invoice_retry_all_errors", help="Only connection errors, timeouts and exhausted rate limits are retried unless this is on. A create request that got no response is never retried, it may have gone through")
+        create_invoice_button = cols[2].button("Create invoices", icon=":material/rocket_launch:", type="primary", use_container_width=True, disabled=invoices_already_generated or len(invalid_rows) == len(base_data))
 
 
         if create_invoice_button:
-            st.session_state.task_queue = TaskQueue(api_key=st.session_state.tabs_api_token, backend_url=st.session_state.backend_url, num_workers=st.session_state.max_allowed_threads)
+            # One queue per session, earlier batches keep their results and no workers are left behind
+            session_task_queue()
             st.session_state.one_off_invoice_batch_id = f"bulk_action_WORKFLOW_CREATE_INVOICES_{create_time_stamp()}"
             copy_of_base_data_for_usage_one_off_invoices = st.session_state.base_data_for_usage_one_off_invoices.copy()
             st.session_state.invoice_generation_results = copy_of_base_data_for_usage_one_off_invoices
-            for index, row in st.session_state.base_data_for_usage_one_off_invoices.iterrows():
-                task_payload = generate_task_payload_for_row(row, contract_name)
-                st.session_state.task_queue.add_task(
+            row_count = len(st.session_state.base_data_for_usage_one_off_invoices)
+            grouped = st.session_state.group_invoice_rows
+            task_groups = group_rows_by_customer(st.session_state.base_data_for_usage_one_off_invoices) if grouped else [[position] for position in range(row_count)]
+            # Rows failing validation never reach the API, a customer's group keeps its valid rows
+            invalid_rows = validate_invoice_rows(st.session_state.base_data_for_usage_one_off_invoices, st.session_state.matched_customers_for_usage_one_off_invoices)
+            if invalid_rows:
+                task_groups = [valid_positions for valid_positions in ([position for position in positions if position not in invalid_rows] for positions in task_groups) if valid_positions]
+            with st.spinner("Checking for existing contracts"):
+                task_groups, existing_contract_ids, skipped_rows, review_rows = match_existing_contracts(contract_name, task_groups)
+            if skipped_rows:
+                st.toast(f"{len(skipped_rows)} row(s) already have a processed contract named {contract_name}, they are skipped")
+            if review_rows:
+                st.toast(f"{len(review_rows)} row(s) match more than one existing contract named {contract_name}, they are held back for review", icon=":material/warning:")
+            bulk_upload = st.session_state.invoice_bulk_upload_enabled and sum(len(positions) for positions in task_groups) >= st.session_state.invoice_bulk_threshold
+            if bulk_upload:
+                chunks = chunk_row_groups(task_groups, BULK_UPLOAD_CHUNK_SIZE) if task_groups else []
+                row_groups = [[position for positions in chunk for position in positions] for chunk in chunks]
+            elif grouped or skipped_rows or invalid_rows or review_rows:
+                row_groups = task_groups
+            else:
+                # Every row is its own task, results already line up with the rows
+                row_groups = None
+            st.session_state.invoice_row_groups = row_groups
+            st.session_state.invoice_bulk_upload = bulk_upload
+            st.session_state.invoice_skipped_rows = skipped_rows
+            st.session_state.invoice_invalid_rows = invalid_rows
+            st.session_state.invoice_review_rows = review_rows
+            st.session_state.task_queue.register_batch(st.session_state.one_off_invoice_batch_id, meta={
+                "backend_url": st.session_state.backend_url,
+                "merchant_name": st.session_state.merchant_name,
+                "contract_name": contract_name,
+                "rows": st.session_state.base_data_for_usage_one_off_invoices.to_dict("records"),
+                "matched_customers": st.session_state.matched_customers_for_usage_one_off_invoices,
+                "invoice_details": invoice_details,
+                "row_groups": row_groups,
+                "bulk_upload": bulk_upload,
+                "grouped": grouped,
+                "chunks": chunks if bulk_upload else None,
+                "existing_contract_ids": existing_contract_ids,
+                "skipped_rows": skipped_rows,
+                "invalid_rows": invalid_rows,
+                "review_rows": review_rows,
+            }, retry_policy=TaskRetryPolicy(max_attempts=st.session_state.invoice_row_attempts, retry_all_errors=st.session_state.invoice_retry_all_errors))
+            if bulk_upload:
+                st.session_state.task_queue.add_tasks(
+                    function=bulk_invoice_chain,
+                    sources=range(len(chunks)),
+                    batch_id=st.session_state.one_off_invoice_batch_id,
+                    build_args=batch_payload_builder(contract_name, bulk_upload, grouped, row_groups, chunks, existing_contract_ids)
+                )
+            elif not grouped:
+                st.session_state.task_queue.add_tasks(
                     function=one_off_invoice_chain,
-                    args=task_payload,
+                    sources=[positions[0] for positions in task_groups],
                     batch_id=st.session_state.one_off_invoice_batch_id,
-                    throttle_time=1
+                    build_args=batch_payload_builder(contract_name, bulk_upload, grouped, row_groups, None, existing_contract_ids),
+                    stages=ONE_OFF_INVOICE_STAGES if st.session_state.pipeline_invoice_steps else None,
+                    timeout=st.session_state.invoice_row_timeout or None
+                )
+            else:
+                st.session_state.task_queue.add_tasks(
+                    function=grouped_invoice_chain,
+                    sources=range(len(row_groups)),
+                    batch_id=st.session_state.one_off_invoice_batch_id,
+                    build_args=batch_payload_builder(contract_name, bulk_upload, grouped, row_groups, None, existing_contract_ids),
+                    stages=GROUPED_INVOICE_STAGES if st.session_state.pipeline_invoice_steps else None,
+                    timeout=st.session_state.invoice_row_timeout or None
                 )
             st.session_state.task_queue.start_processing()
             st.session_state.tabs_icon = "🚧"
@@ -542,30 +813,87 @@ def generate_invoice_step(current_step, steps, render_object=st):
             total = batch_stats.get("total", 0)
             completed = batch_stats.get("completed", 0)
             failed = batch_stats.get("failed", 0)
+            cancelled = batch_stats.get("cancelled", 0)
             pending = batch_stats.get("pending", 0)
             running = batch_stats.get("running", 0)
+            done = count_done(batch_stats)
             
             # Check if all tasks are done
             is_processing = st.session_state.task_queue.processing
-            all_done = (completed + failed) == total and total > 0
+            all_done = done == total and (total > 0 or bool(st.session_state.invoice_skipped_rows or st.session_state.invoice_invalid_rows or st.session_state.invoice_review_rows))
             
             # Show simple progress bar
-            progress_value = (completed + failed) / total if total > 0 else 0
-            progress_text = f"{completed + failed}/{total} invoices processed"
+            progress_value = done / total if total > 0 else 0
+            progress_text = f"{done}/{total} bulk upload chunks processed" if st.session_state.invoice_bulk_upload else f"{done}/{total} invoices processed"
             
             st.progress(progress_value, text=progress_text)
+            if not all_done and (pending + running) > 0:
+                if st.button("Cancel remaining invoices", icon=":material/cancel:", use_container_width=True):
+                    outcome = st.session_state.task_queue.cancel_batch(st.session_state.one_off_invoice_batch_id, reason="cancelled by user")
+                    st.toast(f"Cancelled {outcome['cancelled']} waiting invoice(s), {outcome['cancel_requested']} running invoice(s) stop after their current request")
+                    st.rerun()
+                if cancelled > 0:
+                    # Rows asked to stop while running end up here only if they did stop, the others complete or fail
+                    st.caption(f"{cancelled} invoice(s) cancelled so far, {running} still running")
             
             # Show completion message when done
             if all_done:
-                if failed == 0:
+                if failed == 0 and cancelled == 0:
                     st.success(f"✅ **All {completed} invoice(s) generated successfully!**", icon=":material/check_circle:")
-                else:
+                elif cancelled == 0:
                     st.warning(f"⚠️ **Completed:** {completed} succeeded, {failed} failed", icon=":material/warning:")
+                else:
+                    st.warning(f"⚠️ **Completed:** {completed} succeeded, {failed} failed, {cancelled} cancelled", icon=":material/warning:")
+                if st.session_state.invoice_invalid_rows:
+                    st.info(f"{len(st.session_state.invoice_invalid_rows)} row(s) failed validation and were not submitted, see **Validation Errors** in the results", icon=":material/rule:")
+                if st.session_state.invoice_review_rows:
+                    st.warning(f"{len(st.session_state.invoice_review_rows)} row(s) were not submitted because more than one existing contract could be theirs, see **Needs Review** in the results", icon=":material/manage_search:")
+                if failed > 0:
+                    dead_letters = st.session_state.task_queue.get_dead_letters(st.session_state.one_off_invoice_batch_id)
+                    with st.expander(f"Failed rows ({len(dead_letters)})", icon=":material/error:"):
+                        st.dataframe(pd.DataFrame(dead_letters), hide_index=True, use_container_width=True)
+                    if st.button(f"Retry {failed} failed row(s)", icon=":material/replay:", use_container_width=True):
+                        # Only the failed rows run again, each continues after the last step it completed
+                        st.session_state.task_queue.retry_dead_letters(st.session_state.one_off_invoice_batch_id)
+                        st.session_state.invoice_reconciled_batch_id = None
+                        st.session_state.task_queue.start_processing()
+                        st.session_state.tabs_icon = "🚧"
+                        st.rerun()
             
             # Get results and update session state
             results = st.session_state.task_queue.get_batch_results(st.session_state.one_off_invoice_batch_id)
-            if results and len(results) > 0:
-                st.session_state.invoice_generation_results["Invoice Link"] = results
+            skipped_rows = st.session_state.invoice_skipped_rows
+            invalid_rows = st.session_state.invoice_invalid_rows
+            review_rows = st.session_state.invoice_review_rows
+            if results or skipped_rows or invalid_rows or review_rows:
+                row_groups = st.session_state.invoice_row_groups
+                row_count = len(st.session_state.invoice_generation_results)
+                invoice_links = values_per_row(results, row_groups, keyed=st.session_state.invoice_bulk_upload, row_count=row_count)
+                for position, skipped_row in skipped_rows.items():
+                    invoice_links[position] = skipped_row["invoice_link"]
+                st.session_state.invoice_generation_results["Invoice Link"] = invoice_links
+                if invalid_rows:
+                    st.session_state.invoice_generation_results["Validation Errors"] = [invalid_rows.get(position) for position in range(row_count)]
+                if review_rows:
+                    st.session_state.invoice_generation_results["Needs Review"] = [review_rows.get(position) for position in range(row_count)]
+                # Per row timings go into the exported results, rows of a grouped task share its timings
+                row_timings = values_per_row(st.session_state.task_queue.get_batch_timings(st.session_state.one_off_invoice_batch_id), row_groups, row_count=row_count)
+                timings = pd.DataFrame([row_timing or {} for row_timing in row_timings], index=st.session_state.invoice_generation_results.index)
+                for column in timings.columns:
+                    st.session_state.invoice_generation_results[column] = timings[column]
+            if all_done and (completed > 0 or skipped_rows):
+                # Invoices can take a moment to appear after a contract is processed, the refresh fetches them again
+                reconcile_now = st.session_state.invoice_reconciled_batch_id != st.session_state.one_off_invoice_batch_id
+                if not reconcile_now:
+                    reconcile_now = st.button("Refresh invoice details", icon=":material/sync:", use_container_width=True)
+                if reconcile_now:
+                    with st.spinner("Fetching the generated invoices"):
+                        matched = reconcile_invoices(st.session_state.one_off_invoice_batch_id)
+                    st.session_state.invoice_reconciled_batch_id = st.session_state.one_off_invoice_batch_id
+                    submitted_rows = len(st.session_state.invoice_generation_results) - len(invalid_rows) - len(review_rows)
+                    if matched < submitted_rows:
+                        st.toast(f"Invoice found for {matched} of {submitted_rows} row(s), refresh once the rest are generated", icon=":material/info:")
+            batch_metrics_panel(st.session_state.one_off_invoice_batch_id)
             
             # Update completion status
             invoices_already_generated = all_done
@@ -588,6 +916,65 @@ def generate_invoice_step(current_step, steps, render_object=st):
 
 
 
+def resume_batch_panel(render_object=st):
+    """
+    Offer to resume batches left unfinished in the task store, e.g. after a restart or an expired session.
+    Only batches of the current backend and API key are listed, one still running in another session cannot be resumed.
+    """
+    task_queue = st.session_state.task_queue
+    if task_queue.store is None or task_queue.processing:
+        return
+    resumable = []
+    for batch in task_queue.store.list_unfinished_batches(task_queue.owner):
+        if batch["batch_id"] in task_queue.batches:
+            continue
+        meta = task_queue.store.get_batch_meta(batch["batch_id"]) or {}
+        resumable.append((batch, meta))
+    if not resumable:
+        return
+    with render_object.container(border=True):
+        st.warning(f"**{len(resumable)} unfinished batch(es) found**, resume to continue where they stopped", icon=":material/history:")
+        for batch, meta in resumable:
+            cols = st.columns([3,1])
+            cols[0].write(f"**{meta.get('contract_name')}** ({meta.get('merchant_name')}) · {batch['done']}/{batch['total']} rows done · `{batch['batch_id']}`")
+            if batch["leased"]:
+                cols[1].caption("Running in another session")
+            elif cols[1].button("Resume", key=f"resume_{batch['batch_id']}", icon=":material/play_arrow:", use_container_width=True):
+                if resume_batch(batch["batch_id"], meta):
+                    st.rerun()
+
+def resume_batch(batch_id, meta):
+    """Rebuild the page state of a stored batch and run its unfinished rows, False if the batch cannot be taken over"""
+    try:
+        st.session_state.task_queue.resume_batch(batch_id)
+    except ValueError as e:
+        st.error(str(e), icon=":material/lock:")
+        return False
+    base_data = pd.DataFrame(meta["rows"])
+    invoice_details = meta["invoice_details"]
+    for key in ("start_date", "end_date", "invoice_date"):
+        if invoice_details.get(key):
+            invoice_details[key] = datetime.fromisoformat(invoice_details[key])
+    st.session_state.base_data_for_usage_one_off_invoices = base_data
+    st.session_state.matched_customers_for_usage_one_off_invoices = meta["matched_customers"]
+    st.session_state.all_customers_have_net_terms = True
+    st.session_state.invoice_details_for_usage_one_off_invoices = invoice_details
+    st.session_state.invoice_generation_results = base_data.copy()
+    st.session_state.one_off_invoice_batch_id = batch_id
+    st.session_state.invoice_row_groups = meta.get("row_groups")
+    st.session_state.invoice_bulk_upload = meta.get("bulk_upload", False)
+    # JSON keys are strings
+    st.session_state.invoice_skipped_rows = {int(position): skipped_row for position, skipped_row in (meta.get("skipped_rows") or {}).items()}
+    st.session_state.invoice_invalid_rows = {int(position): error for position, error in (meta.get("invalid_rows") or {}).items()}
+    st.session_state.invoice_review_rows = {int(position): reason for position, reason in (meta.get("review_rows") or {}).items()}
+    st.session_state.invoice_reconciled_batch_id = None
+    # Only the task sources are stored, the factory is rebuilt from the meta and the session state set above
+    existing_contract_ids = {int(position): contract_id for position, contract_id in (meta.get("existing_contract_ids") or {}).items()}
+    st.session_state.task_queue.set_args_factory(batch_id, batch_payload_builder(meta["contract_name"], meta.get("bulk_upload", False), meta.get("grouped", False), meta.get("row_groups"), meta.get("chunks"), existing_contract_ids))
+    st.session_state.task_queue.start_processing()
+    st.session_state.tabs_icon = "🚧"
+    return True
+
 def usage_one_off_invoices_page():
     
     # Initialize session state first
@@ -672,6 +1059,7 @@ def usage_one_off_invoices_page():
                 st.write(f"Step {i}: {step_name}")
     
     st.divider()
+    resume_batch_panel()
     
     # Help & Controls in sidebar
     st.sidebar.markdown("### Help & Controls")
@@ -689,6 +1077,8 @@ def usage_one_off_invoices_page():
     if refresh_from_db:
         app_specific_session_state(refresh_from_db=True)
         st.rerun()
+    concurrency_panel(render_object=st.sidebar)
+    worker_pool_panel(render_object=st.sidebar)
 
 
     if current_step == 1:
@@ -1,10 +1,15 @@
 import streamlit as st
+import pandas as pd
 from api.main import check_valid_token
 from functools import wraps
 import shutil
 import os
 import random
-from helper.task_queue import TaskQueue
+from helper.task_queue import TaskQueue, count_done
+from helper.rate_limiter import configure_rate_limit
+from helper.request_log import RequestLogStore, REQUEST_HISTORY_CAPACITY
+from helper.metrics import metrics
+from helper.data_helpers import dwnload_component
 import time
 from helper.logger import print_logger
 
@@ -149,7 +154,8 @@ def get_app_feature_flags():
     st.session_state.simple_auth = eval_bool_env_var("SIMPLE_AUTH", False)                                       # If True, the simple auth will be enabled. It will only require a username and password to access the app.
     st.session_state.password = get_env_var("PASSWORD")
     st.session_state.page_title = get_env_var("PAGE_TITLE", "Tabs Internal Tool")
-    st.session_state.max_allowed_threads = int(os.getenv("DEFAULT_THREADS", 1))
+    st.session_state.max_allowed_threads = int(os.getenv("DEFAULT_THREADS", 8))                                  # Ceiling for the adaptive concurrency controller
+    st.session_state.requests_per_second = float(os.getenv("DEFAULT_REQUESTS_PER_SECOND", 10))
 
     print_logger("=============== APP FEATURE FLAGS ==================")
     print_logger(f"Salesforce page enabled: {st.session_state.salesforce_page_enabled}")
@@ -265,15 +271,13 @@ def initialize_core_session_state(force=False,environment=None):
     if "tabs_icon" not in st.session_state:
         st.session_state.tabs_icon = NOS_LOGO
     if "request_history" not in st.session_state or force:
-        st.session_state.request_history = []
+        st.session_state.request_history = RequestLogStore(capacity=REQUEST_HISTORY_CAPACITY, indexed=True)
     if "max_allowed_threads" not in st.session_state:
-        st.session_state.max_allowed_threads = 1
+        st.session_state.max_allowed_threads = 8
+    if "requests_per_second" not in st.session_state:
+        st.session_state.requests_per_second = 10
     if "task_queue" not in st.session_state or force:
-        st.session_state.task_queue = TaskQueue(
-            api_key=st.session_state.tabs_api_token, 
-            backend_url=st.session_state.backend_url,
-            num_workers=st.session_state.max_allowed_threads
-        )
+        session_task_queue(replace=force)
     
     if "first_run" not in st.session_state:
         st.session_state.first_run = True
@@ -444,11 +448,12 @@ def control_panel(render_object=st.sidebar):
 
         # Pending tasks in the queue
         is_running = st.session_state.task_queue.processing
-        pending_tasks = st.session_state.task_queue.pending_tasks
-        total_tasks = st.session_state.task_queue.task_size
-        completed_tasks = st.session_state.task_queue.completed_tasks
-        failed_tasks = st.session_state.task_queue.failed_tasks
-        done_tasks = completed_tasks + failed_tasks
+        progress = st.session_state.task_queue.progress()
+        pending_tasks = progress["pending"]
+        total_tasks = progress["total"]
+        completed_tasks = progress["completed"]
+        failed_tasks = progress["failed"]
+        done_tasks = count_done(progress)
         if total_tasks == 0:
             done_percentage = 0
             success_percentage = 0
@@ -466,6 +471,8 @@ def control_panel(render_object=st.sidebar):
         if "developer_settings_enabled" in st.session_state:
             if st.session_state.developer_settings_enabled:
                 st.write(f"Threads: `{st.session_state.max_allowed_threads}`")
+        concurrency_panel(render_object=st)
+        worker_pool_panel(render_object=st, key="control_panel_worker_pool")
 
         st.session_state.global_progress_bar = st.empty()
 
@@ -483,7 +490,8 @@ def control_panel(render_object=st.sidebar):
             st.rerun()
         if stop_button:
             with st.spinner("Stopping task queue"):
-                st.session_state.task_queue.stop_processing()
+                # Rows already running finish in the background, the page does not wait for them
+                st.session_state.task_queue.stop_processing(mode="abort", wait=False)
             with st.spinner("Syncing request history"):
                 sync_request_history()
             st.session_state.tabs_icon = "🟠"
@@ -500,13 +508,96 @@ def control_panel(render_object=st.sidebar):
     
 
 
+def session_task_queue(replace=False):
+    """
+    The session's TaskQueue for the current API key and backend. The existing queue is reused and follows the
+    worker and rate settings, a queue for another key or backend (or replace=True) is stopped before it is replaced
+    so its workers and sessions do not leak.
+    """
+    task_queue = st.session_state.get("task_queue")
+    api_key = st.session_state.tabs_api_token
+    backend_url = st.session_state.backend_url
+    if task_queue is not None and not replace and task_queue.tabs_api_token == api_key and task_queue.backend_url == backend_url:
+        if task_queue.num_workers != st.session_state.max_allowed_threads:
+            task_queue.resize_workers(st.session_state.max_allowed_threads)
+        if st.session_state.requests_per_second:
+            configure_rate_limit(backend_url, api_key, st.session_state.requests_per_second)
+        return task_queue
+    if task_queue is not None:
+        task_queue.stop_processing(mode="abort", wait=False)
+    st.session_state.task_queue = TaskQueue(
+        api_key=api_key,
+        backend_url=backend_url,
+        num_workers=st.session_state.max_allowed_threads,
+        requests_per_second=st.session_state.requests_per_second
+    )
+    return st.session_state.task_queue
+
+def concurrency_panel(render_object=st.sidebar):
+    concurrency = st.session_state.task_queue.concurrency.snapshot()
+    with render_object.expander(f"Concurrency: {concurrency['limit']}/{concurrency['max_limit']}", icon=":material/speed:"):
+        cols = st.columns(2)
+        cols[0].metric("Current limit", concurrency["limit"], help="Tasks allowed to run at once, raised while the backend is healthy and cut on 429s or rising latency")
+        cols[1].metric("In flight", concurrency["in_flight"])
+        if concurrency["latencies"]:
+            latencies = pd.DataFrame(
+                [(endpoint, ewma, baseline) for endpoint, (ewma, baseline) in concurrency["latencies"].items()],
+                columns=["endpoint", "latency", "baseline"])
+            st.caption("Seconds per endpoint, the limit is cut when an endpoint runs over its own baseline")
+            st.dataframe(latencies.round(3), hide_index=True, use_container_width=True)
+        history = pd.DataFrame(concurrency["history"], columns=["timestamp", "limit", "reason"])
+        if len(history) > 1:
+            history["timestamp"] = pd.to_datetime(history["timestamp"], unit="s")
+            st.line_chart(history, x="timestamp", y="limit", height=150)
+            st.dataframe(history.iloc[::-1], hide_index=True, use_container_width=True, height=150)
+
+def batch_metrics_panel(batch_id, render_object=st):
+    batch_metrics = metrics.get(batch_id)
+    with render_object.expander("Performance", icon=":material/timer:"):
+        throughput = batch_metrics.throughput()
+        cols = st.columns(3)
+        cols[0].metric("Rows/sec", f"{throughput:.2f}" if throughput is not None else "-")
+        cols[1].metric("Rows done", batch_metrics.rows_done)
+        cols[2].metric("Rows failed", batch_metrics.rows_failed)
+        stages = pd.DataFrame(st.session_state.task_queue.get_stage_stats())
+        if len(stages) > 0:
+            st.caption("Pipeline stages, the stage with rows piling up in `ready` is the bottleneck")
+            st.dataframe(stages, hide_index=True, use_container_width=True)
+        summary = pd.DataFrame(batch_metrics.summary())
+        if len(summary) == 0:
+            st.caption("No timings recorded yet")
+            return
+        st.caption("Seconds per HTTP call (wait = rate limiter), chain step, pipeline stage (wait = time ready) and task (wait = time queued)")
+        st.dataframe(summary.round(3), hide_index=True, use_container_width=True)
+        dwnload_component(
+            df=pd.DataFrame(batch_metrics.report()).round(3),
+            label="Download performance summary",
+            file_name="performance_summary",
+            type="secondary",
+            icon=":material/download:", use_container_width=True, render_object=st)
+
+def worker_pool_panel(render_object=st.sidebar, key="worker_pool"):
+    task_queue = st.session_state.task_queue
+    with render_object.container(border=False):
+        cols = st.columns([2,1])
+        workers = cols[0].number_input("Workers", min_value=1, max_value=64, value=task_queue.num_workers, step=1, key=f"{key}_size", help="Resize the worker pool, also while a batch is running. Surplus workers retire after the row they are on, no progress is lost")
+        cols[1].write(" ")
+        if cols[1].button("Apply", icon=":material/tune:", use_container_width=True, disabled=workers == task_queue.num_workers, key=f"{key}_apply"):
+            task_queue.resize_workers(workers)
+            # Queues created for the next batch use the same size
+            st.session_state.max_allowed_threads = workers
+            st.toast(f"Worker pool resized to {workers}")
+            st.rerun()
+
 @st.fragment(run_every=1)
 def update_task_queue():
-    total_tasks = st.session_state.task_queue.task_size
-    pending_tasks = st.session_state.task_queue.pending_tasks
-    done_tasks = st.session_state.task_queue.completed_tasks + st.session_state.task_queue.failed_tasks
+    progress = st.session_state.task_queue.progress()
+    total_tasks = progress["total"]
+    pending_tasks = progress["pending"]
+    done_tasks = count_done(progress)
     is_running = st.session_state.task_queue.processing
-    no_tasks_left = pending_tasks == 0
+    # Rows between pipeline stages or waiting out a backoff are running, only stop once every row is done
+    no_tasks_left = done_tasks == total_tasks
     if total_tasks == 0:
         done_percentage = 0
     else:
@@ -523,28 +614,18 @@ def update_task_queue():
         st.session_state.tabs_icon = "✅"
         if st.session_state.bulk_gifs:
             st.balloons()
-        st.session_state.task_queue.stop_processing()
+        st.session_state.task_queue.stop_processing(mode="drain", wait=True, timeout=5)
         st.rerun()
 
 def sync_request_history():
     st.toast("Updating request history")
-    for task in st.session_state.task_queue.tasks:
-        if st.session_state.task_queue.tasks[task].request_logs is not None:
-            for request_log_i in st.session_state.task_queue.tasks[task].request_logs:
-                found_hash = request_log_i.get("hash", None)
-                already_synced = False
-                checked_hashes = []
-                for request_log in st.session_state.request_history:
-                    if request_log is None:
-                        request_log = {}
-                    request_log_hash = request_log.get("hash", None)
-                    checked_hashes.append(request_log_hash)
-                    if request_log_hash == found_hash and found_hash is not None:
-                        already_synced = True
-                if not already_synced:
-                    st.session_state.request_history.append(request_log_i)
-                if already_synced:
-                    pass
+    # Only the logs appended since the last sync are read, the indexed history drops anything already synced
+    new_request_logs = st.session_state.task_queue.drain_new_request_logs()
+    synced = 0
+    for request_log in new_request_logs:
+        if st.session_state.request_history.append(request_log):
+            synced += 1
+    print_logger(f"Synced {synced} request logs into the request history")
 
 
 @token_required
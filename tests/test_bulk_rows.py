@@ -0,0 +1,191 @@
+import io
+
+import pandas as pd
+import pytest
+
+from api import chains
+from api.tools import billing_term_payload_to_bulk_row, create_obligation_payload, BILLING_TYPES_BY_SCHEDULE
+from helper.task_queue import Task
+
+
+def obligation_row(**values):
+    row = {
+        "revenue_start_date": "2026-01-01",
+        "revenue_end_date": "2026-01-31",
+        "revenue_product_id": "category-1",
+        "name": "Usage Credits",
+        "note": "January usage",
+        "invoice_date": "2026-01-31",
+        "duration": 1,
+        "invoiceDateStrategy": "LAST_OF_PERIOD",
+        "is_recurring": True,
+        "due_interval_unit": "MONTH",
+        "due_interval": 1,
+        "net_payment_terms": 30,
+        "quantity": 3,
+        "billing_type": "FLAT_PRICE",
+        "is_volume": False,
+        "event_to_track": None,
+        "integration_item_id": "item-1",
+        "invoice_type": "INVOICE",
+        "classId": None,
+        "amount_1": 100,
+        "value_1": 0,
+        "amount_2": 80,
+        "value_2": 10,
+    }
+    row.update(values)
+    return row
+
+
+@pytest.mark.parametrize("billing_type", ["FLAT_PRICE", "UNIT_PRICE", "TIER_FLAT_PRICE", "TIER_UNIT_PRICE"])
+@pytest.mark.parametrize("is_volume", [False, True])
+@pytest.mark.parametrize("timing", [{"is_arrears": True}, {"is_arrears": False}, {}])
+def test_bulk_row_round_trips_every_billing_type(billing_type, is_volume, timing):
+    row = obligation_row(billing_type=billing_type, is_volume=is_volume, **timing)
+    if "is_arrears" in timing:
+        del row["invoiceDateStrategy"]
+    payload = create_obligation_payload(row)
+
+    bulk_row = billing_term_payload_to_bulk_row(payload, "contract-1")
+
+    assert bulk_row["contract_id"] == "contract-1"
+    assert create_obligation_payload(bulk_row) == payload
+
+
+def test_bulk_row_keeps_discount_and_optional_fields():
+    row = obligation_row(event_to_track="event-1", classId="class-1", discount_type="PERCENTAGE", discount_amount=10, discount_note="Loyalty")
+    payload = create_obligation_payload(row)
+
+    assert create_obligation_payload(billing_term_payload_to_bulk_row(payload, "contract-1")) == payload
+
+
+def test_every_schedule_type_maps_back_to_one_billing_type():
+    assert BILLING_TYPES_BY_SCHEDULE == {
+        ("FLAT", "SIMPLE"): ("FLAT_PRICE", False),
+        ("UNIT", "SIMPLE"): ("UNIT_PRICE", False),
+        ("FLAT", "TIERED"): ("TIER_FLAT_PRICE", False),
+        ("FLAT", "VOLUME"): ("TIER_FLAT_PRICE", True),
+        ("UNIT", "TIERED"): ("TIER_UNIT_PRICE", False),
+        ("UNIT", "VOLUME"): ("TIER_UNIT_PRICE", True),
+    }
+
+
+def test_bulk_row_rejects_unknown_billing_type():
+    payload = create_obligation_payload(obligation_row())
+    payload["billingSchedule"]["pricingType"] = "GRADUATED"
+
+    with pytest.raises(Exception, match="Invalid billing type"):
+        billing_term_payload_to_bulk_row(payload, "contract-1")
+
+
+CONTRACT_OBLIGATIONS = {"contract-a": [{"id": "bt-1"}], "contract-b": [{"id": "bt-2"}, {"id": "bt-3"}]}
+
+
+def test_verify_bulk_ids_maps_ids_on_the_row_contract():
+    row_contract_ids = {"0": "contract-a", "1": "contract-b", "2": "contract-b"}
+
+    mapped = chains.verify_bulk_billing_term_ids(["0", "1", "2"], ["bt-1", "bt-2", "bt-3"], row_contract_ids, CONTRACT_OBLIGATIONS)
+
+    assert mapped == {"0": "bt-1", "1": "bt-2", "2": "bt-3"}
+
+
+def test_verify_bulk_ids_fails_when_an_id_is_on_another_contract():
+    row_contract_ids = {"0": "contract-a", "1": "contract-b"}
+
+    with pytest.raises(Exception, match="not on the contract of 2 row"):
+        chains.verify_bulk_billing_term_ids(["0", "1"], ["bt-2", "bt-1"], row_contract_ids, CONTRACT_OBLIGATIONS)
+
+
+@pytest.mark.parametrize("billing_term_ids", [["bt-1"], ["bt-2", "bt-2"]])
+def test_verify_bulk_ids_fails_when_ids_cannot_be_paired(billing_term_ids):
+    row_contract_ids = {"0": "contract-b", "1": "contract-b"}
+
+    with pytest.raises(Exception, match="billing term ids"):
+        chains.verify_bulk_billing_term_ids(["0", "1"], billing_term_ids, row_contract_ids, CONTRACT_OBLIGATIONS)
+
+
+class FakeBulkBackend:
+    """Contracts and obligations created through the bulk chain, the upload fails `failures` times before it succeeds"""
+
+    def __init__(self, monkeypatch, failures=0):
+        self.failures = failures
+        self.uploads = []
+        self.listings = 0
+        self.obligations = []
+        self.processed = []
+        monkeypatch.setattr(chains, "create_contract", lambda customer_id, contract_name, task=None: f"contract-{customer_id}")
+        monkeypatch.setattr(chains, "bulk_upload_billing_schedule", self.upload)
+        monkeypatch.setattr(chains, "iter_contract_obligations", self.list_obligations)
+        monkeypatch.setattr(chains, "mark_contract_as_processed", lambda contract_id, task=None: self.processed.append(contract_id) or {"success": True})
+        monkeypatch.setattr(chains, "invoices_for_customer_and_contract_name", lambda customer_id, contract_name, merchant_link=None: f"link-{customer_id}")
+
+    def upload(self, files, merchant_name, task=None):
+        rows = pd.read_csv(io.BytesIO(files["file"][1]))
+        self.uploads.append(len(rows))
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Bulk billing schedule upload returned 500: internal error")
+        ids = []
+        for row in rows.to_dict("records"):
+            obligation = create_obligation_payload(row)
+            obligation.update(id=f"bt-{len(self.obligations) + 1}", contractId=row["contract_id"])
+            self.obligations.append(obligation)
+            ids.append(obligation["id"])
+        return ids
+
+    def list_obligations(self, contract_name=None, created_from=None, task=None):
+        self.listings += 1
+        return list(self.obligations)
+
+
+def bulk_groups():
+    return [
+        {"customer_id": "a", "billing_term_payloads": {"0": create_obligation_payload(obligation_row(quantity=1))}},
+        {"customer_id": "b", "billing_term_payloads": {"1": create_obligation_payload(obligation_row(quantity=2)), "2": create_obligation_payload(obligation_row(quantity=3))}},
+    ]
+
+
+def test_failed_bulk_upload_is_uploaded_again_on_retry(monkeypatch):
+    backend = FakeBulkBackend(monkeypatch, failures=1)
+    task = Task(function=chains.bulk_invoice_chain, args=None, batch_id="batch")
+
+    with pytest.raises(Exception, match="returned 500"):
+        chains.bulk_invoice_chain("January", bulk_groups(), "merchant", task=task)
+    assert "obligation_ids" not in task.checkpoint
+    assert backend.processed == []
+
+    links = chains.bulk_invoice_chain("January", bulk_groups(), "merchant", task=task)
+
+    assert backend.uploads == [3, 3]
+    assert task.checkpoint["obligation_ids"] == {"0": "bt-1", "1": "bt-2", "2": "bt-3"}
+    assert backend.processed == ["contract-a", "contract-b"]
+    assert links == {"0": "link-a", "1": "link-b", "2": "link-b"}
+
+
+def test_rerun_after_an_unverified_upload_only_uploads_the_missing_rows(monkeypatch):
+    backend = FakeBulkBackend(monkeypatch)
+    task = Task(function=chains.bulk_invoice_chain, args=None, batch_id="batch")
+    upload = backend.upload
+
+    def upload_dropping_an_id(files, merchant_name, task=None):
+        # The rows are created but one id is missing from the response
+        return upload(files, merchant_name, task=task)[:-1]
+    monkeypatch.setattr(chains, "bulk_upload_billing_schedule", upload_dropping_an_id)
+    with pytest.raises(Exception, match="2 billing term ids"):
+        chains.bulk_invoice_chain("January", bulk_groups(), "merchant", task=task)
+    monkeypatch.setattr(chains, "bulk_upload_billing_schedule", upload)
+
+    chains.bulk_invoice_chain("January", bulk_groups(), "merchant", task=task)
+
+    assert backend.uploads == [3]
+    assert task.checkpoint["obligation_ids"] == {"0": "bt-1", "1": "bt-2", "2": "bt-3"}
+    assert backend.processed == ["contract-a", "contract-b"]
+
+
+def test_bulk_verification_lists_the_chunk_once(monkeypatch):
+    backend = FakeBulkBackend(monkeypatch)
+
+    chains.bulk_invoice_chain("January", bulk_groups(), "merchant")
+
+    assert backend.listings == 1
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from helper.cancellation import CancellationToken, TaskCancelled, TaskDeadlineExceeded, check_cancelled
+from helper.task_queue import TaskQueue
+
+
+def test_token_raises_with_the_first_reason():
+    token = CancellationToken()
+    token.raise_if_cancelled()
+
+    token.cancel("cancelled by user")
+    token.cancel("batch cancelled")
+
+    assert token.cancelled
+    with pytest.raises(TaskCancelled, match="cancelled by user"):
+        token.raise_if_cancelled()
+
+
+def test_token_deadline_raises_deadline_exceeded():
+    token = CancellationToken(deadline=time.monotonic() - 1)
+
+    assert token.expired
+    with pytest.raises(TaskDeadlineExceeded):
+        token.raise_if_cancelled()
+
+
+def test_check_cancelled_is_a_no_op_outside_the_queue():
+    check_cancelled(None)
+
+
+def test_cancel_from_other_threads_is_seen_once():
+    token = CancellationToken()
+    threads = [threading.Thread(target=token.cancel, args=(f"reason {number}",)) for number in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert token.cancelled
+    assert token.reason.startswith("reason ")
+
+
+@pytest.fixture
+def queue():
+    queue = TaskQueue("test-key", "https://api.example", num_workers=1)
+    yield queue
+    queue.stop_processing(wait=True, timeout=5)
+
+
+def test_cancel_batch_counts_waiting_and_running_rows_apart(queue):
+    started = threading.Event()
+
+    def wait_for_cancel(value, task=None):
+        started.set()
+        while True:
+            check_cancelled(task)
+            time.sleep(0.01)
+
+    queue.add_task(wait_for_cancel, {"value": 0}, "batch")
+    for position in range(1, 4):
+        queue.add_task(lambda value, task=None: value, {"value": position}, "batch")
+    queue.add_task(lambda value, task=None: value, {"value": "other"}, "other-batch")
+    queue.start_processing()
+    assert started.wait(5)
+
+    assert queue.cancel_batch("batch", reason="cancelled by user") == {"cancelled": 3, "cancel_requested": 1}
+    assert queue.stop_processing(mode="drain", timeout=5)
+
+    assert queue.get_batch_stats("batch")["cancelled"] == 4
+    assert queue.get_batch_results("batch")[0] == "Cancelled: cancelled by user"
+    assert queue.get_batch_stats("other-batch")["completed"] == 1
+    assert queue.cancel_batch("batch") == {"cancelled": 0, "cancel_requested": 0}
+
+
+def test_running_row_that_finishes_before_its_check_point_completes(queue):
+    started = threading.Event()
+    release = threading.Event()
+
+    def finish_without_checking(value, task=None):
+        started.set()
+        release.wait(5)
+        return value
+
+    queue.add_task(finish_without_checking, {"value": "done"}, "batch")
+    queue.start_processing()
+    assert started.wait(5)
+
+    assert queue.cancel_task("batch_0") == "cancel_requested"
+    release.set()
+    assert queue.stop_processing(mode="drain", timeout=5)
+
+    assert queue.get_batch_stats("batch")["completed"] == 1
+    assert queue.cancel_task("batch_0") is None
+
+
+def test_row_timeout_fails_the_row_at_its_next_check_point(queue):
+    def slow(value, task=None):
+        while True:
+            check_cancelled(task)
+            time.sleep(0.01)
+
+    queue.add_task(slow, {"value": 0}, "batch", timeout=0.1)
+    queue.start_processing()
+    assert queue.stop_processing(mode="drain", timeout=5)
+
+    assert queue.get_batch_stats("batch")["failed"] == 1
+    assert "deadline" in queue.get_batch_results("batch")[0]
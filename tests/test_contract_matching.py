@@ -0,0 +1,87 @@
+from api.tools import billing_term_signature, match_contracts_to_groups, match_obligations_to_rows
+
+
+def billing_term(quantity, amount, start="2026-01-01", end="2026-01-31", name="Usage Credits"):
+    return {
+        "serviceStartDate": start,
+        "serviceEndDate": end,
+        "billingSchedule": {"name": name, "quantity": quantity, "pricing": [{"tier": 1, "amount": amount}]},
+    }
+
+
+def obligation(obligation_id, quantity, amount):
+    # Obligation records come back with timestamps and string numbers
+    record = billing_term(str(quantity), str(amount), start="2026-01-01T00:00:00.000Z", end="2026-01-31T00:00:00.000Z")
+    record["id"] = obligation_id
+    return record
+
+
+def contract(contract_id, status="NEW", created_at="2026-02-01"):
+    return {"id": contract_id, "customerId": "customer-1", "name": "Usage Credits for January 2026", "status": status, "createdAt": created_at}
+
+
+def test_signature_matches_payload_and_obligation_record():
+    assert billing_term_signature(billing_term(3, 100)) == billing_term_signature(obligation("ob-1", 3.0, "100.00"))
+    assert billing_term_signature(billing_term(3, 100)) != billing_term_signature(billing_term(3, 120))
+
+
+def test_contract_goes_to_the_row_its_obligation_belongs_to():
+    contracts = [contract("contract-a"), contract("contract-b", status="PROCESSED")]
+    contract_obligations = {"contract-a": [obligation("ob-1", 5, 50)], "contract-b": [obligation("ob-2", 3, 100)]}
+    group_signatures = [[billing_term_signature(billing_term(3, 100))], [billing_term_signature(billing_term(5, 50))], [billing_term_signature(billing_term(7, 70))]]
+
+    outcomes = match_contracts_to_groups(contracts, contract_obligations, group_signatures)
+
+    assert outcomes == [("processed", contracts[1]), ("reuse", contracts[0]), ("new", None)]
+
+
+def test_contract_without_obligations_goes_to_one_unmatched_row():
+    contracts = [contract("contract-a")]
+    group_signatures = [[billing_term_signature(billing_term(3, 100))], [billing_term_signature(billing_term(5, 50))]]
+
+    outcomes = match_contracts_to_groups(contracts, {"contract-a": []}, group_signatures)
+
+    assert outcomes == [("reuse", contracts[0]), ("new", None)]
+
+
+def test_more_than_one_matching_contract_needs_review():
+    contracts = [contract("contract-a"), contract("contract-b")]
+    contract_obligations = {"contract-a": [obligation("ob-1", 3, 100)], "contract-b": [obligation("ob-2", 3, 100)]}
+
+    outcomes = match_contracts_to_groups(contracts, contract_obligations, [[billing_term_signature(billing_term(3, 100))]])
+
+    assert outcomes[0][0] == "review"
+
+
+def test_contract_matching_two_identical_rows_needs_review():
+    contracts = [contract("contract-a")]
+    signature = billing_term_signature(billing_term(3, 100))
+
+    outcomes = match_contracts_to_groups(contracts, {"contract-a": [obligation("ob-1", 3, 100)]}, [[signature], [signature]])
+
+    assert [outcome for outcome, _ in outcomes] == ["review", "review"]
+
+
+def test_grouped_contract_matches_when_its_obligations_are_some_of_the_group_rows():
+    contracts = [contract("contract-a")]
+    group_signatures = [[billing_term_signature(billing_term(3, 100)), billing_term_signature(billing_term(5, 50))]]
+
+    outcomes = match_contracts_to_groups(contracts, {"contract-a": [obligation("ob-1", 5, 50)]}, group_signatures)
+
+    assert outcomes == [("reuse", contracts[0])]
+
+
+def test_existing_obligations_go_to_the_rows_they_match_not_the_first_rows():
+    billing_term_payloads = {"0": billing_term(3, 100), "1": billing_term(5, 50), "2": billing_term(7, 70)}
+
+    matched = match_obligations_to_rows(billing_term_payloads, [obligation("ob-1", 5, 50)])
+
+    assert matched == {"1": "ob-1"}
+
+
+def test_identical_rows_each_take_one_existing_obligation():
+    billing_term_payloads = {"0": billing_term(3, 100), "1": billing_term(3, 100)}
+    obligations = [dict(obligation("ob-2", 3, 100), createdAt="2026-02-02"), dict(obligation("ob-1", 3, 100), createdAt="2026-02-01")]
+
+    assert match_obligations_to_rows(billing_term_payloads, obligations) == {"0": "ob-1", "1": "ob-2"}
+    assert match_obligations_to_rows(billing_term_payloads, obligations[:1]) == {"0": "ob-2"}
@@ -0,0 +1,40 @@
+from api.tools import match_invoices_to_rows
+
+
+def invoice(invoice_id, contract_id, customer_id, issue_date="2026-01-31", created_at="2026-02-01T00:00:00Z", total=100):
+    return {"id": invoice_id, "contractId": contract_id, "customerId": customer_id, "issueDate": issue_date, "createdAt": created_at, "total": total, "status": "OPEN"}
+
+
+def test_rows_with_a_contract_only_take_that_contracts_invoice():
+    invoices = [invoice("inv-1", "contract-a", "customer-1"), invoice("inv-2", "contract-b", "customer-1")]
+
+    matches = match_invoices_to_rows(invoices, ["contract-b", "contract-a", "contract-a"], ["customer-1"] * 3, issue_date="2026-01-31")
+
+    assert [match["id"] for match in matches] == ["inv-2", "inv-1", "inv-1"]
+    assert {match["match"] for match in matches} == {"confirmed"}
+
+
+def test_row_with_a_contract_without_invoice_gets_no_fallback():
+    invoices = [invoice("inv-1", "contract-other", "customer-1")]
+
+    assert match_invoices_to_rows(invoices, ["contract-a"], ["customer-1"], issue_date="2026-01-31") == [None]
+
+
+def test_rows_without_contract_fall_back_to_customer_as_ambiguous():
+    invoices = [
+        invoice("inv-1", "contract-a", "customer-1"),
+        invoice("inv-2", "contract-x", "customer-1", created_at="2026-02-01T00:00:01Z"),
+        invoice("inv-3", "contract-y", "customer-1", created_at="2026-02-01T00:00:02Z"),
+        invoice("inv-4", "contract-z", "customer-1", issue_date="2026-01-15"),
+    ]
+
+    matches = match_invoices_to_rows(invoices, ["contract-a", None, None, None], ["customer-1"] * 4, issue_date="2026-01-31")
+
+    assert [match["id"] for match in matches] == ["inv-1", "inv-2", "inv-3", "inv-3"]
+    assert [match["match"] for match in matches] == ["confirmed", "ambiguous", "ambiguous", "ambiguous"]
+
+
+def test_rows_left_out_get_no_invoice():
+    invoices = [invoice("inv-1", "contract-x", "customer-1")]
+
+    assert match_invoices_to_rows(invoices, [None], [None], issue_date="2026-01-31") == [None]
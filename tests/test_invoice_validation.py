@@ -0,0 +1,61 @@
+import math
+
+import pandas as pd
+
+from api.tools import clean_numbers, validate_invoice_rows
+
+MAPPED = {
+    "Acme": {"customer_id": "customer-1", "net_terms": 30},
+    "Globex": {"customer_id": "customer-2", "net_terms": 45},
+}
+
+
+def upload(*rows):
+    return pd.DataFrame(rows, columns=["Rep Invoicing Tabs Customer Name", "Rep Invoicing Invoice Value", "Rep Invoicing Invoice Quantity"])
+
+
+def test_clean_numbers_parses_currency_strings_and_blanks_the_rest():
+    numbers = clean_numbers(pd.Series(["$1,234.50", " 7 ", "abc", None, "-3"]))
+
+    assert numbers.tolist()[:2] == [1234.5, 7.0]
+    assert math.isnan(numbers[2]) and math.isnan(numbers[3])
+    assert numbers[4] == -3.0
+
+
+def test_clean_numbers_keeps_numeric_columns():
+    assert clean_numbers(pd.Series([1, 2])).tolist() == [1.0, 2.0]
+
+
+def test_valid_rows_have_no_errors():
+    assert validate_invoice_rows(upload(("Acme", "$100.00", 1), ("Globex", 25, "2")), MAPPED) == {}
+
+
+def test_non_numeric_and_non_positive_amounts_are_reported():
+    errors = validate_invoice_rows(upload(("Acme", "abc", 1), ("Acme", 0, 1), ("Acme", 10, "-2"), ("Acme", None, 1)), MAPPED)
+
+    assert errors == {
+        0: "Amount is missing or not a number",
+        1: "Amount must be greater than zero",
+        2: "Quantity must be greater than zero",
+        3: "Amount is missing or not a number",
+    }
+
+
+def test_blank_and_unmapped_customers_are_reported():
+    matched = dict(MAPPED, Initech={"customer_id": "", "net_terms": 30}, Hooli={"customer_id": "customer-3", "net_terms": None})
+
+    errors = validate_invoice_rows(upload(("", 10, 1), (None, 10, 1), ("Initech", 10, 1), ("Hooli", 10, 1), ("Unknown", 10, 1)), matched)
+
+    assert errors == {
+        0: "Customer name is missing",
+        1: "Customer name is missing",
+        2: "Customer is not mapped to a Tabs customer",
+        3: "Customer is not mapped to a Tabs customer",
+        4: "Customer is not mapped to a Tabs customer",
+    }
+
+
+def test_every_problem_of_a_row_is_in_its_message():
+    errors = validate_invoice_rows(upload(("Acme", 10, 1), ("Unknown", "n/a", 0)), MAPPED)
+
+    assert errors == {1: "Customer is not mapped to a Tabs customer; Amount is missing or not a number; Quantity must be greater than zero"}
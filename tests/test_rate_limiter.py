@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+
+from helper import rate_limiter
+from helper.rate_limiter import RateLimiterRegistry, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # The bucket only reads time.monotonic(), a fixed clock makes refills exact
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_is_free_then_callers_are_spaced_at_the_rate(clock):
+    bucket = TokenBucket(rate=10, burst=3)
+
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.1)
+    assert bucket.reserve() == pytest.approx(0.2)
+
+
+def test_tokens_refill_up_to_the_burst(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    bucket.reserve()
+    bucket.reserve()
+
+    clock[0] += 10
+    assert bucket.reserve() == 0.0
+    assert bucket.tokens == pytest.approx(1.0)
+
+
+def test_configure_changes_the_rate_of_a_live_bucket(clock):
+    bucket = TokenBucket(rate=10, burst=1)
+    bucket.reserve()
+
+    bucket.configure(rate=2, burst=1)
+
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_acquire_sleeps_only_for_the_reserved_wait(clock, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(rate_limiter.time, "sleep", sleeps.append)
+    bucket = TokenBucket(rate=4, burst=1)
+
+    assert bucket.acquire() == 0.0
+    assert bucket.acquire() == pytest.approx(0.25)
+    assert sleeps == [pytest.approx(0.25)]
+
+
+def test_concurrent_reservations_hand_out_every_slot_once(clock):
+    bucket = TokenBucket(rate=100, burst=5)
+    waits = []
+    waits_lock = threading.Lock()
+
+    def reserve_many():
+        for _ in range(200):
+            wait = bucket.reserve()
+            with waits_lock:
+                waits.append(wait)
+
+    threads = [threading.Thread(target=reserve_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The clock does not move, so the n-th reservation past the burst waits exactly n / rate
+    expected = [0.0] * 5 + [n / 100 for n in range(1, 1600 - 5 + 1)]
+    assert sorted(waits) == pytest.approx(expected)
+
+
+def test_registry_shares_one_bucket_per_backend_and_key():
+    registry = RateLimiterRegistry()
+    registry.configure("https://api.example", "key-1", rate=3, burst=2)
+
+    bucket = registry.get_bucket("https://api.example", "key-1")
+
+    assert registry.get_bucket("https://api.example", "key-1") is bucket
+    assert registry.get_bucket("https://api.example", "key-2") is not bucket
+    assert (bucket.rate, bucket.burst) == (3.0, 2)
@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from helper.request_log import RequestLogStore, RequestRecord
+
+
+def record(batch_id="batch-1"):
+    return RequestRecord("GET", "https://api.example", "/v3/contracts", batch_id, status_code=200)
+
+
+def test_since_returns_only_what_was_appended_after_the_cursor():
+    store = RequestLogStore(capacity=10)
+    first = [record() for _ in range(3)]
+    for item in first:
+        store.append(item)
+
+    records, cursor = store.since(0)
+    assert records == first
+    assert cursor == 3
+
+    second = record()
+    store.append(second)
+    assert store.since(cursor) == ([second], 4)
+    assert store.since(4) == ([], 4)
+
+
+def test_since_skips_records_the_ring_buffer_dropped():
+    store = RequestLogStore(capacity=3)
+    records = [record() for _ in range(5)]
+    for item in records:
+        store.append(item)
+
+    assert store.since(0) == (records[2:], 5)
+    assert len(store) == 3
+
+
+def test_indexed_store_ignores_duplicates_and_forgets_dropped_records():
+    store = RequestLogStore(capacity=2, indexed=True)
+    first, second, third = record(), record(), record()
+
+    assert store.append(first) is True
+    assert store.append(first) is False
+    store.append(second)
+    store.append(third)
+
+    assert first.request_id not in store
+    assert store.get_record(third.request_id) is third
+    assert store.appended == 3
+
+
+def test_unindexed_store_has_no_lookup():
+    with pytest.raises(ValueError):
+        RequestLogStore().get_record(1)
+
+
+def test_concurrent_appends_are_all_counted_and_read_once():
+    store = RequestLogStore(capacity=100000)
+    seen = []
+    done = threading.Event()
+
+    def reader():
+        cursor = 0
+        while True:
+            finished = done.is_set()
+            records, cursor = store.since(cursor)
+            seen.extend(records)
+            if finished:
+                return
+
+    def writer():
+        for _ in range(2000):
+            store.append(record())
+
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.start()
+    writers = [threading.Thread(target=writer) for _ in range(8)]
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    done.set()
+    reader_thread.join()
+
+    assert store.appended == 16000
+    assert len({item.request_id for item in seen}) == len(seen) == 16000
@@ -0,0 +1,180 @@
+import socket
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import requests
+
+from api.main import generalized_make_request
+from helper import retry
+from helper.retry import (
+    GIVE_UP, RETRY, RETURN, RateLimitExhausted, RetryLater, RetryPolicy, UnconfirmedWrite, decide, get_retry_after,
+    send_with_retries,
+)
+from helper.task_queue import Task
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(retry.time, "sleep", slept.append)
+    return slept
+
+
+def sender(*outcomes):
+    """send() returning (or raising) each outcome in turn, records how often it was called"""
+    outcomes = list(outcomes)
+
+    def send(timeout):
+        send.calls += 1
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    send.calls = 0
+    return send
+
+
+def test_server_error_on_get_is_retried_until_success(sleeps):
+    send = sender(FakeResponse(503), FakeResponse(502), FakeResponse(200))
+
+    response = send_with_retries(send, "GET", policy=RetryPolicy(base_delay=0.01, max_delay=0.01))
+
+    assert response.status_code == 200
+    assert send.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_server_error_on_post_is_returned_not_retried(sleeps):
+    send = sender(FakeResponse(503))
+
+    response = send_with_retries(send, "POST", policy=RetryPolicy())
+
+    assert response.status_code == 503
+    assert send.calls == 1
+    assert sleeps == []
+
+
+def test_rate_limit_waits_what_the_server_asked_for(sleeps):
+    send = sender(FakeResponse(429, {"Retry-After": "1.5"}), FakeResponse(201))
+
+    response = send_with_retries(send, "POST", policy=RetryPolicy())
+
+    assert response.status_code == 201
+    assert sleeps == [1.5]
+
+
+def test_rate_limit_out_of_attempts_raises(sleeps):
+    send = sender(*[FakeResponse(429, {"Retry-After": "0"})] * 3)
+
+    with pytest.raises(RateLimitExhausted):
+        send_with_retries(send, "GET", policy=RetryPolicy(max_attempts=3))
+    assert send.calls == 3
+
+
+def test_connection_error_is_raised_after_the_last_attempt(sleeps):
+    send = sender(*[requests.exceptions.ConnectionError("down")] * 2)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        send_with_retries(send, "GET", policy=RetryPolicy(max_attempts=2, base_delay=0.01))
+    assert send.calls == 2
+
+
+def test_connection_error_on_post_is_not_retried(sleeps):
+    send = sender(requests.exceptions.ConnectionError("down"))
+
+    with pytest.raises(UnconfirmedWrite) as raised:
+        send_with_retries(send, "POST", policy=RetryPolicy())
+    assert isinstance(raised.value.__cause__, requests.exceptions.ConnectionError)
+    assert send.calls == 1
+
+
+def test_deadline_gives_up_instead_of_a_wait_past_it():
+    decision, delay, reason = decide(RetryPolicy(deadline=5), "GET", FakeResponse(429, {"Retry-After": "10"}), None, attempt=0, elapsed=1)
+
+    assert (decision, delay) == (GIVE_UP, 0.0)
+    assert "deadline" in reason
+
+
+def test_long_backoff_is_deferred_to_the_queue(sleeps):
+    send = sender(FakeResponse(429, {"Retry-After": "30"}))
+
+    with pytest.raises(RetryLater) as raised:
+        send_with_retries(send, "GET", policy=RetryPolicy(), defer_after=2)
+    assert raised.value.delay == 30
+    assert sleeps == []
+
+
+def test_callbacks_see_every_attempt_and_the_total_wait(sleeps):
+    attempts = []
+    completed = []
+    send = sender(FakeResponse(500), FakeResponse(200))
+
+    send_with_retries(
+        send, "GET", policy=RetryPolicy(base_delay=0.01),
+        before_attempt=lambda: 0.25,
+        on_attempt=lambda response, error, attempt, decision, delay, reason, latency: attempts.append((attempt, decision)),
+        on_complete=lambda response, error, wall_time, wait_time, retries: completed.append((response.status_code, wait_time, retries)))
+
+    assert attempts == [(0, RETRY), (1, RETURN)]
+    assert completed == [(200, 0.5, 1)]
+
+
+@pytest.fixture
+def stalled_server():
+    """A backend that accepts connections and never answers"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    yield f"http://127.0.0.1:{server.getsockname()[1]}"
+    server.close()
+
+
+def test_stalled_request_gives_up_at_the_deadline(monkeypatch, stalled_server):
+    monkeypatch.setattr(retry, "DEFAULT_RETRY_POLICY", RetryPolicy(base_delay=0.01, max_delay=0.01, deadline=0.5, attempt_timeout=0.2))
+    task = Task(function=None, args=None, batch_id="batch", backend_url=stalled_server, api_key="key")
+    started_at = time.monotonic()
+
+    with pytest.raises(requests.exceptions.Timeout):
+        generalized_make_request("/v3/customers", "GET", task=task)
+
+    assert time.monotonic() - started_at < 2
+    assert len(task.request_logs) >= 2
+
+
+def test_attempt_timeout_never_runs_past_the_deadline():
+    policy = RetryPolicy(deadline=10, attempt_timeout=3)
+
+    assert policy.timeout_for(0) == 3
+    assert policy.timeout_for(8.5) == 1.5
+    assert policy.timeout_for(12) == retry.MIN_ATTEMPT_TIMEOUT_SECONDS
+
+
+def test_backoff_is_capped_full_jitter():
+    policy = RetryPolicy(base_delay=1, max_delay=4)
+
+    assert all(0 <= policy.backoff(attempt) <= 4 for attempt in range(10) for _ in range(20))
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"Retry-After": "7"}, 7),
+    ({"X-RateLimit-Reset": "3"}, 3),
+    ({"Retry-After": "-4"}, 0),
+    ({}, None),
+])
+def test_retry_after_seconds(headers, expected):
+    assert get_retry_after(FakeResponse(429, headers)) == expected
+
+
+def test_retry_after_http_date_and_epoch():
+    in_ten_seconds = datetime.now(timezone.utc) + timedelta(seconds=10)
+
+    assert get_retry_after(FakeResponse(429, {"Retry-After": format_datetime(in_ten_seconds, usegmt=True)})) == pytest.approx(10, abs=1.5)
+    assert get_retry_after(FakeResponse(429, {"RateLimit-Reset": str(in_ten_seconds.timestamp())})) == pytest.approx(10, abs=1.5)
@@ -0,0 +1,234 @@
+import threading
+import time
+
+import pytest
+
+from helper.retry import RetryLater
+from helper.task_queue import AdaptiveConcurrencyController, PipelineStage, TaskQueue, save_checkpoint
+
+
+@pytest.fixture
+def make_queue():
+    queues = []
+
+    def make(**kwargs):
+        kwargs.setdefault("num_workers", 4)
+        queue = TaskQueue("test-key", "https://api.example", **kwargs)
+        queues.append(queue)
+        return queue
+    yield make
+    for queue in queues:
+        queue.stop_processing(wait=True, timeout=5)
+
+
+def run_to_completion(queue, timeout=10):
+    queue.start_processing()
+    assert queue.stop_processing(mode="drain", timeout=timeout)
+
+
+def succeed(value, task=None):
+    return value
+
+
+def return_none(value, task=None):
+    return None
+
+
+def fail(value, task=None):
+    raise ValueError(f"row {value} is invalid")
+
+
+def test_counters_track_every_outcome_per_batch(make_queue):
+    queue = make_queue()
+    outcomes = [succeed, return_none, fail]
+    for position in range(30):
+        queue.add_task(outcomes[position % 3], {"value": position}, "batch-a")
+    queue.add_tasks(succeed, range(10), "batch-b", build_args=lambda source: {"value": source})
+
+    run_to_completion(queue)
+
+    assert queue.get_batch_stats("batch-a") == {"total": 30, "pending": 0, "running": 0, "completed": 10, "failed": 20, "cancelled": 0}
+    assert queue.get_batch_stats("batch-b")["completed"] == 10
+    assert queue.progress()["total"] == 40
+    assert queue.progress()["completed"] == 20
+    assert queue.get_batch_results("batch-b") == list(range(10))
+    assert queue.is_done()
+
+
+def test_counters_stay_consistent_while_threads_add_rows(make_queue):
+    queue = make_queue(num_workers=8)
+    queue.start_processing()
+
+    def add_rows(batch_id):
+        for position in range(250):
+            queue.add_task(succeed, {"value": position}, batch_id)
+
+    adders = [threading.Thread(target=add_rows, args=(f"batch-{number}",)) for number in range(4)]
+    for thread in adders:
+        thread.start()
+    for thread in adders:
+        thread.join()
+    assert queue.stop_processing(mode="drain", timeout=10)
+
+    progress = queue.progress()
+    assert progress["total"] == progress["completed"] == 1000
+    assert progress["pending"] == progress["running"] == 0
+    for number in range(4):
+        assert queue.get_batch_stats(f"batch-{number}")["completed"] == 250
+
+
+def test_deferred_row_waits_in_the_delay_heap_without_holding_a_worker(make_queue):
+    queue = make_queue(num_workers=1)
+    finished = []
+
+    def deferred_once(value, task=None):
+        if task.deferrals == 0:
+            raise RetryLater(0.3, "rate limited")
+        finished.append(value)
+        return value
+
+    def quick(value, task=None):
+        finished.append(value)
+        return value
+
+    queue.add_task(deferred_once, {"value": "deferred"}, "batch")
+    queue.add_task(quick, {"value": "quick"}, "batch")
+    queue.start_processing()
+    deadline = time.monotonic() + 5
+    while "quick" not in finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # The only worker ran the second row while the first one was waiting out its backoff
+    assert finished == ["quick"]
+    assert queue.delayed_size() == 1
+    assert queue.stop_processing(mode="drain", timeout=5)
+    assert finished == ["quick", "deferred"]
+    assert queue.get_batch_stats("batch")["completed"] == 2
+    assert queue.delayed_size() == 0
+
+
+def test_stage_pipeline_runs_each_row_through_every_stage_in_order(make_queue):
+    queue = make_queue()
+    calls = []
+    calls_lock = threading.Lock()
+
+    def stage(name):
+        def run(value, task=None):
+            with calls_lock:
+                calls.append((value, name))
+            save_checkpoint(task, **{name: True})
+            return f"{value} done" if name == "last" else None
+        return run
+
+    stages = (PipelineStage("first", stage("first")), PipelineStage("middle", stage("middle"), concurrency=1), PipelineStage("last", stage("last")))
+    queue.add_tasks(succeed, range(20), "batch", build_args=lambda source: {"value": source}, stages=stages)
+
+    run_to_completion(queue)
+
+    assert queue.get_batch_results("batch") == [f"{value} done" for value in range(20)]
+    for value in range(20):
+        assert [name for row, name in calls if row == value] == ["first", "middle", "last"]
+    assert queue.get_batch_checkpoints("batch")[0] == {"first": True, "middle": True, "last": True}
+    assert {stats["stage"]: stats["done"] for stats in queue.get_stage_stats()} == {"first": 20, "middle": 20, "last": 20}
+
+
+def test_growing_the_pool_raises_the_concurrency_limit_with_it(make_queue):
+    queue = make_queue(num_workers=2)
+    running = []
+    peak = [0]
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def hold(value, task=None):
+        with lock:
+            running.append(value)
+            peak[0] = max(peak[0], len(running))
+        release.wait(5)
+        with lock:
+            running.remove(value)
+        return value
+
+    for position in range(12):
+        queue.add_task(hold, {"value": position}, "batch")
+    queue.start_processing()
+    queue.resize_workers(6)
+    deadline = time.monotonic() + 5
+    while peak[0] < 6 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    assert queue.stop_processing(mode="drain", timeout=10)
+
+    assert peak[0] == 6
+    assert queue.concurrency.snapshot()["limit"] == 6
+    assert queue.get_batch_stats("batch")["completed"] == 12
+
+
+def test_rate_limited_response_halves_the_concurrency_limit():
+    controller = AdaptiveConcurrencyController(max_limit=8, initial_limit=8, cooldown=0)
+
+    limits = []
+    for _ in range(4):
+        controller.record_response(True)
+        limits.append(controller.snapshot()["limit"])
+
+    assert limits == [4, 2, 1, 1]
+
+
+def test_overloaded_server_cuts_the_concurrency_limit():
+    controller = AdaptiveConcurrencyController(max_limit=8, initial_limit=8, cooldown=0)
+
+    controller.record_response(False, 0.1, "GET /v3/contracts", overloaded=True)
+
+    assert controller.snapshot()["limit"] == 4
+
+
+def test_concurrency_limit_is_cut_once_per_cooldown():
+    controller = AdaptiveConcurrencyController(max_limit=8, initial_limit=8, cooldown=60)
+
+    controller.record_response(True)
+    controller.record_response(True)
+
+    assert controller.snapshot()["limit"] == 4
+
+
+def test_full_window_of_healthy_responses_adds_one_slot():
+    controller = AdaptiveConcurrencyController(max_limit=4, initial_limit=2)
+
+    limits = []
+    for _ in range(9):
+        controller.record_response(False, 0.1, "GET /v3/contracts")
+        limits.append(controller.snapshot()["limit"])
+
+    # One slot per full window (as many healthy responses as the limit), never past the worker ceiling
+    assert limits == [2, 3, 3, 3, 4, 4, 4, 4, 4]
+
+
+def test_latency_rise_on_one_endpoint_cuts_the_concurrency_limit():
+    controller = AdaptiveConcurrencyController(max_limit=8, initial_limit=8, cooldown=0)
+    controller.record_response(False, 0.1, "GET /v3/contracts")
+    controller.record_response(False, 5.0, "POST /v16/bulk-create-billing-schedules")
+
+    assert controller.snapshot()["limit"] == 8
+
+    controller.record_response(False, 5.0, "GET /v3/contracts")
+
+    snapshot = controller.snapshot()
+    assert snapshot["limit"] == 4
+    assert set(snapshot["latencies"]) == {"GET /v3/contracts", "POST /v16/bulk-create-billing-schedules"}
+
+
+def test_acquire_waits_for_a_slot_under_the_limit():
+    controller = AdaptiveConcurrencyController(max_limit=2, initial_limit=1)
+
+    assert controller.acquire(timeout=0.05)
+    assert not controller.acquire(timeout=0.05)
+    controller.release()
+    assert controller.acquire(timeout=0.05)
+
+
+def test_shrinking_the_pool_caps_the_concurrency_limit():
+    controller = AdaptiveConcurrencyController(max_limit=8, initial_limit=8)
+
+    controller.set_max_limit(4)
+
+    assert controller.snapshot()["limit"] == 4
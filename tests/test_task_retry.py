@@ -0,0 +1,128 @@
+import pytest
+import requests
+
+from helper.retry import RateLimitExhausted, RetryPolicy, TaskRetryPolicy, UnconfirmedWrite, send_with_retries
+from helper.task_queue import TaskQueue, save_checkpoint
+
+
+class Flaky:
+    """Fails the first `failures` runs of each row with `error`, keeps a checkpoint so reruns skip the first step"""
+
+    def __init__(self, failures, error):
+        self.failures = failures
+        self.error = error
+        self.first_steps = 0
+        self.runs = {}
+
+    def __call__(self, value, task=None):
+        if not (task.checkpoint or {}).get("first"):
+            self.first_steps += 1
+            save_checkpoint(task, first=True)
+        self.runs[value] = self.runs.get(value, 0) + 1
+        if self.runs[value] <= self.failures:
+            raise Exception(f"step failed for {value}") from self.error
+        return value
+
+
+@pytest.fixture
+def queue():
+    queue = TaskQueue("test-key", "https://api.example", num_workers=2, retry_policy=TaskRetryPolicy(max_attempts=1))
+    yield queue
+    queue.stop_processing(wait=True, timeout=5)
+
+
+def run_to_completion(queue):
+    queue.start_processing()
+    assert queue.stop_processing(mode="drain", timeout=10)
+
+
+def test_policy_follows_the_exception_chain():
+    policy = TaskRetryPolicy(max_attempts=3)
+    try:
+        try:
+            raise requests.exceptions.Timeout("slow")
+        except requests.exceptions.Timeout as e:
+            raise Exception("Error creating contract") from e
+    except Exception as wrapped:
+        error = wrapped
+
+    assert policy.should_retry(0, error)
+    assert policy.should_retry(1, error)
+    assert not policy.should_retry(2, error)
+    assert not policy.should_retry(0, ValueError("bad row"))
+    assert not policy.should_retry(0, None)
+    assert TaskRetryPolicy(max_attempts=2, retry_all_errors=True).should_retry(0, None)
+
+
+def test_create_that_got_no_response_is_not_retried():
+    def send(timeout):
+        raise requests.exceptions.ReadTimeout("no response")
+    try:
+        try:
+            send_with_retries(send, "POST", policy=RetryPolicy())
+        except UnconfirmedWrite as e:
+            raise Exception("Error creating contract") from e
+    except Exception as wrapped:
+        error = wrapped
+
+    assert isinstance(error.__cause__.__cause__, requests.exceptions.ReadTimeout)
+    assert not TaskRetryPolicy(max_attempts=3).should_retry(0, error)
+    assert not TaskRetryPolicy(max_attempts=3, retry_all_errors=True).should_retry(0, error)
+
+
+def test_create_that_never_connected_is_still_retried():
+    def send(timeout):
+        raise requests.exceptions.ConnectTimeout("no connection")
+
+    with pytest.raises(requests.exceptions.ConnectTimeout) as raised:
+        send_with_retries(send, "POST", policy=RetryPolicy())
+    assert TaskRetryPolicy(max_attempts=3).should_retry(0, raised.value)
+
+
+def test_retryable_failure_runs_again_from_its_checkpoint(queue):
+    chain = Flaky(failures=2, error=RateLimitExhausted("429"))
+    queue.register_batch("batch", retry_policy=TaskRetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.01))
+    queue.add_tasks(chain, range(5), "batch", build_args=lambda source: {"value": source})
+
+    run_to_completion(queue)
+
+    assert queue.get_batch_results("batch") == list(range(5))
+    assert chain.first_steps == 5
+    assert queue.get_dead_letters("batch") == []
+    assert queue.get_batch_timings("batch")[0]["attempts"] == 3
+
+
+def test_rows_out_of_attempts_go_to_the_dead_letters_and_can_be_retried(queue):
+    chain = Flaky(failures=1, error=ValueError("bad row"))
+    queue.register_batch("batch", retry_policy=TaskRetryPolicy(max_attempts=3, base_delay=0.01))
+    queue.add_tasks(chain, range(3), "batch", build_args=lambda source: {"value": source})
+    queue.add_task(lambda value, task=None: value, {"value": "ok"}, "batch")
+
+    run_to_completion(queue)
+
+    # Not retryable under the policy, so every row fails on its first run
+    dead_letters = queue.get_dead_letters("batch")
+    assert sorted(dead_letter["task_id"] for dead_letter in dead_letters) == ["batch_0", "batch_1", "batch_2"]
+    assert all(dead_letter["attempts"] == 1 for dead_letter in dead_letters)
+    assert queue.get_batch_stats("batch")["failed"] == 3
+
+    # The second run of each row is past its failures and only reruns what the checkpoint does not cover
+    assert queue.retry_dead_letters("batch") == 3
+    run_to_completion(queue)
+
+    assert queue.get_batch_results("batch") == [0, 1, 2, "ok"]
+    assert queue.get_batch_stats("batch")["completed"] == 4
+    assert queue.get_dead_letters("batch") == []
+    assert chain.first_steps == 3
+
+
+def test_other_batches_keep_the_queue_policy(queue):
+    chain = Flaky(failures=1, error=RateLimitExhausted("429"))
+    queue.register_batch("retried", retry_policy=TaskRetryPolicy(max_attempts=2, base_delay=0.01))
+    queue.add_task(chain, {"value": "retried"}, "retried")
+    queue.add_task(chain, {"value": "single run"}, "single-run")
+
+    run_to_completion(queue)
+
+    assert queue.get_batch_stats("retried")["completed"] == 1
+    assert queue.get_batch_stats("single-run")["failed"] == 1
@@ -0,0 +1,131 @@
+
+import time
+
+import pytest
+
+from api.chains import create_contract_step, step_checkpoint
+from helper.request_log import RequestRecord
+from helper.task_queue import Task, TaskQueue, save_checkpoint
+from helper.task_store import TaskStore, batch_owner
+
+BACKEND_URL = "https://api.example"
+steps_run = []
+
+
+def two_step_chain(value, task=None):
+    checkpoint = step_checkpoint(task, None)
+    if "first" not in checkpoint:
+        steps_run.append(("first", value))
+        save_checkpoint(task, first=f"{value}-first")
+    steps_run.append(("second", value))
+    return checkpoint["first"]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return TaskStore(str(tmp_path / "tasks.db"))
+
+
+@pytest.fixture
+def make_queue(store):
+    queues = []
+
+    def make(api_key="test-key"):
+        queue = TaskQueue(api_key, BACKEND_URL, num_workers=2, store=store)
+        queues.append(queue)
+        return queue
+    yield make
+    for queue in queues:
+        queue.stop_processing(wait=True, timeout=5)
+
+
+def test_resumed_task_continues_after_its_last_checkpoint(store, make_queue):
+    steps_run.clear()
+    first_queue = make_queue()
+    first_queue.register_batch("batch", meta={"contract_name": "January"})
+    first_queue.add_tasks(two_step_chain, ["a", "b"], "batch", build_args=lambda source: {"value": source})
+    # The app stops after the first step of row "a", before anything else ran
+    task = first_queue.tasks["batch_0"]
+    save_checkpoint(task, first="a-first")
+    store.release_leases(first_queue.lease_holder)
+
+    second_queue = make_queue()
+    assert second_queue.resume_batch("batch") == 2
+    second_queue.set_args_factory("batch", lambda source: {"value": source})
+    second_queue.start_processing()
+    assert second_queue.stop_processing(mode="drain", timeout=5)
+
+    assert second_queue.get_batch_results("batch") == ["a-first", "b-first"]
+    assert sorted(steps_run) == [("first", "b"), ("second", "a"), ("second", "b")]
+    assert [row["status"] for row in store.load_tasks("batch")] == ["completed", "completed"]
+    assert store.list_unfinished_batches(second_queue.owner) == []
+
+
+def test_checkpointed_step_does_not_call_the_api_again():
+    checkpoint = {"contract_id": "contract-1"}
+
+    assert create_contract_step("customer-1", "January", None, checkpoint=checkpoint) == "contract-1"
+
+
+def test_batch_is_only_resumed_by_its_owner_once_the_lease_is_free(store, make_queue):
+    running_queue = make_queue()
+    running_queue.register_batch("batch")
+    running_queue.add_task(two_step_chain, {"value": "a"}, "batch")
+
+    with pytest.raises(ValueError, match="still running"):
+        make_queue().resume_batch("batch")
+    with pytest.raises(ValueError, match="another merchant"):
+        make_queue(api_key="other-key").resume_batch("batch")
+
+    store.release_leases(running_queue.lease_holder)
+    assert make_queue().resume_batch("batch") == 1
+
+
+def test_claim_is_refused_while_another_lease_is_live(store):
+    owner = batch_owner(BACKEND_URL, "test-key")
+    store.save_batch("batch", owner)
+
+    assert store.claim_batch("batch", owner, "holder-1", lease_seconds=60)
+    assert not store.claim_batch("batch", owner, "holder-2", lease_seconds=60)
+    assert store.claim_batch("batch", owner, "holder-1", lease_seconds=60)
+
+    store.claim_batch("batch", owner, "holder-1", lease_seconds=-1)
+    assert store.claim_batch("batch", owner, "holder-2", lease_seconds=60)
+
+
+def test_request_records_are_written_once(store):
+    records = [RequestRecord("GET", BACKEND_URL, "/v3/contracts", "batch", status_code=200) for _ in range(3)]
+
+    store.save_request_records("batch_0", "batch", records[:2], first_sequence=0)
+    store.save_request_records("batch_0", "batch", records, first_sequence=0)
+
+    assert store.get_request_sequences("batch") == {"batch_0": 3}
+    assert store._query("SELECT COUNT(*) AS count FROM request_records")[0]["count"] == 3
+
+
+def test_large_batch_is_enqueued_without_waiting_for_the_store(store, make_queue):
+    def enqueue(queue):
+        queue.register_batch("batch")
+        started_at = time.perf_counter()
+        queue.add_tasks(two_step_chain, range(50_000), "batch", build_args=lambda source: {"value": source})
+        return time.perf_counter() - started_at
+    in_memory = TaskQueue("test-key", BACKEND_URL, num_workers=2)
+    memory_time = enqueue(in_memory)
+
+    queue = make_queue()
+    store_time = enqueue(queue)
+
+    # Saving the rows used to take about three times as long as the enqueue itself
+    assert store_time < 1.5 * memory_time + 0.1
+    assert queue.flush_store(timeout=30)
+    assert len(store.load_tasks("batch")) == 50_000
+
+
+def test_task_that_ran_before_its_row_was_written_is_saved_as_finished(store):
+    # add_tasks writes the rows in the background, a task can finish before its row is in the store
+    task = Task(function=two_step_chain, args=None, batch_id="batch", status="completed", result="a-first", checkpoint={"first": "a-first"}, source="a")
+
+    store.save_tasks([("batch_0", 0, task, None)])
+
+    row = store.load_tasks("batch")[0]
+    assert (row["status"], row["result"], row["checkpoint"]) == ("completed", "a-first", {"first": "a-first"})